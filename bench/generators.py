@@ -0,0 +1,212 @@
+""" Synthetic circuits with known node voltages, for benchmarking the solver.
+
+Each generator returns a Case: the circuit as flat arrays, in the layout
+CompactCircuit stores, plus the exact voltage of every node. """
+
+from collections import namedtuple
+import numpy as np
+from src.circuit import Circuit, Resistor, VoltageSource, Wire, \
+                        RESISTOR, VOLTAGE_SOURCE, WIRE
+from src.compact import CompactCircuit
+
+# Voltage of the source driving every case
+VOLTAGE = 10.0
+
+# locations is the node table, and kinds/src/dest/values the elements, with
+# src and dest indexing the node table. expected is the voltage of each node.
+Case = namedtuple("Case", "name locations kinds src dest values ground expected")
+
+####################################################
+## Generators
+####################################################
+
+def ladder(nodes, seed=0):
+    """ Two rails, each a chain of equal resistors from the source to ground,
+    joined by rungs of random resistors. Both rails divide the voltage the same
+    way, so no current flows through the rungs and node k of a rail is at
+    V * (1 - k/n). """
+    random = np.random.RandomState(seed)
+    n = max(2, nodes // 2)
+    # Node 0 is the source's plus node, node 1 ground, then the rails' inner nodes
+    top, bottom = 2 + np.arange(n - 1), 1 + n + np.arange(n - 1)
+    topChain = np.concatenate(([0], top, [1]))
+    bottomChain = np.concatenate(([0], bottom, [1]))
+
+    src = [[1], topChain[:-1], bottomChain[:-1], top]
+    dest = [[0], topChain[1:], bottomChain[1:], bottom]
+    kinds = [[VOLTAGE_SOURCE], [RESISTOR] * n, [RESISTOR] * n, [RESISTOR] * (n - 1)]
+    values = [[VOLTAGE], np.full(n, 1.0), np.full(n, 3.0), random.uniform(1, 100, n - 1)]
+
+    rail = VOLTAGE * (1 - np.arange(1, n) / float(n))
+    expected = np.concatenate(([VOLTAGE, 0.0], rail, rail))
+    locations = ["in", "0"] + [("top", k) for k in range(1, n)] + [("bottom", k) for k in range(1, n)]
+    return _case("ladder", locations, kinds, src, dest, values, expected)
+
+def grid(nodes, dimensions=2, seed=0):
+    """ A 2-D or 3-D grid of resistors, with the face x = 0 wired to the source
+    and the face x = side - 1 wired to ground. Resistors along x are equal
+    within each line of the grid, so every plane across x is at one voltage
+    and the voltage falls linearly with x. """
+    random = np.random.RandomState(seed)
+    side = max(2, int(round(nodes ** (1.0 / dimensions))))
+    shape = (side,) * dimensions
+    count = side ** dimensions
+    index = np.arange(count).reshape(shape)
+    x = np.unravel_index(np.arange(count), shape)[0]
+
+    kinds, src, dest, values = [], [], [], []
+    for axis in range(dimensions):
+        a = _take(index, axis, slice(None, -1)).ravel()
+        b = _take(index, axis, slice(1, None)).ravel()
+        if axis == 0:
+            # One resistance per line along x
+            lines = random.uniform(1, 100, count // side)
+            resistance = np.repeat(lines[None, :], side - 1, axis=0).ravel()
+        else:
+            resistance = random.uniform(1, 100, len(a))
+        kinds.append([RESISTOR] * len(a))
+        src.append(a)
+        dest.append(b)
+        values.append(resistance)
+
+    # The source's plus node and ground come after the grid
+    plus, ground = count, count + 1
+    first, last = _take(index, 0, 0).ravel(), _take(index, 0, -1).ravel()
+    kinds += [[VOLTAGE_SOURCE], [WIRE] * len(first), [WIRE] * len(last)]
+    src += [[ground], np.full(len(first), plus), last]
+    dest += [[plus], first, np.full(len(last), ground)]
+    values += [[VOLTAGE], np.zeros(len(first)), np.zeros(len(last))]
+
+    expected = np.concatenate((VOLTAGE * (1 - x / float(side - 1)), [VOLTAGE, 0.0]))
+    locations = _gridLocations(shape) + ["in", "0"]
+    return _case("grid%dd" % dimensions, locations, kinds, src, dest, values, expected)
+
+def grid3d(nodes, seed=0):
+    return grid(nodes, 3, seed)
+
+def wireHeavy(nodes, wires=3, seed=0):
+    """ A 2-D grid laid out the way the GUI draws circuits: every resistor along
+    x sits at the end of a run of wires, and the nodes of each column are joined
+    by wires. Most elements are wires, and each column merges into one supernode
+    whose voltage follows from the total conductance between columns. """
+    random = np.random.RandomState(seed)
+    columns = max(2, int(round((nodes / float(wires + 1)) ** 0.5)))
+    rows = columns
+    corners = np.arange(columns * rows).reshape(columns, rows)
+
+    kinds, src, dest, values = [], [], [], []
+    # Wires down each column
+    a, b = corners[:, :-1].ravel(), corners[:, 1:].ravel()
+    kinds.append([WIRE] * len(a))
+    src.append(a)
+    dest.append(b)
+    values.append(np.zeros(len(a)))
+
+    # Each link along x: wires through `wires` extra nodes, then a resistor
+    a, b = corners[:-1, :].ravel(), corners[1:, :].ravel()
+    links = len(a)
+    extra = columns * rows + np.arange(links * wires).reshape(links, wires)
+    chain = np.hstack((a[:, None], extra, b[:, None]))
+    kinds.append(np.repeat([[WIRE] * wires + [RESISTOR]], links, axis=0).ravel())
+    src.append(chain[:, :-1].ravel())
+    dest.append(chain[:, 1:].ravel())
+    resistance = np.zeros((links, wires + 1))
+    resistance[:, -1] = random.uniform(1, 100, links)
+    values.append(resistance.ravel())
+
+    count = columns * rows + links * wires
+    plus, ground = count, count + 1
+    kinds += [[VOLTAGE_SOURCE], [WIRE], [WIRE]]
+    src += [[ground], [plus], [corners[-1, 0]]]
+    dest += [[plus], [corners[0, 0]], [ground]]
+    values += [[VOLTAGE], [0.0], [0.0]]
+
+    # A column's voltage only depends on the total conductance between columns
+    conductance = 1.0 / resistance[:, -1].reshape(columns - 1, rows)
+    drops = 1.0 / conductance.sum(axis=1)
+    columnVoltage = VOLTAGE * (1 - np.concatenate(([0.0], np.cumsum(drops))) / drops.sum())
+    expected = np.concatenate((np.repeat(columnVoltage, rows),
+                               np.repeat(columnVoltage[:-1], rows * wires), [VOLTAGE, 0.0]))
+    locations = _gridLocations((columns, rows)) + [("wire", k) for k in range(links * wires)] + ["in", "0"]
+    return _case("wireheavy", locations, kinds, src, dest, values, expected)
+
+def randomMesh(nodes, degree=4, seed=0):
+    """ Nodes joined by random resistors to nearby nodes, each also tied to ground and, where
+    needed, to the source. The voltages are drawn first and the resistors to
+    ground and the source are chosen so every node's currents balance, which
+    makes the drawn voltages the exact solution. """
+    random = np.random.RandomState(seed)
+    n = max(2, nodes - 2)
+    potential = VOLTAGE * random.uniform(0.1, 0.9, n)
+    # Each node links to random nodes shortly after it, as in a layout where
+    # neighbours are close. Links between far apart nodes would make the LU
+    # factors nearly dense, which no real circuit is like.
+    reach = max(2, int(n ** 0.5))
+    a = random.randint(0, n, n * degree // 2)
+    b = (a + random.randint(1, reach, len(a))) % n
+    a, b = a[a != b], b[a != b]
+    resistance = random.uniform(1, 100, len(a))
+
+    # Current flowing into each node through the mesh and its resistor to ground
+    flow = (potential[a] - potential[b]) / resistance
+    grounding = random.uniform(1, 100, n)
+    current = np.bincount(b, flow, n) - np.bincount(a, flow, n) - potential / grounding
+    # Nodes short of current get it from the source, the rest send theirs to ground
+    fromSource, toGround = current < 0, current > 0
+    balance = np.zeros(n)
+    balance[fromSource] = (VOLTAGE - potential[fromSource]) / -current[fromSource]
+    balance[toGround] = potential[toGround] / current[toGround]
+    balanced = current != 0
+
+    plus, ground = n, n + 1
+    nodeIds = np.arange(n)
+    kinds = [[VOLTAGE_SOURCE], [RESISTOR] * len(a), [RESISTOR] * n, [RESISTOR] * balanced.sum()]
+    src = [[ground], a, nodeIds, np.where(fromSource, plus, nodeIds)[balanced]]
+    dest = [[plus], b, np.full(n, ground), np.where(fromSource, nodeIds, ground)[balanced]]
+    values = [[VOLTAGE], resistance, grounding, balance[balanced]]
+
+    expected = np.concatenate((potential, [VOLTAGE, 0.0]))
+    locations = range(n) + ["in", "0"]
+    return _case("randommesh", locations, kinds, src, dest, values, expected)
+
+GENERATORS = {"ladder": ladder, "grid2d": grid, "grid3d": grid3d,
+              "wireheavy": wireHeavy, "randommesh": randomMesh}
+
+####################################################
+## Building circuits
+####################################################
+
+def build(case, backend="compact"):
+    """ The case as a circuit, a CompactCircuit or one made of element objects """
+    if backend == "compact":
+        circuit = CompactCircuit(len(case.kinds))
+        for location in case.locations:
+            circuit.addNode(location)
+        circuit.addElements(case.kinds, case.src, case.dest, case.values)
+    else:
+        circuit = Circuit()
+        locations = case.locations
+        for kind, a, b, value in zip(case.kinds.tolist(), case.src.tolist(),
+                                     case.dest.tolist(), case.values.tolist()):
+            if kind == RESISTOR:
+                circuit.addElement(Resistor(locations[a], locations[b], value))
+            elif kind == VOLTAGE_SOURCE:
+                circuit.addElement(VoltageSource(locations[a], locations[b], value))
+            else:
+                circuit.addElement(Wire(locations[a], locations[b]))
+    circuit.addGround(case.ground)
+    return circuit
+
+def _case(name, locations, kinds, src, dest, values, expected):
+    join = lambda parts, dtype: np.concatenate([np.asarray(p, dtype=dtype) for p in parts])
+    return Case(name, locations, join(kinds, np.int8), join(src, np.int32),
+                join(dest, np.int32), join(values, float), "0", expected)
+
+def _take(array, axis, which):
+    """ array[..., which, ...] with which applied along axis """
+    index = [slice(None)] * array.ndim
+    index[axis] = which
+    return array[tuple(index)]
+
+def _gridLocations(shape):
+    return zip(*[c.tolist() for c in np.unravel_index(np.arange(np.prod(shape)), shape)])
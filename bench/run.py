@@ -0,0 +1,173 @@
+""" Runs the solver benchmarks and saves the results as JSON.
+
+    python -m bench.run --cases grid2d,randommesh --sizes 10,1000,1000000 -o results.json
+    python -m bench.run -o new.json --compare old.json
+    python -m bench.run --ordering colamd -o colamd.json --compare new.json
+
+Every case runs in a fresh process, so its peak memory isn't hidden by an
+earlier, bigger case. Building the circuit, indexing its nodes, building the
+equations (Circuit._createEquations) and solving them (factoring them in the
+given fill reducing ordering, see matrix.Ordering) are timed separately,
+along with how far each raised the peak memory. The fill, the nonzeros of
+the LU factors, is recorded too. The solution is checked against the case's
+known voltages, and a case that doesn't match fails the run. """
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy
+from src.matrix import Ordering, ORDERINGS, DEFAULT_ORDERING
+from bench.generators import GENERATORS, VOLTAGE, build
+
+DEFAULT_SIZES = (10, 1000, 10000)
+# Largest error allowed, relative to the source voltage
+TOLERANCE = 1e-6
+PHASES = ("build", "index", "equations", "solve")
+
+####################################################
+## Running a case
+####################################################
+
+def runCase(name, size, backend="compact", seed=0, ordering=DEFAULT_ORDERING):
+    """ Generates, builds and solves one case, returning its measurements """
+    peaks, times = {}, {}
+    before = peakMemory()
+
+    start = time.time()
+    case = GENERATORS[name](size, seed=seed)
+    circuit = build(case, backend)
+    times["build"] = time.time() - start
+    peaks["build"] = peakMemory()
+
+    start = time.time()
+    circuit._indexNodes()
+    times["index"] = time.time() - start
+    peaks["index"] = peakMemory()
+
+    start = time.time()
+    A, b = circuit._createEquations()
+    times["equations"] = time.time() - start
+    peaks["equations"] = peakMemory()
+
+    start = time.time()
+    factor = Ordering(ordering).factor(A)
+    x = factor.solve(b) if factor is not None else None
+    times["solve"] = time.time() - start
+    peaks["solve"] = peakMemory()
+
+    error = None
+    if x is not None:
+        voltages = np.append(x[:circuit.dim], 0.0)[circuit._nodeCols]
+        order = [circuit._nodeIndex(loc) for loc in case.locations]
+        error = float(np.abs(voltages[order] - case.expected).max())
+
+    # How much each phase raised the peak over the one before it
+    raised, last = {}, before
+    for phase in PHASES:
+        raised[phase] = max(0, peaks[phase] - last)
+        last = max(last, peaks[phase])
+    return {"case": name, "size": size, "backend": backend, "ordering": ordering,
+            "nodes": len(case.locations), "elements": len(case.kinds),
+            "unknowns": A.shape[0], "nonzeros": A.nnz,
+            "fill": factor.lu.L.nnz + factor.lu.U.nnz if factor is not None else None,
+            "seconds": times, "memory": raised, "peakMemory": peaks["solve"],
+            "error": error, "passed": error is not None and error <= TOLERANCE * VOLTAGE}
+
+def peakMemory():
+    """ Peak resident memory of this process so far, in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _runCase(args):
+    return runCase(*args)
+
+def runIsolated(name, size, backend="compact", seed=0, ordering=DEFAULT_ORDERING):
+    """ runCase in a process of its own """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_runCase, ((name, size, backend, seed, ordering),))
+    finally:
+        pool.terminate()
+        pool.join()
+
+####################################################
+## Reports
+####################################################
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "scipy": scipy.__version__,
+            "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def describe(result):
+    seconds = result["seconds"]
+    return "%-10s %8d nodes  build %8.3fs  index %8.3fs  equations %8.3fs  solve %8.3fs  " \
+           "fill %10d  peak %7.1fMB  error %.1e  %s" % (
+               result["case"], result["nodes"], seconds["build"], seconds["index"],
+               seconds["equations"], seconds["solve"], result["fill"] or 0,
+               result["peakMemory"] / 1e6,
+               result["error"] if result["error"] is not None else float("nan"),
+               "ok" if result["passed"] else "FAILED")
+
+def compare(results, baseline):
+    """ Lines comparing the equation and solve times and the fill with a
+    baseline run """
+    old = dict(((r["case"], r["size"], r["backend"]), r) for r in baseline["cases"])
+    lines = []
+    for result in results:
+        before = old.get((result["case"], result["size"], result["backend"]))
+        if before is None:
+            continue
+        ratios = ["%s x%.2f" % (phase, result["seconds"][phase] / max(before["seconds"][phase], 1e-9))
+                  for phase in ("equations", "solve")]
+        if result.get("fill") and before.get("fill"):
+            ratios.append("fill x%.2f" % (float(result["fill"]) / before["fill"]))
+        lines.append("%-10s %8d nodes  %s  peak x%.2f" % (
+            result["case"], result["nodes"], "  ".join(ratios),
+            float(result["peakMemory"]) / max(before["peakMemory"], 1)))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the circuit solver.")
+    parser.add_argument("--cases", default=",".join(sorted(GENERATORS)),
+                        help="comma separated, from %s" % ", ".join(sorted(GENERATORS)))
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated node counts, up to 1000000")
+    parser.add_argument("--backend", choices=("compact", "object"), default="compact")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ordering", choices=ORDERINGS, default=DEFAULT_ORDERING,
+                        help="fill reducing ordering to factor in")
+    parser.add_argument("-o", "--output", help="JSON file to save the results in")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.cases.split(","):
+        if name not in GENERATORS:
+            parser.error("unknown case %r" % name)
+        for size in map(int, args.sizes.split(",")):
+            result = runIsolated(name, size, args.backend, args.seed, args.ordering)
+            print describe(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "cases": results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(results, json.load(f)):
+                print line
+    return 0 if all(r["passed"] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
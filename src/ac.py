@@ -0,0 +1,208 @@
+""" AC small-signal analysis: node voltage phasors over a range of frequencies.
+
+Every element is an admittance: 1/R for a resistor, j w C for a capacitor and
+1/(j w L) for an inductor, so the system at angular frequency w is
+
+    A(w) = G + j w C + (1 / j w) L
+
+where G, C and L are stamped once and share one sparsity pattern. Small
+circuits are solved for many frequencies at once as a stack of dense
+systems, larger ones as sparse block diagonal matrices with a block per
+frequency, which keeps the per frequency overhead of a factorization down. """
+
+import numpy as np
+from scipy import sparse
+import instrument
+from circuit import GROUND, REMOVED, WIRE, VOLTAGE_SOURCE, RESISTOR, CAPACITOR, INDUCTOR, \
+                    NONLINEAR
+from matrix import buildMatrix, Ordering
+
+# Largest system solved as a stack of dense matrices, and the most memory
+# a stack may take
+MAX_DENSE_SIZE = 16
+STACK_BYTES = 1 << 26
+# Larger systems are factored as block diagonal matrices of this many unknowns
+# at most, and this many frequencies
+BLOCK_UNKNOWNS = 1 << 15
+MAX_BLOCKS = 256
+
+####################################################
+## Frequency sweeps
+####################################################
+
+class ACResult(object):
+    """ Node voltage phasors of an AC sweep, a row per frequency and a column
+    per node in sorted(circuit.nodes) order. Frequencies where the circuit
+    can't be solved, and floating nodes, are NaN. """
+
+    def __init__(self, frequencies, locations, voltages):
+        self.frequencies = frequencies
+        self.locations = locations
+        self.voltages = voltages
+
+    @property
+    def magnitude(self):
+        return np.abs(self.voltages)
+
+    @property
+    def phase(self):
+        """ Phase in degrees """
+        return np.degrees(np.angle(self.voltages))
+
+    def decibels(self, reference=1.0):
+        """ Magnitude in dB relative to reference volts """
+        with np.errstate(divide="ignore"):
+            return 20 * np.log10(self.magnitude / reference)
+
+    def node(self, location):
+        """ Phasors of one node across the sweep """
+        return self.voltages[:, self.locations.index(location)]
+
+def acSweep(circuit, frequencies, sources=None):
+    """ Solves the circuit at each frequency (in Hz, all positive).
+
+    sources optionally maps voltage sources of the circuit to their phasor
+    amplitude (a complex number for a phase shift). Sources left out are off.
+    By default every source drives the circuit with its DC voltage as the
+    amplitude. Returns an ACResult. """
+    frequencies = np.asarray(frequencies, dtype=float)
+    if np.any(frequencies <= 0):
+        raise ValueError("AC frequencies must be positive")
+    trace = instrument.begin("ac")
+    try:
+        system = ACSystem(circuit)
+        instrument.count("points", len(frequencies))
+        return ACResult(frequencies, sorted(circuit.nodes), system.solve(frequencies, sources))
+    finally:
+        instrument.end(trace)
+
+class ACSystem(object):
+    """ The G, C and L parts of a circuit's admittance matrix """
+
+    def __init__(self, circuit):
+        if circuit.ground not in circuit.nodes:
+            raise ValueError("The circuit has no ground")
+        self.circuit = circuit
+
+        # Only wires merge nodes, inductors are admittances like the rest
+        locations, kinds, src, dest = circuit._topologyArrays()
+        if np.any(kinds == NONLINEAR):
+            raise ValueError("AC analysis doesn't support nonlinear elements")
+        nodeCols, grounded, self.floating = circuit._columns(kinds == WIRE, kinds != REMOVED)
+        self.dim = nodeCols.max() + 1
+        self._sortedCols = nodeCols[circuit._locationOrder()]
+
+        values = circuit._values()
+        inSystem = grounded[src]
+        self._sourceIdx = np.flatnonzero((kinds == VOLTAGE_SOURCE) & inSystem)
+        self.size = self.dim + len(self._sourceIdx)
+        branches = np.flatnonzero(np.in1d(kinds, (RESISTOR, CAPACITOR, INDUCTOR)) & inSystem)
+        value, kind = values[branches], kinds[branches]
+
+        # Each part gets every entry, zero where it doesn't apply, so the
+        # three compressed matrices line up entry for entry
+        with instrument.phase("assembly"):
+            parts = [np.where(kind == RESISTOR, 1.0 / value, 0.0),
+                     np.where(kind == CAPACITOR, value, 0.0),
+                     np.where(kind == INDUCTOR, 1.0 / value, 0.0)]
+            rows, cols, entries = _stamp(self.dim, self.size,
+                                         nodeCols[src[branches]], nodeCols[dest[branches]], parts,
+                                         nodeCols[src[self._sourceIdx]], nodeCols[dest[self._sourceIdx]])
+            self.G, self.C, self.L = [buildMatrix(rows, cols, e, self.size) for e in entries]
+        instrument.count("unknowns", self.size)
+        instrument.count("nonzeros", self.G.nnz)
+        # Fill reducing order of the block matrix of each number of blocks
+        self._orderings = {}
+
+    def solve(self, frequencies, sources=None):
+        """ Phasors of every node, a row per frequency """
+        b = self._rhs(sources)
+        omegas = 2 * np.pi * np.asarray(frequencies, dtype=float)
+        if self.size <= MAX_DENSE_SIZE:
+            X = self._solveDense(omegas, b)
+        else:
+            X = self._solveSparse(omegas, b)
+        # Ground's column is -1 and floating nodes' -2, as in Circuit.solve
+        X = np.hstack((X[:, :self.dim], np.full((len(X), 1), np.nan), np.zeros((len(X), 1))))
+        return X[:, self._sortedCols]
+
+    def _solveDense(self, omegas, b):
+        G, C, L = self.G.toarray(), self.C.toarray(), self.L.toarray()
+        X = np.empty((len(omegas), self.size), dtype=complex)
+        chunk = max(1, STACK_BYTES // (16 * max(self.size, 1) ** 2))
+        for start in xrange(0, len(omegas), chunk):
+            jw = 1j * omegas[start:start + chunk, None, None]
+            A = G[None] + jw * C[None] + L[None] / jw
+            with instrument.phase("substitution"):
+                X[start:start + chunk] = _solveStack(A, b)
+        return X
+
+    def _solveSparse(self, omegas, b):
+        # A chunk of frequencies is solved as one block diagonal matrix with a
+        # block per frequency, so a single factorization covers them all
+        X = np.empty((len(omegas), self.size), dtype=complex)
+        chunk = max(1, min(MAX_BLOCKS, BLOCK_UNKNOWNS // max(self.size, 1)))
+        for start in xrange(0, len(omegas), chunk):
+            jw = 1j * omegas[start:start + chunk]
+            x = self._solveBlocks(jw, b)
+            if x is not None:
+                X[start:start + len(jw)] = x.reshape(len(jw), self.size)
+                continue
+            # Some frequency is singular, solve them one by one to find it
+            for i, w in enumerate(jw, start):
+                x = self._solveBlocks(w[None], b)
+                X[i] = x if x is not None else np.nan
+        return X
+
+    def _solveBlocks(self, jw, b):
+        """ Stacked solutions at each j w, or None if any is singular """
+        count, size, nnz = len(jw), self.size, self.G.nnz
+        offsets = np.arange(count)[:, None]
+        data = self.G.data[None] + jw[:, None] * self.C.data[None] + self.L.data[None] / jw[:, None]
+        indices = self.G.indices[None] + size * offsets
+        indptr = np.append(0, self.G.indptr[1:][None] + nnz * offsets)
+        A = sparse.csc_matrix((data.ravel(), indices.ravel(), indptr),
+                              shape=(count * size, count * size))
+        ordering = self._orderings.setdefault(count, Ordering(self.circuit.ordering))
+        factor = ordering.factor(A)
+        return factor.solve(np.tile(b, count)) if factor is not None else None
+
+    def _rhs(self, sources):
+        b = np.zeros(self.size, dtype=complex)
+        if sources is None:
+            b[self.dim:] = self.circuit._values()[self._sourceIdx]
+            return b
+        for element, amplitude in sources.iteritems():
+            i = self.circuit._elementIndex(element)
+            position = np.searchsorted(self._sourceIdx, i) if i is not None else len(self._sourceIdx)
+            if position >= len(self._sourceIdx) or self._sourceIdx[position] != i:
+                raise ValueError("%s is not a grounded voltage source of the circuit" % element)
+            b[self.dim + position] = amplitude
+        return b
+
+def _stamp(dim, size, gSrc, gDest, parts, vSrc, vDest):
+    """ Triplets of the admittance stamps, with a value array per part. Voltage
+    source rows only go into the first part """
+    branch = np.arange(dim, size)
+    ones, zeros = np.ones(len(branch)), np.zeros(len(branch))
+    rows = np.concatenate([gSrc, gDest, gSrc, gDest, vDest, vSrc, branch, branch])
+    cols = np.concatenate([gSrc, gDest, gDest, gSrc, branch, branch, vDest, vSrc])
+    entries = []
+    for k, y in enumerate(parts):
+        source = [ones, -ones, ones, -ones] if k == 0 else [zeros] * 4
+        entries.append(np.concatenate([y, y, -y, -y] + source))
+    keep = (rows != GROUND) & (cols != GROUND)
+    return rows[keep], cols[keep], [e[keep] for e in entries]
+
+def _solveStack(A, b):
+    """ Solves each system of a stack, NaN where one is singular """
+    try:
+        return np.linalg.solve(A, np.broadcast_to(b[:, None], (len(A), len(b), 1)))[:, :, 0]
+    except np.linalg.LinAlgError:
+        X = np.empty((len(A), len(b)), dtype=complex)
+        for i in range(len(A)):
+            try:
+                X[i] = np.linalg.solve(A[i], b)
+            except np.linalg.LinAlgError:
+                X[i] = np.nan
+        return X
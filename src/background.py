@@ -0,0 +1,80 @@
+""" Solving a circuit in a worker process, so a program with a user interface
+stays responsive while a big circuit solves.
+
+    solver = BackgroundSolver()
+    solver.submit(circuit)
+    ...
+    if solver.poll():       # from the event loop, until it says it's done
+        print circuit.solved
+
+The worker solves a copy of the circuit, and sends back what a SolutionCache
+keeps of the solve. poll() puts it in the circuit's cache and solves the
+circuit, which is then a lookup. The circuit can be edited while it solves:
+the solve is then cancelled, or dropped when it comes back. """
+
+import multiprocessing
+from cache import SolutionCache
+
+class BackgroundSolver(object):
+    """ One solve at a time in a worker process """
+
+    def __init__(self):
+        self.circuit = None
+        self._pool = None
+        self._pending = None
+
+    @property
+    def busy(self):
+        return self._pending is not None
+
+    def submit(self, circuit):
+        """ Starts solving the circuit, cancelling any solve still running """
+        self.cancel()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(1)
+        self.circuit = circuit
+        self._pending = self._pool.apply_async(_solveEntry, (circuit,))
+
+    def cancel(self):
+        """ Drops the solve in progress. Its worker is killed, since there is
+        no stopping a factorization halfway otherwise """
+        if self._pending is not None and not self._pending.ready():
+            self.close()
+        self.circuit = self._pending = None
+
+    def poll(self):
+        """ Finishes the solve if the worker is done with it. Returns True
+        once the circuit is solved (or found unsolvable). A solve of a circuit
+        that was edited since it was submitted is dropped, leaving the
+        circuit as it was, and poll returns False """
+        if self._pending is None or not self._pending.ready():
+            return False
+        circuit, (key, entry) = self.circuit, self._pending.get()
+        self.circuit = self._pending = None
+        if key != circuit.canonicalHash():
+            return False
+        cache = circuit.cache
+        if entry is not None:
+            if cache is None:
+                circuit.cache = SolutionCache(size=1)
+            circuit.cache.put(key, entry)
+        # Without an entry the circuit has no ground, which takes no solving
+        try:
+            circuit.solve()
+        finally:
+            circuit.cache = cache
+        return True
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+def _solveEntry(circuit):
+    """ Worker task: the circuit's hash and the entry a SolutionCache gets
+    from solving it, None if it gets none """
+    circuit.cache = SolutionCache(size=1)
+    circuit.solve()
+    key = circuit.canonicalHash()
+    return key, circuit.cache.entry(key)
@@ -0,0 +1,152 @@
+""" Reading and writing circuits in a binary format made for huge generated
+circuits: a header followed by the circuit's arrays, as CompactCircuit keeps
+them.
+
+    binary.save(circuit, "grid.cbin")
+    circuit = binary.load("grid.cbin")
+
+Loading maps the arrays straight from the file instead of reading them, so it
+takes about as long for ten million elements as for ten, and no object is
+made per element or node. The pages are only read as the solver touches
+them, and processes mapping the same file share them in the page cache. A
+loaded circuit sent to another process by pickling goes as the file name,
+and is mapped again there.
+
+The file holds, in this order and all little endian:
+
+    header          64 bytes, see HEADER
+    coordinates     int64 x, y of each node
+    values          float64 value of each element
+    src, dest       int32 node index of each end of each element
+    kinds           int8 kind code of each element
+
+Nodes must be (x, y) grid locations. """
+
+import mmap
+import numpy as np
+from circuit import REMOVED
+from compact import CompactCircuit, GridLocations
+
+MAGIC = "CIRCBIN\0"
+VERSION = 1
+# ground is the node index of the ground, -1 if there is none
+HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("reserved", "<u4"),
+                   ("nodes", "<i8"), ("elements", "<i8"), ("ground", "<i8"),
+                   ("padding", "S24")])
+
+####################################################
+## Reading
+####################################################
+
+def isBinary(filename):
+    """ Whether the file starts like a circuit in this format """
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load(filename):
+    """ Maps a circuit file into a new CompactCircuit. Its arrays are read-only
+    views of the file until the circuit is edited, which copies them """
+    with open(filename, "rb") as f:
+        header = np.fromfile(f, HEADER, 1)
+    if len(header) != 1 or header["magic"][0] != MAGIC.rstrip("\0"):
+        raise ValueError("%s is not a binary circuit file" % filename)
+    if header["version"][0] != VERSION:
+        raise ValueError("%s has version %d of the format, only %d can be read"
+                         % (filename, header["version"][0], VERSION))
+
+    nodes, elements = int(header["nodes"][0]), int(header["elements"][0])
+    arrays = []
+    for dtype, shape, offset in _layout(nodes, elements):
+        arrays.append(mapArray(filename, dtype, offset, shape))
+    coordinates, values, src, dest, kinds = arrays
+
+    locations = GridLocations(coordinates)
+    circuit = CompactCircuit.fromArrays(locations, kinds, src, dest, values)
+    ground = int(header["ground"][0])
+    if ground >= 0:
+        circuit.addGround(locations[ground])
+    return circuit
+
+def mapArray(filename, dtype, offset, shape):
+    """ Read-only array of the file's bytes at offset """
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return MappedArray(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+class MappedArray(np.memmap):
+    """ Array mapped from a file, which pickles as where it is in the file
+    rather than as its contents """
+
+    def __reduce__(self):
+        # Only an array mapped whole has the file's offset and shape
+        if isinstance(self.base, mmap.mmap):
+            return mapArray, (self.filename, self.dtype.str, self.offset, self.shape)
+        return np.asarray(self).__reduce__()
+
+    # Copies taken from it, and results of arithmetic on it, are ordinary
+    # arrays, as with np.memmap
+
+    def __getitem__(self, index):
+        item = np.memmap.__getitem__(self, index)
+        if isinstance(item, MappedArray) and item._mmap is None:
+            return item.view(np.ndarray)
+        return item
+
+    def __array_wrap__(self, array, context=None):
+        array = np.ndarray.__array_wrap__(self, array, context)
+        if array is self:
+            return array
+        if array.shape == ():
+            return array[()]
+        return array.view(np.ndarray)
+
+####################################################
+## Writing
+####################################################
+
+def save(circuit, filename):
+    """ Writes any circuit whose nodes are all grid locations. Removed
+    elements of a CompactCircuit are left out """
+    locations, kinds, src, dest = circuit._topologyArrays()
+    values = circuit._values()
+    live = np.flatnonzero(kinds != REMOVED)
+    coordinates = _coordinates(locations)
+
+    ground = -1
+    if circuit.ground is not None:
+        if circuit.ground in circuit.nodes:
+            ground = circuit._nodeIndex(circuit.ground)
+        else:
+            # A ground with nothing connected yet is kept as a node of its own
+            ground = len(coordinates)
+            coordinates = np.vstack((coordinates, _coordinates([circuit.ground])))
+
+    header = np.zeros(1, HEADER)
+    header["magic"], header["version"] = MAGIC, VERSION
+    header["nodes"], header["elements"], header["ground"] = len(coordinates), len(live), ground
+    columns = [coordinates, values[live], src[live], dest[live], kinds[live]]
+    with open(filename, "wb") as f:
+        header.tofile(f)
+        for (dtype, shape, offset), column in zip(_layout(len(coordinates), len(live)), columns):
+            np.ascontiguousarray(column, dtype=dtype).tofile(f)
+
+def _coordinates(locations):
+    """ The locations as an n x 2 array of int64 """
+    if isinstance(locations, GridLocations) and not locations._added:
+        return locations.coordinates
+    locations = list(locations)
+    for location in locations:
+        if not isinstance(location, tuple) or len(location) != 2 or \
+           not all(isinstance(c, (int, long)) for c in location):
+            raise ValueError("Node %r isn't a grid location, which the binary format needs"
+                             % (location,))
+    return np.array(locations, dtype=np.int64).reshape(len(locations), 2)
+
+def _layout(nodes, elements):
+    """ (dtype, shape, offset) of each array of a file, in file order """
+    layout, offset = [], HEADER.itemsize
+    for dtype, shape in (("<i8", (nodes, 2)), ("<f8", (elements,)), ("<i4", (elements,)),
+                         ("<i4", (elements,)), ("i1", (elements,))):
+        layout.append((dtype, shape, offset))
+        offset += np.dtype(dtype).itemsize * int(np.prod(shape))
+    return layout
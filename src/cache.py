@@ -0,0 +1,124 @@
+""" Cache of circuit solutions keyed by Circuit.canonicalHash(), so solving a
+circuit that was solved before, by this or any other Circuit, is a lookup.
+
+    circuit.cache = SolutionCache(size=64, directory="~/.circuit-cache")
+
+The cache keeps the most recently used solutions in memory. With a
+directory, solutions are also written there, so later runs and other
+processes sharing the directory find them too. """
+
+import cPickle as pickle
+import os
+import tempfile
+from collections import OrderedDict
+
+# Solutions kept in memory, and files kept in a cache directory
+DEFAULT_SIZE = 128
+DEFAULT_DISK_SIZE = 10000
+
+class SolutionCache(object):
+    """ Bounded LRU map from circuit hashes to solutions """
+
+    def __init__(self, size=DEFAULT_SIZE, directory=None, diskSize=DEFAULT_DISK_SIZE):
+        self.size = size
+        self.directory = None
+        if directory is not None:
+            self.directory = os.path.expanduser(directory)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        self.diskSize = diskSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._writes = 0
+
+    def get(self, key):
+        """ The solution stored under key, or None """
+        entry = self._entries.pop(key, None)
+        if entry is None and self.directory is not None:
+            entry = self._read(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def entry(self, key):
+        """ The solution kept in memory under key, or None. Unlike get it
+        doesn't count a hit or miss, mark the solution as used, or read files """
+        return self._entries.get(key)
+
+    def put(self, key, entry):
+        self._entries.pop(key, None)
+        self._remember(key, entry)
+        if self.directory is not None:
+            self._write(key, entry)
+
+    def clear(self):
+        """ Forgets the solutions in memory. Files in the directory stay """
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    ####################################################
+    ## Files
+    ####################################################
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark it as recently used, for pruning
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def _write(self, key, entry):
+        # Written to a temporary file and renamed, so other processes never
+        # read half a file
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, self._path(key))
+
+        # Listing the directory is slow, so it's only pruned every so often
+        self._writes += 1
+        if self._writes % max(1, self.diskSize // 10) == 0:
+            self._prune()
+
+    def _prune(self):
+        """ Deletes the least recently used files beyond diskSize """
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith(".pickle")]
+        if len(paths) <= self.diskSize:
+            return
+        used = []
+        for path in paths:
+            try:
+                used.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        used.sort()
+        for _, path in used[:len(used) - self.diskSize]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,6 +1,47 @@
 """ Class definitions of circuit components. Also contains solve function. """
 
-from matrix import solveMatrix
+import copy
+import hashlib
+import numpy as np
+import instrument
+from graph import components, supernodes, envelope
+from matrix import buildMatrix, Factorization, StampPattern, conjugateGradient, \
+                   multigrid, Ordering, DEFAULT_ORDERING, MAX_CG_ITERATIONS
+from multiport import MultiPort
+
+# Column given to the ground node, which is fixed at 0 volts, and to nodes
+# with no path to ground, whose voltage is unknown (NaN)
+GROUND = -1
+FLOATING = -2
+# Element kinds as stored in the arrays the equations are built from,
+# in the same order as KINDS. Removed elements are left as holes.
+WIRE, VOLTAGE_SOURCE, RESISTOR, CAPACITOR, INDUCTOR, NONLINEAR, OTHER = range(7)
+REMOVED = -1
+# Most resistor edits applied to a cached factorization before it gets redone
+MAX_UPDATE_RANK = 16
+# Newton iterations for circuits with nonlinear elements: the most tried,
+# and how little the solution may change between the last two, in volts
+# (amps for source currents) plus a fraction of the value
+MAX_ITERATIONS = 100
+ABSOLUTE_TOLERANCE = 1e-9
+RELATIVE_TOLERANCE = 1e-9
+# Conductance put across every nonlinear element, so one that is off doesn't
+# leave a node without a path to ground
+GMIN = 1e-12
+# Diode model: thermal voltage at 300K and the default saturation current
+THERMAL_VOLTAGE = 0.025852
+SATURATION_CURRENT = 1e-14
+# Circuits with at least this many unknowns are solved iteratively when they
+# can be, to the default relative residual
+ITERATIVE_SIZE = 1 << 17
+ITERATIVE_TOLERANCE = 1e-10
+# Left to choose, a circuit is only solved iteratively if the envelope of its
+# n node conductance matrix (see graph.envelope) holds more than this many
+# times n^1.5 entries, which 3-D meshes do and planar ones don't. Planar
+# circuits factor with little fill, and directly is faster. Conjugate
+# gradients are given up on for the direct solver after AUTO_ITERATIONS.
+ITERATIVE_ENVELOPE = 2.0
+AUTO_ITERATIONS = 100
 
 ####################################################
 ## Classes for circuit elements
@@ -8,16 +49,39 @@ from matrix import solveMatrix
 
 # Only one circuit instance is created, holds all the nodes
 
-# TODO: Handle case of creating multiple elements between the same src and dest
-# TODO: Faster lookup/deletion of elements (using dicts)
-
 class Circuit(object):
     def __init__(self):
         self.nodes = dict()
-        self.elements = []
+        # Every element, plus an index of them by kind and a list of them per
+        # pair of locations they connect. Elements are kept by identity, so
+        # parallel elements with the same value can coexist.
+        self.elements = ElementSet()
+        self._byKind = dict((kind, ElementSet()) for kind in KINDS)
+        self._between = dict()
+        self._reset()
+
+    def _reset(self):
+        """ Sets up the state every circuit has, however it stores its elements """
         self.ground = None
         self.unsolvable = False
         self.solved = False
+        # Parts of the circuit with no path to ground, as lists of locations
+        self.floating = []
+        # Optional SolutionCache, consulted by solve()
+        self.cache = None
+        # Optional SpatialIndex, kept up to date with the elements by id
+        self.spatial = None
+        # Current from src to dest through each element and the power it
+        # dissipates, in elementsInOrder() order. None until solved.
+        self.currents = None
+        self.powers = None
+        # Whether to solve iteratively: None to decide by size and shape, True
+        # whenever the circuit can be, False never. See _usesIterative
+        self.iterative = None
+        self.tolerance = ITERATIVE_TOLERANCE
+        # Fill reducing ordering of the matrix, one of matrix.ORDERINGS
+        self.ordering = DEFAULT_ORDERING
+        self._invalidate()
 
     def addElement(self, element):
         """ Create and add an element to the circuit """
@@ -27,30 +91,71 @@ class Circuit(object):
         if dest not in self.nodes:
             self.nodes[dest] = Node(dest)
         self.nodes[src].addElement(element)
-        self.nodes[dest].addElement(element.inverse())
-        self.elements.append(element)
+        self.nodes[dest].addElement(element.inverse(), element)
+        self.elements.add(element)
+        self._byKind[kindOf(element)].add(element)
+        self._between.setdefault(pairKey(src, dest), []).append(element)
+        if self.spatial is not None:
+            self.spatial.add(self._spatialKey(element), element)
+        self._invalidate()
+
+    def _spatialKey(self, element):
+        """ What the spatial index knows the element by """
+        return id(element)
 
     def removeElement(self, element):
+        """ Remove an element from the circuit. If that exact element isn't in the
+        circuit, an equal one between the same locations is removed instead """
+        if element not in self.elements:
+            equal = [e for e in self.elementsBetween(element.src, element.dest) if e == element]
+            if not equal:
+                raise ValueError("%s is not in the circuit" % element)
+            element = equal[0]
+
         src, dest = element.src, element.dest
-        print src, dest
-        assert(src in self.nodes)
-        assert(dest in self.nodes)
-        print "src: ", self.nodes[src].elements
-        print "dest: ", self.nodes[dest].elements
-        self.nodes[src].elements.remove(element)
-        self.nodes[dest].elements.remove(element.inverse())
+        for loc in (src, dest):
+            node = self.nodes[loc]
+            if element in node.elements:
+                node.removeElement(element)
+            # Nodes only exist to connect elements
+            if not node.elements:
+                del self.nodes[loc]
+        self.elements.remove(element)
+        self._byKind[kindOf(element)].remove(element)
+        # Only a handful of elements share a pair, so a scan by identity is fine
+        between = self._between[pairKey(src, dest)]
+        between[:] = [e for e in between if e is not element]
+        if not between:
+            del self._between[pairKey(src, dest)]
+        if self.spatial is not None:
+            self.spatial.remove(self._spatialKey(element))
+        self._invalidate()
+
+    def elementsBetween(self, a, b):
+        """ Every element connecting locations a and b, in either direction """
+        return list(self._between.get(pairKey(a, b), ()))
 
     def voltageSources(self):
-        return filter(lambda x: isinstance(x, VoltageSource) and x.voltage, self.elements) 
+        return [e for e in self._byKind[VoltageSource] if e.voltage]
 
     def resistors(self):
-        return filter(lambda x: isinstance(x, Resistor), self.elements) 
+        return list(self._byKind[Resistor])
 
     def wires(self):
-        return filter(lambda x: isinstance(x, Wire), self.elements) 
+        return list(self._byKind[Wire])
+
+    def capacitors(self):
+        return list(self._byKind[Capacitor])
+
+    def inductors(self):
+        return list(self._byKind[Inductor])
+
+    def nonlinearElements(self):
+        return list(self._byKind[Nonlinear])
 
     def addGround(self,location):
         self.ground = location
+        self._invalidate()
 
     def __str__(self):
         elementStr = "\n".join(["\n".join(map(str,v.elements)) \
@@ -62,94 +167,1000 @@ class Circuit(object):
     ####################################################
 
     def solve(self):
+        trace = instrument.begin("solve")
+        try:
+            self._solve()
+            instrument.count("solved", self.solved)
+        finally:
+            instrument.end(trace)
+
+    def _solve(self):
         self.unsolvable = False
         self.solved = False
 
-        # A circuit with no voltage sources is unsolvable
-        if not self.voltageSources():
+        # A circuit without a ground to measure the voltages from is unsolvable
+        if self.ground not in self.nodes:
             self.unsolvable = True
             return
-        print self 
-        # Map each node location to a variable in the system of equations (column in the matrix)
-        self.nodeToCol = dict((k, i) for i, (k,_) in enumerate(self.nodes.iteritems()))
-        self.dim = len(self.nodes)
+        # Node columns and element arrays only change with the topology,
+        # so they are rebuilt only after the circuit was edited
+        if self._nodeCols is None:
+            with instrument.phase("indexing"):
+                self._indexNodes()
+
+        # A circuit solved before, here or by another circuit, is looked up
+        key = None
+        if self.cache is not None:
+            key, order, turned = self._canonicalKey()
+            if self._restore(self.cache.get(key), order, turned):
+                instrument.count("cacheHit", True)
+                return
+
+        voltages = self._solveVoltages()
+        self.unsolvable = voltages is None
+        self.solved = not self.unsolvable
+        if self.unsolvable:
+            self._storeCurrents(None, None)
+        if key is not None:
+            self.cache.put(key, self._entry(voltages, order, turned))
 
-        solution = solveMatrix(self._createEquations())
+    def _solveVoltages(self):
+        """ Node voltages in _arrays() order, or None if the circuit is unsolvable """
+        # So is a circuit with no voltage sources
+        if not np.any(self._voltages()):
+            return None
+
+        solution = self._solveSystem()
         if solution is None:
-            self.unsolvable = True
+            return None
+
+        # Ground's column is -1, which picks up the 0 volts appended at the end,
+        # and floating nodes get the NaN before it
+        voltages = np.append(solution[:self.dim], (np.nan, 0.0))[self._nodeCols]
+        self._storeVoltages(voltages)
+        with instrument.phase("currents"):
+            self._storeCurrents(self._branchCurrents(solution, voltages), voltages)
+        return voltages
+
+    def __getstate__(self):
+        # The LU factors can't be pickled, and are cheap to redo compared to sending them.
+        # Element positions are keyed by id, which changes, so __setstate__ redoes them.
+        # A cache is shared with other circuits, so it isn't sent along either,
+        # and a spatial index is keyed by element ids too.
+        state = self.__dict__.copy()
+        state['_factor'] = None
+        state['_canonical'] = state['cache'] = state['spatial'] = None
+        state.pop('_position', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for node in self.nodes.itervalues():
+            node.elements = ElementSet()
+        for element in self.elements:
+            self.nodes[element.src].addElement(element)
+            self.nodes[element.dest].addElement(element.inverse(), element)
+        if '_elementList' in state:
+            self._position = dict((id(e), i) for i, e in enumerate(self._elementList))
+
+    def _invalidate(self):
+        """ Drops everything cached from the last solve. Called on topology changes """
+        self._nodeCols = None
+        self._factor = None
+        self._topology = None
+        self._canonical = None
+        self._jacobian = None
+        self._guess = None
+        self._reduced = None
+        self._ordering = None
+        self._directOnly = False
+
+    # Solves the system using the factorization from an earlier solve when possible.
+    # New source voltages only change the right hand side, and a few changed
+    # resistances are applied to the old factors as a low-rank update.
+    # Anything more gets a fresh factorization.
+    def _solveSystem(self):
+        conductance = self._conductances()
+        b = self._rhs()
+        if len(self._nonlinearIdx):
+            return self._solveNewton(conductance, b)
+        if self._usesIterative(conductance):
+            x = self._solveIterative(conductance, b)
+            if x is not None or self.iterative:
+                return x
+            # Picked automatically but too slow to converge
+            self._directOnly = True
+
+        if self._factor is not None:
+            changed = np.flatnonzero(conductance != self._baseConductance)
+            if len(changed) <= MAX_UPDATE_RANK:
+                instrument.count("updateRank", len(changed))
+                U = self._incidence(changed)
+                delta = conductance[changed] - self._baseConductance[changed]
+                solution = self._factor.solve(b, U, delta)
+                if solution is not None:
+                    return solution
+
+        factor = self._currentFactor()
+        if factor is None:
+            return None
+        return factor.solve(b)
+
+    def _currentFactor(self):
+        """ Factorization of the system with the current element values, or None if singular """
+        conductance = self._conductances()
+        if self._factor is None or np.any(conductance != self._baseConductance):
+            self._factor = self._factorSystem(conductance)
+            self._baseConductance = conductance
+        return self._factor
+
+    def _factorSystem(self, conductance):
+        """ Factors the system with the given resistor conductances. The fill
+        reducing order only depends on the topology, so the first
+        factorization after an edit works it out and the rest reuse it """
+        if self._ordering is None or self._ordering.method != self.ordering:
+            self._ordering = Ordering(self.ordering)
+        return self._ordering.factor(self._createEquations(conductance)[0])
+
+    ####################################################
+    ## Parameter sweeps
+    ####################################################
+
+    def sweep(self, element, values):
+        """ Solves the circuit for each value of one resistance or source voltage.
+
+        Returns an array with a row per value and a column per node, in
+        sorted(self.nodes) order, or None if the circuit can't be solved. """
+        return self.sweepGrid([(element, values)])
+
+    def sweepGrid(self, params):
+        """ Solves the circuit for every combination of several element values.
+
+        params is a list of (element, values) pairs, each element a Resistor or
+        VoltageSource in the circuit. Returns an array of shape
+        (len(values1), ..., len(valuesK), number of nodes), or None if the
+        circuit can't be solved. The other elements keep their current values. """
+        trace = instrument.begin("sweep")
+        try:
+            return self._sweepGrid(params)
+        finally:
+            instrument.end(trace)
+
+    def _sweepGrid(self, params):
+        factor = self._batchFactor()
+        if factor is None:
+            return None
+
+        # Every combination of values, one row per point
+        shape = tuple(len(values) for _, values in params)
+        grid = np.meshgrid(*[np.asarray(v, dtype=float) for _, v in params], indexing='ij')
+        points = [g.ravel() for g in grid]
+
+        resistors, resistances, sources, voltages = [], [], [], []
+        for (element, _), values in zip(params, points):
+            kind, index = self._parameter(element)
+            if kind is Resistor:
+                resistors.append(index)
+                resistances.append(values)
+            else:
+                sources.append(index)
+                voltages.append(values)
+        count = np.prod(shape)
+        instrument.count("points", int(count))
+        resistances = np.array(resistances).reshape(len(resistors), count).T
+        voltages = np.array(voltages).reshape(len(sources), count).T
+
+        solutions = self._solvePoints(factor, resistors, resistances, sources, voltages)
+        return solutions.reshape(shape + (len(self._sortedCols),))
+
+    def _batchFactor(self):
+        """ Indexes the circuit and factors it with its current values, ready for
+        _solvePoints. A circuit with nonlinear elements gets the Jacobian pattern
+        its Newton solves share instead. Returns None if the circuit can't be solved """
+        if self.ground not in self.nodes:
+            return None
+        if self._nodeCols is None:
+            with instrument.phase("indexing"):
+                self._indexNodes()
+        if len(self._nonlinearIdx):
+            return self._jacobianPattern()
+        return self._currentFactor()
+
+    # Solves the system for a batch of points, each giving new values to some
+    # resistors and sources (one row of resistances/voltages per point).
+    # Returns the node voltages of each point as a row, in sorted(self.nodes) order.
+    # Points whose system is singular are all NaN.
+    def _solvePoints(self, factor, resistors, resistances, sources, voltages):
+        sources, resistors = np.array(sources, dtype=int), np.array(resistors, dtype=int)
+        if len(resistors) <= MAX_UPDATE_RANK and not len(self._nonlinearIdx):
+            # Source voltages only change the right hand side of each point,
+            # resistances are applied to the factorization as a low-rank update
+            currentVoltages = self._voltages()[sources]
+            E = self._selector(self.dim + sources)
+            U = self._incidence(resistors)
+            D = 1.0/resistances - self._baseConductance[resistors]
+            X = factor.solveBatch(self._rhs(), E, voltages - currentVoltages, U, D)
+        else:
+            # Too many changes for an update to pay off, factor each point. A
+            # nonlinear circuit is a Newton solve per point, each starting
+            # from the solution of the point before.
+            X = np.empty((self.size, len(resistances)))
+            conductance, b = self._conductances(), self._rhs()
+            for i in range(len(resistances)):
+                conductance[resistors] = 1.0/resistances[i]
+                b[self.dim + sources] = voltages[i]
+                if len(self._nonlinearIdx):
+                    x = self._solveNewton(conductance, b)
+                else:
+                    pointFactor = self._factorSystem(conductance)
+                    x = pointFactor.solve(b) if pointFactor is not None else None
+                X[:, i] = x if x is not None else np.nan
+
+        X = np.vstack((X[:self.dim], np.full(X.shape[1], np.nan), np.zeros(X.shape[1])))
+        return X[self._sortedCols].T
+
+    def _parameter(self, element):
+        """ Returns (Resistor, index) or (VoltageSource, index) of an element in the system """
+        i = self._elementIndex(element)
+        for kind, indices in ((Resistor, self._resistorIdx), (VoltageSource, self._sourceIdx)):
+            position = np.searchsorted(indices, i) if i is not None else len(indices)
+            if position < len(indices) and indices[position] == i:
+                return kind, position
+        raise ValueError("%s is not a grounded resistor or voltage source of the circuit" % element)
+
+    # Maps each node to a variable in the system of equations (column in the matrix).
+    # Nodes joined by wires are the same electrical node, so they are merged
+    # into one supernode first and share a column. At DC an inductor is a
+    # wire too, and a capacitor is an open circuit.
+    #
+    # Only the part of the circuit connected to ground is solved. Every other
+    # connected part is floating: its voltages are only known relative to each
+    # other, so its nodes are left out of the system and read as NaN, and the
+    # rest of the circuit still solves.
+    def _indexNodes(self):
+        locations, kinds, src, dest = self._topologyArrays()
+        shorts = (kinds == WIRE) | (kinds == INDUCTOR)
+        links = (kinds != REMOVED) & (kinds != CAPACITOR)
+        self._nodeCols, grounded, self.floating = self._columns(shorts, links)
+        self.dim = self._nodeCols.max() + 1
+
+        # Results are reported in sorted location order
+        self._sortedCols = self._nodeCols[self._locationOrder()]
+
+        # Wires were merged away, every other source gets a current variable.
+        # Elements of floating parts aren't in the system at all.
+        inSystem = grounded[src]
+        self._resistorIdx = np.flatnonzero((kinds == RESISTOR) & inSystem)
+        self._sourceIdx = np.flatnonzero((kinds == VOLTAGE_SOURCE) & inSystem)
+        self._rSrc = self._nodeCols[src[self._resistorIdx]]
+        self._rDest = self._nodeCols[dest[self._resistorIdx]]
+        self._vSrc = self._nodeCols[src[self._sourceIdx]]
+        self._vDest = self._nodeCols[dest[self._sourceIdx]]
+        self.size = self.dim + len(self._sourceIdx)
+
+        # Nonlinear elements are evaluated a class at a time
+        self._nonlinearIdx = np.flatnonzero((kinds == NONLINEAR) & inSystem)
+        self._nSrc = self._nodeCols[src[self._nonlinearIdx]]
+        self._nDest = self._nodeCols[dest[self._nonlinearIdx]]
+        classes = self._nonlinearClasses(self._nonlinearIdx)
+        self._nonlinearGroups = [(cls, np.array([i for i, c in enumerate(classes) if c is cls], dtype=int))
+                                 for cls in set(classes)]
+
+    def _columns(self, shorts, links):
+        """ Column of each node when the elements in the mask shorts join their
+        ends into supernodes and the elements in links conduct. Returns the
+        columns, a mask of the grounded nodes and the floating parts' locations """
+        locations, kinds, src, dest = self._topologyArrays()
+        labels = supernodes(len(locations), src[shorts], dest[shorts])
+        parts = components(len(locations), src[links], dest[links])
+
+        # Ground is fixed at 0 volts, so its supernode doesn't get a column.
+        # Neither do nodes with nothing connected, which are left at 0 volts.
+        ground = self._nodeIndex(self.ground)
+        live = kinds != REMOVED
+        used = np.zeros(len(locations), dtype=bool)
+        used[src[live]] = used[dest[live]] = True
+        grounded = parts == parts[ground]
+        floating = used & ~grounded
+        labels[~grounded] = labels[ground]
+        cols = np.unique(labels, return_inverse=True)[1]
+        groundCol = cols[ground]
+        cols = np.where(cols == groundCol, GROUND, cols - (cols > groundCol))
+        cols[floating] = FLOATING
+
+        # Each floating part, listed by its locations
+        islands = np.flatnonzero(floating)
+        order = np.argsort(parts[islands], kind="mergesort")
+        groups = np.split(islands[order], np.flatnonzero(np.diff(parts[islands][order])) + 1)
+        return cols, grounded, [sorted(locations[i] for i in group) for group in groups if len(group)]
+
+    # Stamps every element into a sparse modified nodal analysis system Ax = b.
+    # The unknowns are the voltage at each non-ground node, followed by the
+    # current through each voltage source.
+    def _createEquations(self, conductance=None):
+        if conductance is None:
+            conductance = self._conductances()
+        with instrument.phase("assembly"):
+            A = stampSystem(self.size, self.dim, self._rSrc, self._rDest, conductance,
+                            self._vSrc, self._vDest)
+        instrument.count("unknowns", self.size)
+        instrument.count("nonzeros", A.nnz)
+        return A, self._rhs()
+
+    def _conductances(self):
+        return 1.0/self._resistances()
+
+    def _rhs(self):
+        b = np.zeros(self.size)
+        b[self.dim:] = self._voltages()
+        return b
+
+    def _selector(self, rows):
+        """ Sparse matrix with a unit column for each given row of the system """
+        which = np.arange(len(rows))
+        return buildMatrix(rows, which, np.ones(len(rows)), self.size, len(rows))
+
+    def _incidence(self, resistors):
+        """ Sparse matrix with a src - dest column for each given resistor index """
+        src, dest = self._rSrc[resistors], self._rDest[resistors]
+        which = np.arange(len(resistors))
+        rows, cols = np.concatenate((src, dest)), np.concatenate((which, which))
+        vals = np.concatenate((np.ones(len(src)), -np.ones(len(dest))))
+        keep = rows != GROUND
+        return buildMatrix(rows[keep], cols[keep], vals[keep], self.size, len(resistors))
+
+    ####################################################
+    ## Multi-port reduction
+    ####################################################
+
+    def reduce(self, ports):
+        """ The circuit at DC as seen from ports, a list of node locations,
+        with every other node eliminated and the ground as the reference.
+        Returns a MultiPort.
+
+        Raises ValueError if a port has no path to ground or is the ground,
+        wires join two ports, the circuit has nonlinear elements, it can't be
+        solved or no network of resistors and sources behaves like it, which
+        addMultiPort needs """
+        trace = instrument.begin("reduce")
+        try:
+            return self._reduce(list(ports))
+        finally:
+            instrument.end(trace)
+
+    # With currents i flowing in at the ports, the system is
+    #
+    #   [ A_pp  A_pq ] [ v ]   [ b_p + i ]
+    #   [ A_qp  A_qq ] [ x ] = [ b_q     ]
+    #
+    # where v are the port voltages and x every other unknown: the voltages
+    # of the inner nodes and the source currents. Eliminating x leaves the
+    # Schur complement of A_qq,
+    #
+    #   (A_pp - A_pq A_qq^-1 A_qp) v = b_p - A_pq A_qq^-1 b_q + i
+    #
+    # which is the Norton form, for one sparse factorization of A_qq and a
+    # solve per port. Sources holding the ports' voltages make A_qq singular,
+    # and those circuits get the Thevenin form instead: the port voltages
+    # when a unit current flows in at each port in turn.
+    def _reduce(self, ports):
+        if not ports:
+            raise ValueError("A reduced circuit needs at least one port")
+        if self.ground not in self.nodes:
+            raise ValueError("The circuit has no ground to measure the ports from")
+        if self._nodeCols is None:
+            with instrument.phase("indexing"):
+                self._indexNodes()
+        if len(self._nonlinearIdx):
+            raise ValueError("Circuits with nonlinear elements can't be reduced")
+        p = np.array([self._portColumn(port) for port in ports], dtype=int)
+        if len(np.unique(p)) < len(p):
+            raise ValueError("Wires join some of the ports %s" % (ports,))
+        instrument.count("ports", len(p))
+
+        A, b = self._createEquations()
+        A = A.tocsr()
+        inner = np.ones(self.size, dtype=bool)
+        inner[p] = False
+        q = np.flatnonzero(inner)
+        portRows, innerRows = A[p], A[q]
+        X = np.zeros((0, len(p) + 1))
+        if len(q):
+            factor = Ordering(self.ordering).factor(innerRows[:, q].tocsc())
+            X = factor.solve(np.column_stack((innerRows[:, p].toarray(), b[q]))) \
+                if factor is not None else None
+        if X is not None:
+            coupling = portRows[:, q]
+            admittance = portRows[:, p].toarray() - coupling.dot(X[:, :-1])
+            currents = b[p] - coupling.dot(X[:, -1])
+            model = MultiPort(ports, self.ground, admittance=admittance, shortCurrents=currents)
+        else:
+            factor = Ordering(self.ordering).factor(A.tocsc())
+            X = factor.solve(np.column_stack((self._selector(p).toarray(), b))) \
+                if factor is not None else None
+            if X is None:
+                raise ValueError("The circuit can't be solved")
+            model = MultiPort(ports, self.ground, impedance=X[p, :-1], openVoltages=X[p, -1])
+        # Models addMultiPort couldn't add are turned down here, where the
+        # circuit they came from is at hand
+        model.network()
+        return model
+
+    def _portColumn(self, port):
+        """ Column of a port's node in the system """
+        if port not in self.nodes:
+            raise ValueError("%s is not a node of the circuit" % (port,))
+        col = self._nodeCols[self._nodeIndex(port)]
+        if col == GROUND:
+            raise ValueError("Port %s is the ground, which is the reference of every port" % (port,))
+        if col == FLOATING:
+            raise ValueError("Port %s has no path to ground" % (port,))
+        return col
+
+    def addMultiPort(self, model, terminals, reference, name):
+        """ Adds resistors and voltage sources behaving like model, a
+        MultiPort, with its ports at terminals, a location each, and its
+        reference at the location reference. A port with a source in series
+        gets a node of its own behind it, (name, k) for port k, so name must
+        be new to the circuit. Ports the model holds at a voltage get a source
+        from the reference or the port they're held to. Returns the elements
+        added """
+        elements = self._multiPortElements(model, terminals, reference, name)
+        for element in elements:
+            self.addElement(element)
+        return elements
+
+    def _multiPortElements(self, model, terminals, reference, name):
+        if len(terminals) != len(model):
+            raise ValueError("%s has %d ports, not %d" % (model, len(model), len(terminals)))
+        resistors, sources = model.network()
+        # Nodes of the network: the terminals, the nodes behind them and,
+        # last, the reference
+        nodes = list(terminals) + [(name, k) for k in xrange(len(terminals))] + [reference]
+        elements = [VoltageSource(nodes[a], nodes[b], voltage) for a, b, voltage in sources]
+        elements.extend(Resistor(nodes[a], nodes[b], resistance) for a, b, resistance in resistors)
+        return elements
+
+    ####################################################
+    ## Sensitivities
+    ####################################################
+
+    def sensitivity(self, outputs):
+        """ Derivatives of the voltage at each of outputs, a list of node
+        locations, with respect to the value of every element: the resistance
+        of each resistor, the voltage of each voltage source and the value of
+        each nonlinear element, a diode's saturation current. Capacitances and
+        inductances don't enter the DC solution, and get 0.
+
+        Solves the circuit, then takes one adjoint solve per output with the
+        factorization the solve left. Returns an array with a row per output
+        and a column per element in elementsInOrder() order, or None if the
+        circuit can't be solved. Outputs with no path to ground get rows of
+        NaN, and removed elements columns of NaN """
+        trace = instrument.begin("sensitivity")
+        try:
+            return self._sensitivity(list(outputs))
+        finally:
+            instrument.end(trace)
+
+    # With x the solution of Ax = b and an output c^T x, the adjoint solve
+    # A^T y = c gives the output's derivative with respect to any parameter p
+    # as y^T (db/dp - dA/dp x). A source's voltage is its entry of b, so its
+    # derivative is its entry of y. A resistor adds g u u^T to A, with u the
+    # difference of its ends' columns, so its derivative is -(u^T y)(u^T x)
+    # by g, and (u^T y)(u^T x) / R^2 by R. A circuit with nonlinear elements
+    # gets the same from the Jacobian at its solution, and a nonlinear
+    # element, whose current i adds to the KCL rows like a resistor's, has a
+    # derivative of -(u^T y) di/dp by its value p.
+    def _sensitivity(self, outputs):
+        for output in outputs:
+            if output not in self.nodes:
+                raise ValueError("%s is not a node of the circuit" % (output,))
+        self._solve()
+        if not self.solved:
+            return None
+        locations, kinds, src, dest = self._topologyArrays()
+        cols = self._nodeCols[[self._nodeIndex(output) for output in outputs]]
+        instrument.count("outputs", len(outputs))
+
+        voltages = self._previousVoltages()
+        resistors = self._resistorIdx
+        across = voltages[src[resistors]] - voltages[dest[resistors]]
+        scale = across / self._values()[resistors] ** 2
+        nonlinear = self._nonlinearIdx
+        valueSlope = self._valueSlope(voltages[src[nonlinear]] - voltages[dest[nonlinear]],
+                                      self._values()[nonlinear])
+        gradient = np.zeros((len(outputs), len(kinds)))
+        gradient[:, kinds == REMOVED] = np.nan
+        gradient[cols == FLOATING] = np.nan
+
+        solve = self._adjointSolver(voltages)
+        for row in np.flatnonzero(cols >= 0):
+            c = np.zeros(self.size)
+            c[cols[row]] = 1.0
+            y = solve(c)
+            if y is None:
+                return None
+            # Ground's column is -1, which picks up the 0 appended at the end
+            adjoint = np.append(y[:self.dim], 0.0)
+            gradient[row, resistors] = (adjoint[self._rSrc] - adjoint[self._rDest]) * scale
+            gradient[row, self._sourceIdx] = y[self.dim:]
+            if len(nonlinear):
+                gradient[row, nonlinear] = -(adjoint[self._nSrc] - adjoint[self._nDest]) * valueSlope
+        return gradient
+
+    def _adjointSolver(self, voltages):
+        """ Function solving A^T y = c for the system of the last solve, given
+        its node voltages, or returning None if the system is singular """
+        conductance = self._conductances()
+        if len(self._nonlinearIdx):
+            locations, kinds, src, dest = self._topologyArrays()
+            n = self._nonlinearIdx
+            slope = self._evaluate(voltages[src[n]] - voltages[dest[n]], self._values()[n])[1]
+            A = stampSystem(self.size, self.dim, np.concatenate((self._rSrc, self._nSrc)),
+                            np.concatenate((self._rDest, self._nDest)),
+                            np.concatenate((conductance, slope + GMIN)), self._vSrc, self._vDest)
+            factor = Ordering(self.ordering).factor(A)
+            return lambda c: factor.solve(c, transpose=True) if factor is not None else None
+        if self._usesIterative(conductance):
+            return lambda c: self._adjointIterative(conductance, c)
+
+        if self._factor is not None:
+            changed = np.flatnonzero(conductance != self._baseConductance)
+            if len(changed) <= MAX_UPDATE_RANK:
+                U = self._incidence(changed)
+                delta = conductance[changed] - self._baseConductance[changed]
+                return lambda c: self._factor.solve(c, U, delta, transpose=True)
+        factor = self._currentFactor()
+        return lambda c: factor.solve(c, transpose=True) if factor is not None else None
+
+    def _adjointIterative(self, conductance, c):
+        """ A^T y = c for a circuit solved iteratively. The system is
+        symmetric, so y is the solution with every source shorted and the
+        current c injected at the nodes """
+        src, dest = self._vSrc, self._vDest
+        fixed = np.where(src == GROUND, dest, src)
+        reduced = self._reducedSystem(conductance, fixed)
+        if reduced is None:
+            return None
+        G, free, inner, grid = reduced
+        y = np.zeros(self.dim)
+        v = conjugateGradient(inner, c[:self.dim][free], None, self.tolerance, grid.solve)
+        if v is None:
+            return None
+        y[free] = v
+        # Each source's row of the fixed node's KCL balances what the resistors leave over
+        residual = c[:self.dim][fixed] - G.dot(y)[fixed]
+        return np.concatenate((y, np.where(src == GROUND, residual, -residual)))
+
+    ####################################################
+    ## Iterative solution
+    ####################################################
+
+    # When every voltage source has an end on ground, each fixes the voltage
+    # of its other end, and the voltages of the remaining nodes only depend on
+    # the conductance matrix between them. Of a circuit of resistors, that is
+    # symmetric positive definite, so conjugate gradients solve it, with
+    # multigrid as the preconditioner. Everything it keeps grows linearly
+    # with the circuit, where the LU factors of a big mesh fill in far more.
+    # Meshes whose multigrid levels would fill in too (see matrix.Multigrid)
+    # are solved directly after all, and so are planar ones and those that
+    # converge slowly when the choice is left to the circuit.
+    def _usesIterative(self, conductance):
+        if self.iterative is False or len(self._nonlinearIdx) or self._directOnly:
+            return False
+        if self.iterative is None and self.size < ITERATIVE_SIZE:
+            return False
+        src, dest = self._vSrc, self._vDest
+        if np.any((src == GROUND) == (dest == GROUND)) or np.any(conductance <= 0):
+            return False
+        # Two sources fixing the same node would clash
+        fixed = np.where(src == GROUND, dest, src)
+        if len(np.unique(fixed)) != len(fixed):
+            return False
+        return self._reducedSystem(conductance, fixed) is not None
+
+    def _solveIterative(self, conductance, b):
+        """ Solution of the system, source currents included, or None if it
+        is singular or conjugate gradients don't converge. Starts from the node voltages of
+        the last solve """
+        src, dest = self._vSrc, self._vDest
+        fixed = np.where(src == GROUND, dest, src)
+        reduced = self._reducedSystem(conductance, fixed)
+        if reduced is None:
+            return None
+        G, free, inner, grid = reduced
+
+        # The voltage of a source's dest is its voltage above src
+        voltages = np.zeros(self.dim)
+        voltages[fixed] = np.where(src == GROUND, b[self.dim:], -b[self.dim:])
+        guess = np.zeros(self.dim)
+        last = self._previousVoltages()
+        known = (self._nodeCols >= 0) & np.isfinite(last)
+        guess[self._nodeCols[known]] = last[known]
+
+        limit = AUTO_ITERATIONS if self.iterative is None else MAX_CG_ITERATIONS
+        v = conjugateGradient(inner, -G.dot(voltages)[free], guess[free], self.tolerance,
+                              grid.solve, limit)
+        if v is None:
+            return None
+        voltages[free] = v
+        # Each source carries whatever current leaves its fixed node through resistors
+        leaving = G.dot(voltages)[fixed]
+        return np.concatenate((voltages, np.where(src == GROUND, -leaving, leaving)))
+
+    def _reducedSystem(self, conductance, fixed):
+        """ (conductance matrix of the nodes, mask of the nodes not fixed by a
+        source, conductance matrix between those, its multigrid), kept until
+        the topology or a resistance changes. None if it has no multigrid, or
+        the choice is left to the circuit and it is planar, in which case it
+        is solved directly until its topology changes """
+        if self._reduced is None or np.any(conductance != self._reduced[0]):
+            with instrument.phase("assembly"):
+                G = stampSystem(self.dim, self.dim, self._rSrc, self._rDest, conductance,
+                                np.empty(0, dtype=int), np.empty(0, dtype=int)).tocsr()
+                free = np.ones(self.dim, dtype=bool)
+                free[fixed] = False
+                inner = G[free][:, free]
+            instrument.count("unknowns", inner.shape[0])
+            instrument.count("nonzeros", inner.nnz)
+            if self.iterative is None and \
+               envelope(inner) <= ITERATIVE_ENVELOPE * inner.shape[0] ** 1.5:
+                self._directOnly = True
+                return None
+            grid = multigrid(inner)
+            if grid is None:
+                self._directOnly = True
+                return None
+            self._reduced = (conductance, (G, free, inner, grid))
+        return self._reduced[1]
+
+    def _previousVoltages(self):
+        """ Voltage of each node from the last solve, in _arrays() order """
+        return np.array([node.voltage for node in self._nodeList], dtype=float)
+
+    ####################################################
+    ## Nonlinear elements
+    ####################################################
+
+    # A circuit with nonlinear elements is solved by Newton-Raphson. Each
+    # iteration replaces every nonlinear element by its tangent at the current
+    # guess, a conductance in parallel with a current source, and solves the
+    # resulting linear system for the next guess. The matrix only changes in
+    # the conductances, so the pattern and ordering are worked out once.
+    def _solveNewton(self, conductance, b):
+        """ Solution of the system with the given resistor conductances and
+        right hand side, or None if it is singular or Newton doesn't converge """
+        pattern = self._jacobianPattern()
+        values = self._values()[self._nonlinearIdx]
+        gSrc = np.concatenate((self._rSrc, self._nSrc))
+        gDest = np.concatenate((self._rDest, self._nDest))
+
+        # Start from the last solution, so repeated solves during a sweep or
+        # after an edit only take a few iterations
+        v = self._guess if self._guess is not None else self._initial(values)
+        last = None
+        for iteration in xrange(MAX_ITERATIONS):
+            current, slope = self._evaluate(v, values)
+            slope += GMIN
+            vals = stampTriplets(self.size, self.dim, gSrc, gDest, np.concatenate((conductance, slope)),
+                                 self._vSrc, self._vDest)[2]
+            # Whatever of the current the conductance doesn't carry flows from
+            # src to dest through a source
+            offset = current - (slope - GMIN) * v
+            rhs = b.copy()
+            for nodes, sign in ((self._nSrc, -1.0), (self._nDest, 1.0)):
+                keep = nodes != GROUND
+                rhs[:self.dim] += sign * np.bincount(nodes[keep], offset[keep], self.dim)
+            x = pattern.solve(vals, rhs)
+            if x is None:
+                return None
+
+            nodeVoltages = np.append(x[:self.dim], 0.0)
+            new = nodeVoltages[self._nSrc] - nodeVoltages[self._nDest]
+            limited = self._limit(new, v, values)
+            converged = last is not None and np.all(limited == new) and \
+                np.all(np.abs(x - last) <= ABSOLUTE_TOLERANCE + RELATIVE_TOLERANCE * np.abs(x))
+            v, last = limited, x
+            if converged:
+                instrument.count("iterations", iteration + 1)
+                self._guess = v
+                return x
+        instrument.add("diverged")
+        return None
+
+    def _jacobianPattern(self):
+        """ StampPattern of the Newton matrix, kept until the topology changes """
+        if self._jacobian is None or self._jacobian.ordering.method != self.ordering:
+            rows, cols, _ = stampTriplets(self.size, self.dim,
+                                          np.concatenate((self._rSrc, self._nSrc)),
+                                          np.concatenate((self._rDest, self._nDest)),
+                                          np.ones(len(self._rSrc) + len(self._nSrc)),
+                                          self._vSrc, self._vDest)
+            self._jacobian = StampPattern(rows, cols, self.size, self.ordering)
+        return self._jacobian
+
+    def _evaluate(self, voltage, values):
+        """ Current through each nonlinear element and its derivative """
+        current, slope = np.empty(len(voltage)), np.empty(len(voltage))
+        for cls, which in self._nonlinearGroups:
+            current[which], slope[which] = cls.evaluate(voltage[which], values[which])
+        return current, slope
+
+    def _valueSlope(self, voltage, values):
+        """ Derivative of each nonlinear element's current by its value """
+        slope = np.empty(len(voltage))
+        for cls, which in self._nonlinearGroups:
+            slope[which] = cls.valueSlope(voltage[which], values[which])
+        return slope
+
+    def _initial(self, values):
+        v = np.empty(len(values))
+        for cls, which in self._nonlinearGroups:
+            v[which] = cls.initial(values[which])
+        return v
+
+    def _limit(self, new, old, values):
+        limited = new.copy()
+        for cls, which in self._nonlinearGroups:
+            limited[which] = cls.limit(new[which], old[which], values[which])
+        return limited
+
+    def _nonlinearClasses(self, indices):
+        """ Class of each of the given nonlinear elements """
+        return [self._elementList[i].__class__ for i in indices]
+
+    ####################################################
+    ## Branch currents
+    ####################################################
+
+    # Every element's current follows from the solution in one pass. Resistors
+    # and nonlinear elements get theirs from the voltage across them, voltage
+    # sources have theirs among the unknowns and capacitors carry none at DC.
+    # That leaves wires and inductors, which were merged into supernodes: their
+    # currents are whatever balances the current the other elements bring to
+    # each node of the supernode.
+    def _branchCurrents(self, solution, voltages):
+        """ Current from src to dest through every element, NaN for the
+        elements of floating parts and removed ones """
+        locations, kinds, src, dest = self._topologyArrays()
+        values = self._values()
+        across = voltages[src] - voltages[dest]
+        currents = np.full(len(kinds), np.nan)
+        grounded = (kinds != REMOVED) & (self._nodeCols[src] != FLOATING)
+        currents[grounded & (kinds == CAPACITOR)] = 0.0
+
+        currents[self._resistorIdx] = across[self._resistorIdx] / values[self._resistorIdx]
+        n = self._nonlinearIdx
+        currents[n] = self._evaluate(across[n], values[n])[0] + GMIN * across[n]
+        # The source's unknown is the current flowing out of its dest
+        currents[self._sourceIdx] = -solution[self.dim:]
+
+        shorts = np.flatnonzero(grounded & ((kinds == WIRE) | (kinds == INDUCTOR)))
+        if len(shorts):
+            currents[shorts] = self._shortCurrents(shorts, currents)
+        return currents
+
+    def _shortCurrents(self, shorts, currents):
+        """ Currents through the given wires and inductors that satisfy KCL at
+        every node, given the current of every other element. Wires in a loop
+        share their current as if they were equal resistors """
+        locations, kinds, src, dest = self._topologyArrays()
+        count = len(locations)
+        known = np.isfinite(currents)
+        known[shorts] = False
+        # Current the other elements take out of each node
+        leaving = np.bincount(src[known], currents[known], count) - \
+                  np.bincount(dest[known], currents[known], count)
+
+        # The wires have to bring it back. Their currents are the differences
+        # of a potential over each wire, which takes a Laplacian solve with one
+        # node of every supernode pinned at 0.
+        a, b = src[shorts], dest[shorts]
+        labels = supernodes(count, a, b)
+        touched = np.unique(np.concatenate((a, b)))
+        pinned = np.zeros(count, dtype=bool)
+        pinned[touched[np.unique(labels[touched], return_index=True)[1]]] = True
+        free = touched[~pinned[touched]]
+        column = np.full(count, -1)
+        column[free] = np.arange(len(free))
+        ca, cb = column[a], column[b]
+        rows = np.concatenate((ca, cb, ca, cb))
+        cols = np.concatenate((ca, cb, cb, ca))
+        ones = np.ones(len(shorts))
+        vals = np.concatenate((ones, ones, -ones, -ones))
+        keep = (rows >= 0) & (cols >= 0)
+        L = buildMatrix(rows[keep], cols[keep], vals[keep], len(free))
+        potential = np.zeros(count)
+        if len(free):
+            # Factored directly rather than by factorMatrix, so the counters
+            # of the solve stay those of the circuit's own system
+            potential[free] = Factorization(L).solve(-leaving[free])
+        return potential[a] - potential[b]
+
+    def _storeCurrents(self, currents, voltages):
+        """ Records the current and power of every element, and the current
+        through every node: half of what its elements carry in and out """
+        if currents is None:
+            self.currents = self.powers = None
+            self._storeElementCurrents(None, None, None)
             return
+        locations, kinds, src, dest = self._topologyArrays()
+        self.currents = currents
+        self.powers = currents * (voltages[src] - voltages[dest])
+        magnitude = np.where(np.isfinite(currents), np.abs(currents), 0.0)
+        through = 0.5 * (np.bincount(src, magnitude, len(locations)) +
+                         np.bincount(dest, magnitude, len(locations)))
+        self._storeElementCurrents(self.currents, self.powers, through)
+
+    ####################################################
+    ## Canonical hash and cached solutions
+    ####################################################
 
-        for loc, node in self.nodes.iteritems():
-            node.voltage = solution[self.nodeToCol[loc]][0]
+    def canonicalHash(self):
+        """ Hex digest identifying the circuit: its node locations, the kind,
+        ends and value of every element, and the ground. It doesn't depend on
+        the order elements were added in or which end of a resistor or wire is
+        src, so equal circuits hash the same wherever they were built. """
+        return self._canonicalKey()[0]
 
+    def _canonicalKey(self):
+        """ (canonicalHash(), indices of the elements in canonical order, and
+        whether each of them was turned around to get there) """
+        locations, kinds, src, dest = self._topologyArrays()
+        nodes, rank, digest = self._canonicalNodes()
+        live = kinds != REMOVED
+        kinds, values = kinds[live], self._values()[live] + 0.0
+        a, b = rank[src[live]], rank[dest[live]]
+        # Only the direction of a voltage source or nonlinear element matters
+        swap = (kinds != VOLTAGE_SOURCE) & (kinds != NONLINEAR) & (a > b)
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        order = np.lexsort((values, b, a, kinds))
+
+        h = hashlib.sha1(digest)
+        h.update(repr(self.ground))
+        for column in (kinds.astype(np.int8), a.astype(np.int64), b.astype(np.int64),
+                       values.astype(np.float64)):
+            h.update(np.ascontiguousarray(column[order]).tostring())
+        # Nonlinear elements with the same value can still behave differently
+        nonlinear = np.flatnonzero(live)[order][kinds[order] == NONLINEAR]
+        h.update(" ".join(cls.__name__ for cls in self._nonlinearClasses(nonlinear)))
+        return h.hexdigest(), np.flatnonzero(live)[order], swap[order]
+
+    def _canonicalNodes(self):
+        """ (nodes, rank, digest): indices of the nodes with elements in sorted
+        location order, each node's position in that order, and a digest of
+        their locations. Kept until the topology changes """
+        if self._canonical is None:
+            locations, kinds, src, dest = self._topologyArrays()
+            live = kinds != REMOVED
+            used = np.zeros(len(locations), dtype=bool)
+            used[src[live]] = used[dest[live]] = True
+            nodes = np.array(self._locationOrder(np.flatnonzero(used).tolist()), dtype=int)
+            rank = np.full(len(locations), -1, dtype=np.int64)
+            rank[nodes] = np.arange(len(nodes))
+            digest = hashlib.sha1("\n".join(repr(locations[i]) for i in nodes)).digest()
+            self._canonical = (nodes, rank, digest)
+        return self._canonical
+
+    def _entry(self, voltages, order, turned):
+        """ What the cache keeps of a solve: voltages of the nodes and currents
+        of the elements in canonical order (None if unsolvable), and the
+        floating parts. Currents are turned around with their element """
+        nodes = self._canonicalNodes()[0]
+        if voltages is None:
+            return {"voltages": None, "currents": None, "floating": self.floating}
+        return {"voltages": voltages[nodes],
+                "currents": np.where(turned, -self.currents[order], self.currents[order]),
+                "floating": self.floating}
+
+    def _restore(self, entry, order, turned):
+        """ Takes the solution from a cache entry. Returns False if there is none """
+        # Entries from before currents were kept don't count
+        if entry is None or "currents" not in entry:
+            return False
+        if entry["voltages"] is None:
+            self.unsolvable = True
+            self._storeCurrents(None, None)
+            return True
+        voltages = np.zeros(len(self._topologyArrays()[0]))
+        voltages[self._canonicalNodes()[0]] = entry["voltages"]
+        self._storeVoltages(voltages)
+        currents = np.full(len(self._topologyArrays()[1]), np.nan)
+        currents[order] = np.where(turned, -entry["currents"], entry["currents"])
+        self._storeCurrents(currents, voltages)
+        self.floating = entry["floating"]
         self.solved = True
+        return True
 
-    # Creates each node equation using a KCL (if needed)
-    # Goes through each node, starting with ground
-    def _createEquations(self):
-        equations = []
-
-        # Ground equation forces ground node to be 0 volts
-        groundEquation = [0]*(self.dim + 1)
-        groundEquation[self.nodeToCol[self.ground]] = 1
-        equations.append(groundEquation)
-
-        for loc, node in self.nodes.iteritems():
-            # First, create all voltage source equations
-            for element in node.elements:
-                src = self.nodeToCol[element.src]
-                dest = self.nodeToCol[element.dest]
-
-                # Equation is n1 - n2 = voltageValue for voltage sources
-                if isinstance(element, VoltageSource):
-                    equation = [0]*(self.dim + 1)
-                    equation[src] = 1
-                    equation[dest] = -1
-                    equation[self.dim] = -element.voltage
-                    equations.append(equation)
-
-            # Next, use KCL to produce equations for nodes connecting resistors
-            if any([isinstance(e, Resistor) for e in node.elements]):
-                equation = [0]*(self.dim + 1)
-                self._buildKCLEquation(loc, set(), equation)
-                equations.append(equation)
-
-        return equations
-
-    def _buildKCLEquation(self, location, visited, equation):
-        """ Find current using either Ohm's law or recursively with KCL """
-
-        for element in self.nodes[location].elements:
-            #if the connection was already visited, don't do anything
-            #otherwise, this would recurse infinitely
-            if element not in visited:
-                visited.add(element)
-
-                #Base case: two nodes are connected by a resistor
-                if isinstance(element, Resistor):
-                    srcIndex = self.nodeToCol[element.src]
-                    destIndex = self.nodeToCol[element.dest]
-
-                    # Equation is src - dest (normalized by R)
-                    equation[srcIndex] += 1.0/element.resistance
-                    equation[destIndex] += -1.0/element.resistance
-
-                #Recursive case: nodes connected by a non-resistive element
-                #Go through using KCLs and add them up to get the current
-                else:
-                    self._buildKCLEquation(element.dest, visited, equation)
+    ####################################################
+    ## Element storage, as seen by the equation builder
+    ####################################################
+
+    # The solver works on flat arrays: a table of node locations, and the kind,
+    # src node index, dest node index and value of each element. These methods
+    # build them from the element objects. CompactCircuit stores them directly.
+
+    def _topologyArrays(self):
+        """ _arrays(), built once per topology """
+        if self._topology is None:
+            self._topology = self._arrays()
+        return self._topology
+
+    def _arrays(self):
+        """ Returns (locations, kinds, src, dest) for every node and element """
+        locations = list(self.nodes)
+        index = dict((loc, i) for i, loc in enumerate(locations))
+        self._nodeList = [self.nodes[loc] for loc in locations]
+        self._elementList = list(self.elements)
+        self._position = dict((id(e), i) for i, e in enumerate(self._elementList))
+        self._locationIndex = index
+
+        kinds = np.array([kindCode(e) for e in self._elementList], dtype=np.int8)
+        src = np.array([index[e.src] for e in self._elementList], dtype=np.int32)
+        dest = np.array([index[e.dest] for e in self._elementList], dtype=np.int32)
+        return locations, kinds, src, dest
+
+    def _nodeIndex(self, location):
+        return self._locationIndex[location]
+
+    def _locationOrder(self, nodes=None):
+        """ Node indices, all of them by default, sorted by location """
+        locations = self._topologyArrays()[0]
+        if nodes is None:
+            nodes = xrange(len(locations))
+        return sorted(nodes, key=locations.__getitem__)
+
+    def _elementIndex(self, element):
+        """ Index of an element in the arrays, or None if it isn't in the circuit """
+        return self._position.get(id(element))
+
+    def _resistances(self):
+        return np.array([self._elementList[i].resistance for i in self._resistorIdx], dtype=float)
+
+    def _values(self):
+        """ Value of every element, in _arrays() order """
+        return np.array([valueOf(e) for e in self._elementList], dtype=float)
+
+    def _voltages(self):
+        return np.array([self._elementList[i].voltage for i in self._sourceIdx], dtype=float)
 
-class Element:
+    def _storeVoltages(self, voltages):
+        """ Records the solved voltage of every node, in _arrays() order """
+        for node, voltage in zip(self._nodeList, voltages.tolist()):
+            node.voltage = voltage
+
+    def _storeElementCurrents(self, currents, powers, through):
+        """ Puts the currents and powers on the elements, and the currents
+        through the nodes on the nodes. All None resets them """
+        if currents is None:
+            for element in self._elementList:
+                element.resetCurrent()
+            return
+        for element, current, power in zip(self._elementList, currents.tolist(), powers.tolist()):
+            element.resetCurrent(current)
+            element.power = power
+        for node, current in zip(self._nodeList, through.tolist()):
+            node.current = current
+
+    def elementsInOrder(self):
+        """ The elements in the order of currents and powers """
+        self._topologyArrays()
+        return list(self._elementList)
+
+class Element(object):
 
     def __init__(self, src, dest):
         """ src and dest are tuples representing the element's grid location """
         self.src = src
         self.dest = dest
         # Populated when circuit is solved
-        #self.current = None
+        self.current = None
+        self.power = None
 
     def resetCurrent(self, value=None):
         self.current = value
+        self.power = None
 
     def __eq__(self, other):
         return self.src == other.src and self.dest == other.dest
@@ -199,6 +1210,142 @@ class Resistor(Element):
         s = Element.__str__(self)
         return "Resistor: %s, resistance: %0.3f" % (s, self.resistance)
 
+class Capacitor(Element):
+
+    def __init__(self, src, dest, capacitance):
+        Element.__init__(self, src, dest)
+        self.capacitance = capacitance
+
+    def inverse(self):
+        return Capacitor(self.dest, self.src, self.capacitance)
+
+    def __eq__(self, other):
+        return isinstance(other, Capacitor) and self.capacitance == other.capacitance \
+                                            and Element.__eq__(self, other)
+
+    def __str__(self):
+        s = Element.__str__(self)
+        return "Capacitor: %s, capacitance: %g" % (s, self.capacitance)
+
+class Inductor(Element):
+
+    def __init__(self, src, dest, inductance):
+        Element.__init__(self, src, dest)
+        self.inductance = inductance
+
+    def inverse(self):
+        return Inductor(self.dest, self.src, self.inductance)
+
+    def __eq__(self, other):
+        return isinstance(other, Inductor) and self.inductance == other.inductance \
+                                           and Element.__eq__(self, other)
+
+    def __str__(self):
+        s = Element.__str__(self)
+        return "Inductor: %s, inductance: %g" % (s, self.inductance)
+
+class Nonlinear(Element):
+    """ Base of two-terminal elements whose current, from src to dest, is a
+    nonlinear function of the voltage V(src) - V(dest) across them. Each has a
+    single parameter, value. Subclasses give the current for arrays of
+    voltages and values at once, so a Newton iteration evaluates all the
+    elements of a class in one call. """
+
+    def __init__(self, src, dest, value):
+        Element.__init__(self, src, dest)
+        self.value = value
+
+    @staticmethod
+    def evaluate(voltage, value):
+        """ (current, dcurrent/dvoltage) of elements with the given values """
+        raise NotImplementedError
+
+    @classmethod
+    def valueSlope(cls, voltage, value):
+        """ dcurrent/dvalue, which sensitivity() needs. By default a central
+        difference of evaluate() """
+        step = 1e-6 * np.where(value != 0, np.abs(value), 1.0)
+        return (cls.evaluate(voltage, value + step)[0] -
+                cls.evaluate(voltage, value - step)[0]) / (2 * step)
+
+    @staticmethod
+    def initial(value):
+        """ Voltages to start Newton iterations from, without a better guess """
+        return np.zeros(len(value))
+
+    @staticmethod
+    def limit(new, old, value):
+        """ The voltages to move to next from old, when a Newton step asks
+        for new. Elements that overflow on too large a step limit it """
+        return new
+
+    def inverse(self):
+        element = copy.copy(self)
+        element.src, element.dest = self.dest, self.src
+        return element
+
+    def __eq__(self, other):
+        return other.__class__ is self.__class__ and self.value == other.value \
+                                         and Element.__eq__(self, other)
+
+    def __str__(self):
+        s = Element.__str__(self)
+        return "%s: %s, value: %g" % (self.__class__.__name__, s, self.value)
+
+class Diode(Nonlinear):
+    """ Shockley diode conducting from its anode, src, to its cathode, dest:
+    i = Is (exp(v / Vt) - 1) where value is the saturation current Is """
+
+    def __init__(self, src, dest, saturationCurrent=SATURATION_CURRENT):
+        Nonlinear.__init__(self, src, dest, saturationCurrent)
+
+    @property
+    def saturationCurrent(self):
+        return self.value
+
+    @saturationCurrent.setter
+    def saturationCurrent(self, saturationCurrent):
+        self.value = saturationCurrent
+
+    @staticmethod
+    def evaluate(voltage, value):
+        # Far into forward bias the exponential continues as a straight line
+        # rather than overflow
+        x = voltage / THERMAL_VOLTAGE
+        capped = np.minimum(x, 80.0)
+        e = np.exp(capped)
+        return value * (e * (1.0 + x - capped) - 1.0), value * e / THERMAL_VOLTAGE
+
+    @staticmethod
+    def valueSlope(voltage, value):
+        # The current is proportional to Is
+        return Diode.evaluate(voltage, np.ones_like(value))[0]
+
+    @staticmethod
+    def critical(value):
+        """ Voltage where the current turns steep """
+        return THERMAL_VOLTAGE * np.log(THERMAL_VOLTAGE / (np.sqrt(2.0) * value))
+
+    # Like SPICE, start every junction at its critical voltage
+    initial = critical
+
+    @staticmethod
+    def limit(new, old, value):
+        # SPICE's junction limiting: above the critical voltage a step only
+        # moves along the logarithm of the current the linearization predicted
+        vt = THERMAL_VOLTAGE
+        critical = Diode.critical(value)
+        big = (new > critical) & (np.abs(new - old) > 2 * vt)
+        step = 1.0 + (new - old) / vt
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fromOld = np.where(step > 0, old + vt * np.log(step), critical)
+            fromZero = vt * np.log(new / vt)
+        return np.where(big, np.where(old > 0, fromOld, fromZero), new)
+
+    def __str__(self):
+        s = Element.__str__(self)
+        return "Diode: %s, saturation current: %g" % (s, self.value)
+
 class Wire(VoltageSource):
     def __init__(self, src, dest):
         VoltageSource.__init__(self, src, dest, 0)
@@ -211,11 +1358,104 @@ class Wire(VoltageSource):
 
 class Node(object):
     def __init__(self,location,voltage=0,current=0):
-        self.elements = set()
+        # Elements connected here, each turned so its src is this node
+        self.elements = ElementSet()
         self.location = location
         self.voltage = voltage
         self.current = current
 
-    def addElement(self, element):
+    def addElement(self, element, key=None):
+        """ key is the circuit's element when element is its inverse """
         assert(self.location == element.src)
-        self.elements.add(element)
+        self.elements.add(element, key)
+
+    def removeElement(self, key):
+        self.elements.remove(key)
+
+# Kinds the circuit indexes its elements by, subclasses before their parents
+KINDS = (Wire, VoltageSource, Resistor, Capacitor, Inductor, Nonlinear, Element)
+
+def kindOf(element):
+    for kind in KINDS:
+        if isinstance(element, kind):
+            return kind
+
+def kindCode(element):
+    return KINDS.index(kindOf(element))
+
+def pairKey(a, b):
+    """ Key of the unordered pair of locations a and b """
+    return (a, b) if a <= b else (b, a)
+
+def valueOf(element):
+    """ The value the equations use: resistance of a resistor, voltage of a
+    source, capacitance, inductance or a nonlinear element's parameter """
+    if isinstance(element, Resistor):
+        return element.resistance
+    if isinstance(element, VoltageSource):
+        return element.voltage
+    if isinstance(element, Capacitor):
+        return element.capacitance
+    if isinstance(element, Inductor):
+        return element.inductance
+    if isinstance(element, Nonlinear):
+        return element.value
+    return 0.0
+
+# Stamps a modified nodal analysis system of size unknowns: the voltages of dim
+# nodes, then a current per voltage source. Elements with a conductance between
+# columns gSrc and gDest add it to the KCL rows of both ends. Sources add their
+# current to the KCL rows of both ends, and get their own row saying
+# dest - src = voltage. Anything touching ground is dropped.
+def stampSystem(size, dim, gSrc, gDest, conductance, vSrc, vDest):
+    rows, cols, vals = stampTriplets(size, dim, gSrc, gDest, conductance, vSrc, vDest)
+    return buildMatrix(rows, cols, vals, size)
+
+def stampTriplets(size, dim, gSrc, gDest, conductance, vSrc, vDest):
+    """ The (rows, cols, vals) stampSystem builds its matrix from. The rows and
+    columns only depend on the topology """
+    branch = np.arange(dim, size)
+    ones = np.ones(len(branch))
+    rows = [gSrc, gDest, gSrc, gDest, vDest, vSrc, branch, branch]
+    cols = [gSrc, gDest, gDest, gSrc, branch, branch, vDest, vSrc]
+    vals = [conductance, conductance, -conductance, -conductance,
+            ones, -ones, ones, -ones]
+    rows, cols, vals = map(np.concatenate, (rows, cols, vals))
+    keep = (rows != GROUND) & (cols != GROUND)
+    return rows[keep], cols[keep], vals[keep]
+
+class ElementSet(object):
+    """ Set of elements compared by identity instead of value.
+
+    An element can be stored under another element as its key, which is how
+    nodes keep the inverse of a circuit element while looking it up by the
+    original. Add, remove and membership are O(1). """
+    __slots__ = ("_items",)
+
+    def __init__(self):
+        self._items = dict()
+
+    def add(self, element, key=None):
+        self._items[id(element if key is None else key)] = element
+
+    def remove(self, key):
+        del self._items[id(key)]
+
+    def __contains__(self, key):
+        return id(key) in self._items
+
+    def __iter__(self):
+        return self._items.itervalues()
+
+    def __len__(self):
+        return len(self._items)
+
+    # ids change when unpickled, so only the elements are stored. Sets keyed by
+    # other elements (the nodes') are rebuilt by Circuit.__setstate__ instead.
+    def __getstate__(self):
+        return (list(self),)
+
+    def __setstate__(self, state):
+        self.__init__()
+        for element in state[0]:
+            self.add(element)
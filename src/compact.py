@@ -0,0 +1,563 @@
+""" Compact circuit storage for very large circuits. Instead of an object for
+every element and node (and a second, inverted one per element), the circuit
+is a handful of numpy arrays, and the equation builder reads them directly. """
+
+from collections import Mapping
+import numpy as np
+from circuit import Circuit, Resistor, VoltageSource, Wire, Capacitor, Inductor, \
+                    Diode, kindCode, valueOf, WIRE, VOLTAGE_SOURCE, RESISTOR, CAPACITOR, \
+                    INDUCTOR, NONLINEAR, REMOVED
+
+class CompactCircuit(Circuit):
+    """ Circuit stored as a struct of arrays: the kind, src node index, dest node
+    index and value of every element, plus a table of node locations. Elements
+    and nodes handed out through the Circuit API are light views into them.
+
+    Removing an element leaves a hole, so the indices of the others stay valid.
+    The only nonlinear element stored is the diode, which is all the arrays
+    can tell apart. """
+
+    @classmethod
+    def fromArrays(cls, locations, kinds, src, dest, values):
+        """ Circuit made of existing arrays, used as they are rather than
+        copied. locations is the node table, a list or GridLocations. Read-only
+        arrays, like ones mapped from a file, are copied when first written """
+        circuit = cls(capacity=0)
+        circuit._locations = locations
+        if isinstance(locations, GridLocations):
+            circuit._index = GridIndex(locations)
+        else:
+            circuit._index = dict((loc, i) for i, loc in enumerate(locations))
+        circuit._kind, circuit._src, circuit._dest, circuit._value = kinds, src, dest, values
+        circuit._count = len(kinds)
+        circuit._changed()
+        return circuit
+
+    def __init__(self, capacity=16):
+        # Node table: index -> location and location -> index
+        self._locations = []
+        self._index = dict()
+        # Element arrays, the first _count entries are in use
+        self._count = 0
+        self._kind = np.empty(capacity, dtype=np.int8)
+        self._src = np.empty(capacity, dtype=np.int32)
+        self._dest = np.empty(capacity, dtype=np.int32)
+        self._value = np.empty(capacity, dtype=float)
+        # Node voltages and the currents through the nodes from the last
+        # solve, in node table order
+        self._nodeVoltages = None
+        self._nodeCurrents = None
+        self._adjacency = None
+        self._reset()
+
+    ####################################################
+    ## Building the circuit
+    ####################################################
+
+    def addNode(self, location):
+        """ Index of the node at location, adding it to the node table if needed """
+        i = self._index.get(location)
+        if i is None:
+            i = self._index[location] = len(self._locations)
+            self._locations.append(location)
+        return i
+
+    def addElements(self, kinds, src, dest, values):
+        """ Adds many elements at once, without creating any objects.
+
+        kinds are element kind codes (RESISTOR, VOLTAGE_SOURCE, WIRE, ...), src and
+        dest are node indices from addNode, and values the resistances, voltages,
+        capacitances, inductances or diode saturation currents. """
+        n = len(kinds)
+        self._reserve(self._count + n)
+        added = slice(self._count, self._count + n)
+        self._kind[added] = kinds
+        self._src[added] = src
+        self._dest[added] = dest
+        self._value[added] = values
+        self._count += n
+        if self.spatial is not None:
+            # Indexed one by one, so a circuit built in bulk is quicker to
+            # index once it's done, with spatial.attach
+            for i in xrange(added.start, added.stop):
+                self.spatial.add(self._spatialKey(i), self._view(i))
+        self._changed()
+
+    def addElement(self, element):
+        """ Copy an element into the circuit """
+        if kindCode(element) == NONLINEAR and not isinstance(element, Diode):
+            raise ValueError("%s can't be stored in a CompactCircuit" % element)
+        src, dest = self.addNode(element.src), self.addNode(element.dest)
+        self.addElements([kindCode(element)], [src], [dest], [valueOf(element)])
+
+    def addMultiPort(self, model, terminals, reference, name):
+        """ Adds the network of a MultiPort in one go, as Circuit.addMultiPort
+        does. Returns views of the elements added """
+        elements = self._multiPortElements(model, terminals, reference, name)
+        start = self._count
+        self.addElements([kindCode(e) for e in elements], [self.addNode(e.src) for e in elements],
+                         [self.addNode(e.dest) for e in elements], [valueOf(e) for e in elements])
+        return [self._view(i) for i in xrange(start, self._count)]
+
+    def removeElement(self, element):
+        """ Remove an element, given as one of the circuit's views or an equal element """
+        i = self._elementIndex(element)
+        if i is None:
+            equal = [e for e in self.elementsBetween(element.src, element.dest) if e == element]
+            if not equal:
+                raise ValueError("%s is not in the circuit" % element)
+            i = equal[0].index
+        self._writable("_kind")[i] = REMOVED
+        if self.spatial is not None:
+            self.spatial.remove(self._spatialKey(i))
+        self._changed()
+
+    def _spatialKey(self, element):
+        # Views come and go, the index of an element stays
+        return element.index if isinstance(element, ElementView) else element
+
+    def addGround(self, location):
+        self.addNode(location)
+        Circuit.addGround(self, location)
+
+    def _writable(self, name):
+        """ The named element array, first copied if it is read-only """
+        array = getattr(self, name)
+        if not array.flags.writeable:
+            array = np.array(array)
+            setattr(self, name, array)
+        return array
+
+    def _reserve(self, capacity):
+        """ Grows the element arrays to hold at least capacity elements """
+        if capacity <= len(self._kind):
+            return
+        capacity = max(capacity, 2 * len(self._kind))
+        for name in ("_kind", "_src", "_dest", "_value"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._count] = old[:self._count]
+            setattr(self, name, new)
+
+    def __getstate__(self):
+        # The topology arrays are views of the element arrays, which would be copied
+        state = Circuit.__getstate__(self)
+        state['_topology'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Nothing to rebuild, the arrays are the whole circuit
+        self.__dict__.update(state)
+
+    def _changed(self):
+        self._adjacency = None
+        # Currents are kept by element index, which an edit may outgrow
+        self.currents = self.powers = None
+        self._invalidate()
+
+    ####################################################
+    ## Circuit API, answered with views
+    ####################################################
+
+    @property
+    def nodes(self):
+        return NodeMap(self)
+
+    @property
+    def elements(self):
+        return (self._view(i) for i in self._live())
+
+    def voltageSources(self):
+        sources = self._live(VOLTAGE_SOURCE)
+        return [self._view(i) for i in sources[self._value[sources] != 0]]
+
+    def resistors(self):
+        return [self._view(i) for i in self._live(RESISTOR)]
+
+    def wires(self):
+        return [self._view(i) for i in self._live(WIRE)]
+
+    def capacitors(self):
+        return [self._view(i) for i in self._live(CAPACITOR)]
+
+    def inductors(self):
+        return [self._view(i) for i in self._live(INDUCTOR)]
+
+    def nonlinearElements(self):
+        return [self._view(i) for i in self._live(NONLINEAR)]
+
+    def elementsBetween(self, a, b):
+        """ Every element connecting locations a and b, in either direction """
+        if a not in self._index or b not in self._index:
+            return []
+        a, b = self._index[a], self._index[b]
+        return [self._view(i) for i in self.elementsAt(a)
+                if (self._src[i], self._dest[i]) in ((a, b), (b, a))]
+
+    def elementsAt(self, node):
+        """ Indices of the elements connected to a node index """
+        indptr, elements = self.adjacency()
+        return elements[indptr[node]:indptr[node + 1]]
+
+    def adjacency(self):
+        """ CSR adjacency of the nodes: the elements connected to node i are
+        elements[indptr[i]:indptr[i + 1]]. Built on first use after an edit. """
+        if self._adjacency is None:
+            live = self._live()
+            ends = np.concatenate((self._src[live], self._dest[live]))
+            order = np.argsort(ends, kind="mergesort")
+            counts = np.bincount(ends, minlength=len(self._locations))
+            indptr = np.zeros(len(self._locations) + 1, dtype=np.int64)
+            np.cumsum(counts, out=indptr[1:])
+            elements = np.concatenate((live, live))[order].astype(np.int32)
+            self._adjacency = (indptr, elements)
+        return self._adjacency
+
+    def __str__(self):
+        elementStr = "\n".join(map(str, self.elements))
+        return "%s\n Ground: %s" % (elementStr, self.ground)
+
+    def _live(self, kind=None):
+        kinds = self._kind[:self._count]
+        if kind is None:
+            return np.flatnonzero(kinds != REMOVED)
+        return np.flatnonzero(kinds == kind)
+
+    def _view(self, i):
+        return VIEWS[self._kind[i]](self, i)
+
+    ####################################################
+    ## Arrays for the equation builder
+    ####################################################
+
+    def _arrays(self):
+        n = self._count
+        return self._locations, self._kind[:n], self._src[:n], self._dest[:n]
+
+    def _nodeIndex(self, location):
+        return self._index[location]
+
+    def _locationOrder(self, nodes=None):
+        if isinstance(self._locations, GridLocations):
+            order = self._locations.order(nodes)
+            if order is not None:
+                return order
+        return Circuit._locationOrder(self, nodes)
+
+    def _elementIndex(self, element):
+        if isinstance(element, ElementView) and element.circuit is self \
+                and self._kind[element.index] != REMOVED:
+            return element.index
+        return None
+
+    def _resistances(self):
+        return self._value[self._resistorIdx]
+
+    def _values(self):
+        return self._value[:self._count]
+
+    def _nonlinearClasses(self, indices):
+        return [Diode] * len(indices)
+
+    def _voltages(self):
+        return self._value[self._sourceIdx]
+
+    def _storeVoltages(self, voltages):
+        self._nodeVoltages = voltages
+
+    def _previousVoltages(self):
+        voltages = self._nodeVoltages
+        if voltages is None or len(voltages) != len(self._locations):
+            return np.zeros(len(self._locations))
+        return voltages
+
+    def _storeElementCurrents(self, currents, powers, through):
+        # The views read currents and powers straight from the circuit
+        self._nodeCurrents = through
+
+    def elementsInOrder(self):
+        """ The elements in the order of currents and powers, which is their
+        index. Removed elements are None """
+        kinds = self._kind[:self._count]
+        return [self._view(i) if kinds[i] != REMOVED else None for i in xrange(self._count)]
+
+####################################################
+## Views
+####################################################
+
+class ElementView(object):
+    """ An element of a CompactCircuit. Reads and writes go to the circuit's arrays """
+    __slots__ = ("circuit", "index")
+
+    def __init__(self, circuit, index):
+        self.circuit = circuit
+        self.index = index
+
+    @property
+    def src(self):
+        return self.circuit._locations[self.circuit._src[self.index]]
+
+    @property
+    def dest(self):
+        return self.circuit._locations[self.circuit._dest[self.index]]
+
+    @property
+    def current(self):
+        currents = self.circuit.currents
+        return currents[self.index] if currents is not None else None
+
+    @property
+    def power(self):
+        powers = self.circuit.powers
+        return powers[self.index] if powers is not None else None
+
+    def toElement(self):
+        """ A standalone element object with the same values """
+        raise NotImplementedError
+
+    def inverse(self):
+        return self.toElement().inverse()
+
+    def __eq__(self, other):
+        if isinstance(other, ElementView):
+            return self.circuit is other.circuit and self.index == other.index
+        return kindCode(other) == self.circuit._kind[self.index] \
+            and (other.src, other.dest) == (self.src, self.dest) \
+            and valueOf(other) == self.circuit._value[self.index]
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.circuit), self.index))
+
+    def __str__(self):
+        return str(self.toElement())
+
+class ResistorView(ElementView):
+    __slots__ = ()
+
+    def _getResistance(self):
+        return self.circuit._value[self.index]
+
+    def _setResistance(self, resistance):
+        self.circuit._writable("_value")[self.index] = resistance
+
+    resistance = property(_getResistance, _setResistance)
+
+    def toElement(self):
+        return Resistor(self.src, self.dest, self.resistance)
+
+class VoltageSourceView(ElementView):
+    __slots__ = ()
+
+    def _getVoltage(self):
+        return self.circuit._value[self.index]
+
+    def _setVoltage(self, voltage):
+        self.circuit._writable("_value")[self.index] = voltage
+
+    voltage = property(_getVoltage, _setVoltage)
+
+    def toElement(self):
+        return VoltageSource(self.src, self.dest, self.voltage)
+
+class WireView(VoltageSourceView):
+    __slots__ = ()
+
+    def toElement(self):
+        return Wire(self.src, self.dest)
+
+class CapacitorView(ElementView):
+    __slots__ = ()
+
+    def _getCapacitance(self):
+        return self.circuit._value[self.index]
+
+    def _setCapacitance(self, capacitance):
+        self.circuit._writable("_value")[self.index] = capacitance
+
+    capacitance = property(_getCapacitance, _setCapacitance)
+
+    def toElement(self):
+        return Capacitor(self.src, self.dest, self.capacitance)
+
+class InductorView(ElementView):
+    __slots__ = ()
+
+    def _getInductance(self):
+        return self.circuit._value[self.index]
+
+    def _setInductance(self, inductance):
+        self.circuit._writable("_value")[self.index] = inductance
+
+    inductance = property(_getInductance, _setInductance)
+
+    def toElement(self):
+        return Inductor(self.src, self.dest, self.inductance)
+
+class DiodeView(ElementView):
+    __slots__ = ()
+
+    def _getSaturationCurrent(self):
+        return self.circuit._value[self.index]
+
+    def _setSaturationCurrent(self, saturationCurrent):
+        self.circuit._writable("_value")[self.index] = saturationCurrent
+
+    saturationCurrent = value = property(_getSaturationCurrent, _setSaturationCurrent)
+
+    def toElement(self):
+        return Diode(self.src, self.dest, self.saturationCurrent)
+
+VIEWS = {WIRE: WireView, VOLTAGE_SOURCE: VoltageSourceView, RESISTOR: ResistorView,
+         CAPACITOR: CapacitorView, INDUCTOR: InductorView, NONLINEAR: DiodeView}
+
+class NodeView(object):
+    """ A node of a CompactCircuit """
+    __slots__ = ("circuit", "index")
+
+    def __init__(self, circuit, index):
+        self.circuit = circuit
+        self.index = index
+
+    @property
+    def location(self):
+        return self.circuit._locations[self.index]
+
+    @property
+    def voltage(self):
+        voltages = self.circuit._nodeVoltages
+        return voltages[self.index] if voltages is not None else 0
+
+    @property
+    def current(self):
+        currents = self.circuit._nodeCurrents
+        return currents[self.index] if currents is not None else 0
+
+    @property
+    def elements(self):
+        return [self.circuit._view(i) for i in self.circuit.elementsAt(self.index)]
+
+class NodeMap(Mapping):
+    """ Read-only location -> NodeView mapping standing in for Circuit.nodes """
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+
+    def __getitem__(self, location):
+        return NodeView(self.circuit, self.circuit._index[location])
+
+    def __contains__(self, location):
+        return location in self.circuit._index
+
+    def __iter__(self):
+        return iter(self.circuit._locations)
+
+    def __len__(self):
+        return len(self.circuit._locations)
+
+####################################################
+## Node tables of grid locations
+####################################################
+
+# Lookups by location that scan the coordinates before a dict is built
+MAX_SCANS = 64
+# Rows of coordinates turned into tuples at a time when iterating
+ITER_ROWS = 65536
+
+class GridLocations(object):
+    """ Node table of (x, y) grid locations kept as an n x 2 integer array,
+    which takes no object per node. Nodes added afterwards go in a list """
+
+    def __init__(self, coordinates):
+        self.coordinates = coordinates
+        self._added = []
+
+    def __len__(self):
+        return len(self.coordinates) + len(self._added)
+
+    def __getitem__(self, i):
+        if i < len(self.coordinates):
+            x, y = self.coordinates[i].tolist()
+            return (x, y)
+        return self._added[i - len(self.coordinates)]
+
+    def __iter__(self):
+        for start in xrange(0, len(self.coordinates), ITER_ROWS):
+            for x, y in self.coordinates[start:start + ITER_ROWS].tolist():
+                yield (x, y)
+        for location in self._added:
+            yield location
+
+    def append(self, location):
+        self._added.append(location)
+
+    def find(self, location):
+        """ Index of a location, or None """
+        if location in self._added:
+            return len(self.coordinates) + self._added.index(location)
+        if not _isGridLocation(location):
+            return None
+        x, y = self.coordinates[:, 0], self.coordinates[:, 1]
+        found = np.flatnonzero((x == location[0]) & (y == location[1]))
+        return int(found[0]) if len(found) else None
+
+    def order(self, nodes=None):
+        """ Node indices sorted by location, like sorted() would sort their
+        tuples, or None if some added node isn't a grid location """
+        if not all(_isGridLocation(location) for location in self._added):
+            return None
+        x = np.append(self.coordinates[:, 0], [location[0] for location in self._added])
+        y = np.append(self.coordinates[:, 1], [location[1] for location in self._added])
+        if nodes is None:
+            return np.lexsort((y, x))
+        nodes = np.asarray(nodes, dtype=int)
+        return nodes[np.lexsort((y[nodes], x[nodes]))]
+
+class GridIndex(object):
+    """ Location -> node index of a GridLocations table, standing in for the
+    dict of CompactCircuit._index. The first lookups scan the coordinates,
+    which is quicker than building a dict of every node for just a few """
+
+    def __init__(self, locations):
+        self.locations = locations
+        self._added = dict()
+        self._dict = None
+        self._scans = 0
+
+    def get(self, location, default=None):
+        if self._dict is None and self._scans >= MAX_SCANS:
+            self._dict = dict((location, i) for i, location in enumerate(self.locations))
+        if self._dict is not None:
+            return self._dict.get(location, default)
+        i = self._added.get(location)
+        if i is None:
+            self._scans += 1
+            i = self.locations.find(location)
+        return default if i is None else i
+
+    def __getitem__(self, location):
+        i = self.get(location)
+        if i is None:
+            raise KeyError(location)
+        return i
+
+    def __contains__(self, location):
+        return self.get(location) is not None
+
+    def __setitem__(self, location, i):
+        self._added[location] = i
+        if self._dict is not None:
+            self._dict[location] = i
+
+    def __getstate__(self):
+        # The dict is only a shortcut, and can be as big as the table
+        state = self.__dict__.copy()
+        state['_dict'] = None
+        state['_scans'] = 0
+        return state
+
+def _isGridLocation(location):
+    return isinstance(location, tuple) and len(location) == 2 and \
+        all(isinstance(c, (int, long)) for c in location)
@@ -0,0 +1,49 @@
+""" Graph algorithms over the circuit's nodes """
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+####################################################
+## Connected components
+####################################################
+
+# Labels each of count nodes with the connected component it belongs to,
+# where every (src, dest) pair is an edge. The search runs in compiled code,
+# so millions of edges take no Python-level loop.
+def components(count, src, dest):
+    joins = sparse.coo_matrix((np.ones(len(src)), (src, dest)), shape=(count, count))
+    return csgraph.connected_components(joins, directed=False)[1]
+
+# Supernodes are nodes merged because wires join them: the components of
+# the graph of wires, found by scipy's connected_components.
+def supernodes(count, src, dest):
+    return components(count, src, dest)
+
+####################################################
+## Orderings
+####################################################
+
+# Reverse Cuthill-McKee order of the graph whose edges are the nonzeros of
+# the square matrix A, whatever their direction: a breadth first search from
+# a node at the edge of the graph, reversed, which numbers neighbours close
+# together. Returns the position each node moves to.
+def bandOrder(A):
+    pattern = (abs(A) + abs(A.T)).tocsr()
+    order = csgraph.reverse_cuthill_mckee(pattern, symmetric_mode=True)
+    position = np.empty(len(order), dtype=int)
+    position[order] = np.arange(len(order))
+    return position
+
+# Entries of the lower triangle of the symmetric matrix A within its
+# envelope in bandOrder: each row from its first nonzero to the diagonal.
+# Factoring A in that order fills in nothing outside the envelope, so this
+# bounds the size of its factors, and it takes a breadth first search to
+# find, where factoring a mesh takes far longer.
+def envelope(A):
+    position = bandOrder(A)
+    coo = A.tocoo()
+    rows, cols = position[coo.row], position[coo.col]
+    first = np.arange(A.shape[0])
+    np.minimum.at(first, rows, cols)
+    return int((np.arange(A.shape[0]) - first).sum()) + A.shape[0]
@@ -2,15 +2,40 @@ from Tkinter import *
 import tkSimpleDialog
 import tkFileDialog
 from circuit import *
-import pickle
+import netlist
+from cache import SolutionCache
+from background import BackgroundSolver
+from spatial import attach, point
 
 #  Constants
 CELL_SIZE = 20
 OFFSCREEN = (-50, -50)
 R_VOLTAGE = 20
+# Zoom levels, in screen pixels per circuit unit, and how far the arrow keys
+# pan, in screen pixels
+ZOOMS = (0.25, 0.5, 1, 2, 4)
+PAN_STEP = 100
+# How often a solve in progress is checked on, and how long live solving
+# waits for edits to stop, in milliseconds
+POLL_MS = 50
+DEBOUNCE_MS = 300
+# Solutions of circuits solved this session, so solving again is a lookup
+solutionCache = SolutionCache()
+# Solves run in a worker process, so the window keeps responding meanwhile
+solver = BackgroundSolver()
+
+# The canvas is retained mode: every element, text and pane is drawn once and
+# keeps its canvas items, which are moved, reconfigured, hidden or deleted as
+# things change. Nothing is redrawn on a timer, every input event ends with
+# refresh(), which only touches what changed since the last one.
+#
+# The circuit lives in its own coordinates, shown through a view that pans
+# and zooms. Only the elements in view have canvas items, found through the
+# circuit's spatial index, which also answers which node or element a click
+# is on.
 
 #########################################################################
-## Taking human/time input (mousePressed, motion, keyPressed, timerFired)
+## Taking human input (mousePressed, motion, keyPressed)
 #########################################################################
 
 ### MOUSE PRESSED FUNCTIONS ###
@@ -24,18 +49,20 @@ def mousePressed(event):
         mousePressedVoltage(event)
         mousePressedResistor(event)
         mousePressedNode(event)
+    refresh()
 
 # Adds the initial coordiantes of the click to the list of wires,
 # which will be drawn each time
 def mousePressedWire(event):
     if inBounds(event.x,event.y):
-        x,y = snapToGrid(event.x,event.y)
+        x,y = gridPoint(event.x,event.y)
         if canvas.data.isClicked:
             canvas.data.currentWire = Wire((x,y), (x,y))
         else:
             # If wire drawn on same point, delete it
             if canvas.data.currentWire.src != canvas.data.currentWire.dest:
                 canvas.data.circuit.addElement(canvas.data.currentWire)
+                circuitEdited()
             canvas.data.currentWire = None
 
 # Mouse pressed actions if user selects a Voltage Source
@@ -47,14 +74,14 @@ def mousePressedVoltage(event):
     # When dropping the object, it's added to the grid
     elif not canvas.data.isClicked and canvas.data.draggingVoltage:
         if inBounds(event.x,event.y):
-            x,y = snapToGrid(event.x,event.y)
+            x,y = gridPoint(event.x,event.y)
             addVoltageToGrid(x,y)
 
 # Initializes voltage and adds it to the grid
 # Also creates a connection object between the two nodes and stores
 # the voltage source as that connection
 def addVoltageToGrid(x,y):
-    canvas.data.clickedVoltage = (x,y)
+    canvas.data.clickedVoltage = toScreen(x,y)
     canvas.data.draggingVoltage = False
     vPrompt = ("Voltage Entry","Enter voltage in Volts")
     voltValue = 0
@@ -69,6 +96,7 @@ def addVoltageToGrid(x,y):
     if voltValue != None:
         a = VoltageSource((x,y + 40),(x,y-40), voltValue)
         canvas.data.circuit.addElement(a)
+        circuitEdited()
     # adds ground to the bottom of the first voltage source
     if len(canvas.data.circuit.voltageSources()) == 1 and voltValue != None:
         canvas.data.circuit.addGround((x,y + 40))
@@ -82,12 +110,12 @@ def mousePressedResistor(event):
     #  When dropping the resistor, it's added to the grid
     elif not canvas.data.isClicked and canvas.data.draggingResistor:
         if inBounds(event.x,event.y):
-            (x,y) = snapToGrid(event.x,event.y)
+            (x,y) = gridPoint(event.x,event.y)
             addResistorToGrid(x,y)
 
 # Adds the resistor to the circuit, initializing it with a user-entered resistance. Same idea as the voltage source
 def addResistorToGrid(x,y):
-    canvas.data.clickedResistor = x,y
+    canvas.data.clickedResistor = toScreen(x,y)
     canvas.data.draggingResistor = False
     rPrompt = ("Resistance Entry","Enter resistance in Ohms")
     resistance = 0
@@ -101,9 +129,10 @@ def addResistorToGrid(x,y):
     if resistance != None:
         b = Resistor((x-40,y),(x + 40,y), resistance)
         canvas.data.circuit.addElement(b)
+        circuitEdited()
 
 # When the user clicks on a node after solving the circuit,
-# it is allowed to be displayed
+# it is allowed to be displayed. Clicking an element shows its current.
 def mousePressedNode(event):
     if not canvas.data.circuit.solved:
         pass
@@ -111,6 +140,11 @@ def mousePressedNode(event):
         if type(isNode(event.x,event.y)) == tuple:
             nodeLocation,nodeVoltage = isNode(event.x,event.y)
             canvas.data.displayedNode = (nodeLocation,nodeVoltage)
+            canvas.data.displayedElement = None
+        elif inBounds(event.x,event.y):
+            canvas.data.displayedElement = isElement(event.x,event.y)
+            if canvas.data.displayedElement is not None:
+                canvas.data.displayedNode = OFFSCREEN
 
 ### MOTION FUNCTIONS  ###
 
@@ -122,37 +156,42 @@ def motion(event):
             motionVoltage(event)
         elif canvas.data.draggingResistor:
             motionResistor(event)
-        elif canvas.data.draggingGround:
-            motionGround(event)
+        else:
+            return
+        refresh()
 
 def motionWire(event):
     # Draw wire as user drags mouse
     if canvas.data.currentWire is not None and canvas.data.isClicked:
-        canvas.data.currentWire.dest = snapToGrid(event.x,event.y)
+        canvas.data.currentWire.dest = gridPoint(event.x,event.y)
 
-# Draws voltage as the cursor moves
+# Moves the voltage source as the cursor moves
 def motionVoltage(event):
-    drawVoltageSource(event.x,event.y)
     canvas.data.clickedVoltage = (event.x,event.y)
 
 # Same for resistor
 def motionResistor(event):
-    drawResistor(event.x,event.y)
     canvas.data.clickedResistor = (event.x,event.y)
 
-def drawMotionElements():
-    cx,cy = canvas.data.clickedVoltage
-    rx,ry = canvas.data.clickedResistor
-    drawVoltageSource(cx,cy)
-    drawResistor(rx,ry)
+# Zooms in and out about the cursor
+def mouseWheel(event):
+    if inBounds(event.x,event.y):
+        zoomIn = event.num == 4 or (event.num != 5 and event.delta > 0)
+        zoom(1 if zoomIn else -1, event.x, event.y)
+        refresh()
 
 def keyPressed(event):
     key = event.keysym.lower()
 
     # Solves circuit
     if key == "c":
-        canvas.data.circuit.solve()
+        startSolve()
         canvas.data.drawWire = False
+    # Solves the circuit again after every edit
+    if key == "a":
+        canvas.data.liveSolve = not canvas.data.liveSolve
+        if canvas.data.liveSolve:
+            scheduleSolve()
     # Reset
     if key == "r":
         init()
@@ -168,22 +207,27 @@ def keyPressed(event):
     #  save to file
     if key == "s":
         filename = tkFileDialog.asksaveasfilename()
-        with open(filename, 'w') as f:
-            pickle.dump(canvas.data.circuit, f)
+        if filename:
+            netlist.save(canvas.data.circuit, filename)
     if key == "l":
         filename = tkFileDialog.askopenfilename()
-        with open(filename, 'r') as f:
-             circuit = pickle.load(f)
-        init()
-        canvas.data.circuit = circuit
-
-    redrawAll()
-
-def timerFired():
-    redrawAll()
-    drawMotionElements()
-    delay = 10 # milliseconds
-    canvas.after(delay,timerFired)
+        if filename:
+            circuit = netlist.load(filename, Circuit())
+            init()
+            circuit.cache = solutionCache
+            attach(circuit)
+            canvas.data.circuit = circuit
+            circuitEdited()
+    # moves and zooms the view
+    steps = {"left": (-1, 0), "right": (1, 0), "up": (0, -1), "down": (0, 1)}
+    if key in steps:
+        pan(steps[key][0] * PAN_STEP, steps[key][1] * PAN_STEP)
+    if key in ("plus", "equal", "kp_add"):
+        zoom(1, 200, 250)
+    if key in ("minus", "kp_subtract"):
+        zoom(-1, 200, 250)
+
+    refresh()
 
 #################################################################
 ## Visual elements (drawGrid, drawElements, etc.)
@@ -191,29 +235,35 @@ def timerFired():
 
 # Draws the instruction pane on the bottom right corner
 def drawInstructions():
-    instructCoords = [(400,425),(502,510)]
-    canvas.create_rectangle(instructCoords,fill="white")
-    canvas.create_text(450,435,text="INSTRUCTIONS")
-    canvas.create_text(405,450,text="'e' for element pane",anchor=W,
-    font= "helvetica 10")
-    canvas.create_text(405,495,text="'w' to draw wire",anchor=W,
-    font= "helvetica 10")
-    canvas.create_text(405,480,text="'c' to solve circuit",anchor=W,
-    font= "helvetica 10")
-    canvas.create_text(405,465,text="'r' to reset",anchor=W,
-    font= "helvetica 10")
-
-# Draws element pane and node voltage (if circuit is solved)
+    instructCoords = [(400,380),(502,510)]
+    tags = "instructions"
+    canvas.create_rectangle(instructCoords,fill="white",tags=tags)
+    canvas.create_text(450,390,text="INSTRUCTIONS",tags=tags)
+    canvas.create_text(405,420,text="'e' for element pane",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,465,text="'w' to draw wire",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,450,text="'c' to solve circuit",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,435,text="'r' to reset",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,480,text="arrows to pan",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,495,text="'+' '-' or wheel to zoom",anchor=W,
+    font= "helvetica 10",tags=tags)
+    canvas.create_text(405,405,text="'a' for live solving",anchor=W,
+    font= "helvetica 10",tags=tags)
+
+# Draws element pane, shown and hidden with its "pane" tag. The solved
+# message is a status item, updated by updateStatus
 def drawElementPane():
     paneCoords = [(400,0),(510,510)]
-    canvas.create_rectangle(paneCoords,fill = "grey")
-    canvas.create_text(450,20,text="Elements",font = "helvetica 19")
-    drawVoltageSource(450,100)
-    drawResistor(450,180)
-    if canvas.data.circuit.solved:
-        font = "helvetica 9"
-        text = "Solved!\nClick a node\nto display \nnode voltage."
-        canvas.create_text(450,300,text=text)
+    canvas.create_rectangle(paneCoords,fill = "grey",tags="pane")
+    canvas.create_text(450,20,text="Elements",font = "helvetica 19",tags="pane")
+    drawVoltageSource(450,100,"pane")
+    drawResistor(450,180,"pane")
+    text = "Solved!\nClick a node\nto display \nnode voltage."
+    canvas.data.status["solved"] = canvas.create_text(450,300,text=text,state=HIDDEN)
 
 
 def getCenter(element):
@@ -223,82 +273,296 @@ def getCenter(element):
 
     return ((src[0] + dest[0])/2,(src[1] + dest[1])/2)
 
-# Displays node location and voltage if user clicks a node
-def displayNodeVoltage():
+# Text showing the clicked node's location and voltage, or None
+def nodeVoltageText():
     if canvas.data.circuit.solved and canvas.data.displayedNode[1] != -50:
         if not canvas.data.circuit.unsolvable:
             (nodeLocation,nodeVoltage) = canvas.data.displayedNode
-            text = "Node at %s has voltage %.2f V" % (nodeLocation,nodeVoltage)
-            font = "helvetica 14"
-            canvas.create_text(200,450,text=text,font=font,fill ="red")
-
-
-def displayWireMode():
-    if canvas.data.drawWire:
-        text = "Wire mode: Click to start a wire, press 'w' to exit"
-        font = "helvetica 14"
-        canvas.create_text(200,400,text=text,font=font,fill ="red")
-
-# Function that draws a resistor
-def drawResistor(cx,cy):
+            # NaN, the node has no path to ground
+            if nodeVoltage != nodeVoltage:
+                return "Node at %s is not connected to ground" % (nodeLocation,)
+            return "Node at %s has voltage %.2f V" % (nodeLocation,nodeVoltage)
+    return elementCurrentText()
+
+# Text showing the clicked element's current, or None
+def elementCurrentText():
+    element = canvas.data.displayedElement
+    circuit = canvas.data.circuit
+    if not circuit.solved or circuit.unsolvable or element is None:
+        return None
+    if element.current is None or element.current != element.current:
+        return "%s carries no current" % kindOf(element).__name__
+    return "%s carries %.3g A" % (kindOf(element).__name__, element.current)
+
+# Function that draws a resistor, scale times its usual size. Returns its
+# canvas items
+def drawResistor(cx,cy,tags=(),scale=1):
     # c represents the 'center' of the resistor, where it's length is 80 pixels
-    eLeft,eRight = cx-2*CELL_SIZE,cx + 2*CELL_SIZE # left and right endpoints
-    halfCell = CELL_SIZE/2
-    canvas.create_line(eLeft,cy,eRight,cy,fill="yellow")
-    canvas.create_rectangle(eLeft + CELL_SIZE,cy + halfCell/2,
-    eRight-CELL_SIZE,cy-halfCell/2,fill="red")
-
-# Function that draws a voltage source
-def drawVoltageSource(cx, cy):
-    r = R_VOLTAGE
-    canvas.create_line(cx,cy + 2*r,cx,cy-2*r,fill="yellow")
-    canvas.create_oval(cx-r,cy-r,cx + r,cy + r,fill = "white")
-    canvas.create_text(cx,cy,text=" + \n -",font = "helevetica 14")
+    cell = CELL_SIZE*scale
+    eLeft,eRight = cx-2*cell,cx + 2*cell # left and right endpoints
+    halfCell = cell/2
+    return [canvas.create_line(eLeft,cy,eRight,cy,fill="yellow",tags=tags),
+            canvas.create_rectangle(eLeft + cell,cy + halfCell/2,
+            eRight-cell,cy-halfCell/2,fill="red",tags=tags)]
+
+# Function that draws a voltage source. Returns its canvas items
+def drawVoltageSource(cx,cy,tags=(),scale=1):
+    r = R_VOLTAGE*scale
+    font = "helevetica %d" % max(1, int(14*scale))
+    return [canvas.create_line(cx,cy + 2*r,cx,cy-2*r,fill="yellow",tags=tags),
+            canvas.create_oval(cx-r,cy-r,cx + r,cy + r,fill = "white",tags=tags),
+            canvas.create_text(cx,cy,text=" + \n -",font = font,tags=tags)]
+
+def drawWire(wire,tags=()):
+    x1, y1 = toScreen(*wire.src)
+    x2, y2 = toScreen(*wire.dest)
+    return [canvas.create_line(x1,y1,x2,y2,fill="yellow",tags=tags)]
 
 # Function to create ground
-def drawGround(x,top):
-    canvas.create_line(x,top,x,top + 10,fill="brown")
-    canvas.create_line(x-10,top + 15,x + 10,top + 15,fill="brown",width=2)
-    canvas.create_line(x-5,top + 20,x + 5,top + 20,fill="brown",width=2)
-    canvas.create_line(x-2,top + 25,x + 2,top + 25,fill="brown")
-
-# Generates grid , element pane, instructions, and node voltage
+def drawGround(x,top,scale=1):
+    s = scale
+    canvas.create_line(x,top,x,top + 10*s,fill="brown",tags="ground")
+    canvas.create_line(x-10*s,top + 15*s,x + 10*s,top + 15*s,fill="brown",width=2,tags="ground")
+    canvas.create_line(x-5*s,top + 20*s,x + 5*s,top + 20*s,fill="brown",width=2,tags="ground")
+    canvas.create_line(x-2*s,top + 25*s,x + 2*s,top + 25*s,fill="brown",tags="ground")
+
+# Creates every item that is only ever moved or reconfigured afterwards:
+# the panes, the status texts, the wire being drawn and the elements that
+# follow the cursor while dragged
 def background():
-    if canvas.data.showElementPane:
-        drawElementPane()
+    drawElementPane()
     drawInstructions()
-    displayNodeVoltage()
-    displayWireMode()
-
-# Draws each voltage source, resistor, ground, and 'unsolvable'
-# if it applies
-def drawCircuit():
-    for voltageSource in canvas.data.circuit.voltageSources():
-        drawVoltageSource(*getCenter(voltageSource))
-    for wire in canvas.data.circuit.wires():
-        x1, y1 = wire.src
-        x2, y2 = wire.dest
-        canvas.create_line(x1,y1,x2,y2,fill="yellow")
-
-    if canvas.data.currentWire is not None:
-        x1, y1 = canvas.data.currentWire.src
-        x2, y2 = canvas.data.currentWire.dest
-        canvas.create_line(x1,y1,x2,y2,fill="yellow")
-
-    for resistor in canvas.data.circuit.resistors():
-        drawResistor(*getCenter(resistor))
-    if (canvas.data.circuit.ground):
-        ground = canvas.data.circuit.ground
-        drawGround(ground[0], ground[1])
-    if canvas.data.circuit.unsolvable:
-        font = "helvetica 20"
-        canvas.create_text(250,450,text="UNSOLVABLE",font=font,fill = "red")
-
-# Draws the background and circuit
-def redrawAll():
-    canvas.delete(ALL)
-    background()
-    drawCircuit()
+    status = canvas.data.status
+    status["node"] = canvas.create_text(200,450,font="helvetica 14",fill="red",state=HIDDEN)
+    text = "Wire mode: Click to start a wire, press 'w' to exit"
+    status["wireMode"] = canvas.create_text(200,400,text=text,font="helvetica 14",
+                                            fill="red",state=HIDDEN)
+    status["unsolvable"] = canvas.create_text(250,450,text="UNSOLVABLE",font="helvetica 20",
+                                              fill="red",state=HIDDEN)
+    status["solving"] = canvas.create_text(200,480,font="helvetica 14",fill="red",state=HIDDEN)
+    canvas.data.wireItem = canvas.create_line(0,0,0,0,fill="yellow",state=HIDDEN)
+    canvas.data.dragged = {
+        "voltage": (drawVoltageSource(0,0,"dragged"), (0,0)),
+        "resistor": (drawResistor(0,0,"dragged"), (0,0))}
+
+# Draws every circuit element in view that isn't drawn yet and deletes the
+# items of the ones that are gone or out of view. Only called after the
+# circuit or the view changed.
+def syncCircuit():
+    circuit = canvas.data.circuit
+    scale = canvas.data.view[2]
+    wanted = {}
+    (x0, y0), (x1, y1) = toWorld(0, 0), toWorld(400, 500)
+    for element in circuit.spatial.query(x0, y0, x1, y1):
+        kind = {VoltageSource: "source", Wire: "wire", Resistor: "resistor"}.get(kindOf(element))
+        # Sources without a voltage aren't drawn, as in voltageSources()
+        if kind is not None and (kind != "source" or element.voltage):
+            wanted[id(element)] = (kind, element)
+
+    drawn = canvas.data.drawn
+    for key in [key for key in drawn if key not in wanted]:
+        for item in drawn.pop(key)[1]:
+            canvas.delete(item)
+    for key, (kind, element) in wanted.iteritems():
+        if key in drawn:
+            continue
+        cx, cy = toScreen(*getCenter(element))
+        if kind == "source":
+            items = drawVoltageSource(cx,cy,"circuit",scale)
+        elif kind == "wire":
+            items = drawWire(element,"circuit")
+        else:
+            items = drawResistor(cx,cy,("circuit","resistor"),scale)
+        # The element is kept so its id stays unique while it's drawn
+        drawn[key] = (element, items)
+
+    # Named grounds, like the "0" of a netlist, aren't on the grid. Neither
+    # are the elements on named nodes, which the spatial index leaves out
+    ground = circuit.ground
+    if ground != canvas.data.drawnGround:
+        canvas.delete("ground")
+        if point(ground) is not None:
+            x, top = toScreen(*ground)
+            drawGround(x, top, scale)
+        canvas.data.drawnGround = ground
+
+    # Keep the original stacking: resistors over wires, then the ground and
+    # the panes, which hide elements partly in view, then the wire being
+    # drawn, the status texts and whatever is being dragged
+    canvas.tag_raise("resistor")
+    canvas.tag_raise("ground")
+    canvas.tag_raise("pane")
+    canvas.tag_raise("instructions")
+    canvas.tag_raise(canvas.data.wireItem)
+    for item in canvas.data.status.itervalues():
+        canvas.tag_raise(item)
+    canvas.tag_raise("dragged")
+
+# Moves the dragged elements to where they were last put
+def placeDragged():
+    for name, position in (("voltage", canvas.data.clickedVoltage),
+                           ("resistor", canvas.data.clickedResistor)):
+        items, (x, y) = canvas.data.dragged[name]
+        if position != (x, y):
+            for item in items:
+                canvas.move(item, position[0] - x, position[1] - y)
+            canvas.data.dragged[name] = (items, position)
+
+def placeCurrentWire():
+    wire = canvas.data.currentWire
+    if wire is None:
+        configure(canvas.data.wireItem, state=HIDDEN)
+    else:
+        x1, y1 = toScreen(*wire.src)
+        x2, y2 = toScreen(*wire.dest)
+        setCoords(canvas.data.wireItem, (x1, y1, x2, y2))
+        configure(canvas.data.wireItem, state=NORMAL)
+
+# Shows, hides and rewrites the status texts
+def updateStatus():
+    circuit = canvas.data.circuit
+    status = canvas.data.status
+    configure("pane", state=shown(canvas.data.showElementPane))
+    configure(status["solved"], state=shown(canvas.data.showElementPane and circuit.solved))
+    configure(status["wireMode"], state=shown(canvas.data.drawWire))
+    configure(status["unsolvable"], state=shown(circuit.unsolvable))
+    text = "Solving..." if solver.busy else "Live solving" if canvas.data.liveSolve else ""
+    configure(status["solving"], text=text, state=shown(text != ""))
+    text = nodeVoltageText()
+    configure(status["node"], text=text or "", state=shown(text is not None))
+
+def shown(visible):
+    return NORMAL if visible else HIDDEN
+
+# Item options and coordinates last given to the canvas, so unchanged ones
+# aren't sent to Tk again
+def configure(item, **options):
+    last = canvas.data.options.setdefault(item, {})
+    changed = dict((k, v) for k, v in options.iteritems() if last.get(k) != v)
+    if changed:
+        canvas.itemconfigure(item, **changed)
+        last.update(changed)
+
+def setCoords(item, coords):
+    if canvas.data.options.setdefault(item, {}).get("coords") != coords:
+        canvas.coords(item, *coords)
+        canvas.data.options[item]["coords"] = coords
+
+# Brings the canvas up to date after an input event
+def refresh():
+    if canvas.data.circuitChanged:
+        syncCircuit()
+        canvas.data.circuitChanged = False
+    placeDragged()
+    placeCurrentWire()
+    updateStatus()
+
+# Marks the circuit's elements for syncing at the next refresh
+def circuitChanged():
+    canvas.data.circuitChanged = True
+
+# After the circuit was edited: a solve in progress is out of date, and in
+# live mode a new one is due
+def circuitEdited():
+    circuitChanged()
+    solver.cancel()
+    if canvas.data.liveSolve:
+        scheduleSolve()
+
+#################################################################
+## Solving in the background (startSolve, pollSolve, scheduleSolve)
+#################################################################
+
+# Starts solving the circuit, unless it was solved before this session
+def startSolve():
+    cancelJob("solveJob")
+    circuit = canvas.data.circuit
+    if circuit.canonicalHash() in solutionCache:
+        solver.cancel()
+        circuit.solve()
+        solveFinished()
+        return
+    solver.submit(circuit)
+    cancelJob("pollJob")
+    canvas.data.pollJob = canvas.after(POLL_MS, pollSolve)
+
+# Checks on the solve in progress until it's done
+def pollSolve():
+    canvas.data.pollJob = None
+    if solver.poll():
+        solveFinished()
+    elif solver.busy:
+        canvas.data.pollJob = canvas.after(POLL_MS, pollSolve)
+    refresh()
+
+# Shows the new voltage of the node on display
+def solveFinished():
+    nodeLocation = canvas.data.displayedNode[0]
+    nodes = canvas.data.circuit.nodes
+    if nodeLocation in nodes:
+        canvas.data.displayedNode = (nodeLocation,nodes[nodeLocation].voltage)
+
+# Solves once edits stop coming for DEBOUNCE_MS
+def scheduleSolve():
+    cancelJob("solveJob")
+    canvas.data.solveJob = canvas.after(DEBOUNCE_MS, solveLater)
+
+def solveLater():
+    canvas.data.solveJob = None
+    startSolve()
+    refresh()
+
+def cancelJob(name):
+    job = getattr(canvas.data, name)
+    if job is not None:
+        canvas.after_cancel(job)
+        setattr(canvas.data, name, None)
+
+#################################################################
+## The view (toScreen, toWorld, pan, zoom)
+#################################################################
+
+# canvas.data.view is the circuit location at the top left corner of the
+# canvas and the zoom, in screen pixels per circuit unit
+
+def toScreen(x,y):
+    left, top, scale = canvas.data.view
+    return ((x - left)*scale, (y - top)*scale)
+
+def toWorld(x,y):
+    left, top, scale = canvas.data.view
+    return (int(round(left + x/float(scale))), int(round(top + y/float(scale))))
+
+# Moves the view by dx, dy screen pixels. The drawn elements are moved
+# along, and the ones coming into view drawn at the next refresh
+def pan(dx,dy):
+    left, top, scale = canvas.data.view
+    canvas.data.view = (left + int(round(dx/float(scale))), top + int(round(dy/float(scale))), scale)
+    x, y = toScreen(left, top)
+    canvas.move("circuit", x, y)
+    canvas.move("ground", x, y)
+    circuitChanged()
+
+# Zooms one level in (steps 1) or out (-1), keeping the circuit location
+# under the screen point x, y in place
+def zoom(steps,x,y):
+    left, top, scale = canvas.data.view
+    level = min(max(ZOOMS.index(scale) + steps, 0), len(ZOOMS) - 1)
+    if ZOOMS[level] == scale:
+        return
+    wx, wy = toWorld(x,y)
+    newScale = ZOOMS[level]
+    resetView((wx - int(round(x/float(newScale))), wy - int(round(y/float(newScale))), newScale))
+
+# Sets the view and deletes every drawn element, to be drawn again at the
+# next refresh
+def resetView(view):
+    canvas.data.view = view
+    canvas.delete("circuit")
+    canvas.delete("ground")
+    canvas.data.drawn = {}
+    canvas.data.drawnGround = None
+    circuitChanged()
 
 #################################################################
 ## General helper functions
@@ -319,14 +583,19 @@ def isResistor(x,y):
 # After the circuit is solved, checks which node the user selects
 # and stores that node's location and voltage into a display variable
 def isNode(x,y):
-    nodes = canvas.data.circuit.nodes
-    for node in canvas.data.circuit.nodes:
-        # allows for leeway in where the user clicks
-        if node[0] in range(x-CELL_SIZE,x + CELL_SIZE):
-            if node[1] in range(y-CELL_SIZE,y + CELL_SIZE):
-                canvas.data.displayedNode = (node,nodes[node].voltage)
-                return canvas.data.displayedNode
-    return False
+    circuit = canvas.data.circuit
+    scale = canvas.data.view[2]
+    # allows for leeway in where the user clicks
+    node = circuit.spatial.nodeAt(*toWorld(x,y), tolerance=(CELL_SIZE - 1)/float(scale))
+    if node is None:
+        return False
+    canvas.data.displayedNode = (node,circuit.nodes[node].voltage)
+    return canvas.data.displayedNode
+
+# The element drawn under the screen point x, y, or None
+def isElement(x,y):
+    scale = canvas.data.view[2]
+    return canvas.data.circuit.spatial.elementAt(*toWorld(x,y), tolerance=CELL_SIZE/2/float(scale))
 
 # Uses the "closest bus stop" solution to snap the pieces to the nodes
 def snapToGrid(x,y):
@@ -335,14 +604,21 @@ def snapToGrid(x,y):
     snappedY = ((y + a)/CELL_SIZE)*CELL_SIZE
     return snappedX,snappedY
 
+# The grid point of the circuit closest to the screen point x, y
+def gridPoint(x,y):
+    return snapToGrid(*toWorld(x,y))
+
 #################################################################
 ## Initialize canvas.data and run
 #################################################################
 
 def init():
+    solver.cancel()
     canvas.data.circuit = Circuit()
+    canvas.data.circuit.cache = solutionCache
+    attach(canvas.data.circuit)
     visualElementInit()
-    background()
+    resetView((0, 0, 1))
 
 def visualElementInit():
     canvas.data.showElementPane = True
@@ -356,8 +632,22 @@ def visualElementInit():
     canvas.data.draggingGround = False
     canvas.data.drawWire = False
     canvas.data.displayedNode = OFFSCREEN
+    canvas.data.displayedElement = None
     canvas.data.currentWire = None
 
+# Canvas items kept between events
+def sceneInit():
+    canvas.data.drawn = {}
+    canvas.data.drawnGround = None
+    canvas.data.status = {}
+    canvas.data.options = {}
+    canvas.data.view = (0, 0, 1)
+    canvas.data.liveSolve = False
+    canvas.data.solveJob = None
+    canvas.data.pollJob = None
+    canvas.data.circuitChanged = True
+    background()
+
 def run():
     #  create the root and the canvas
     global canvas
@@ -370,13 +660,16 @@ def run():
     #  Set up canvas data and call init
     class Struct: pass
     canvas.data = Struct()
+    sceneInit()
     init()
-    redrawAll()
+    refresh()
     #  set up keyPressed
     root.bind("<Button-1>", mousePressed)
     root.bind("<Key>", keyPressed)
     root.bind("<Motion>",motion)
-    timerFired()
+    root.bind("<MouseWheel>",mouseWheel)
+    root.bind("<Button-4>",mouseWheel)
+    root.bind("<Button-5>",mouseWheel)
     root.mainloop()
 
 run()
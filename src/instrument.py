@@ -0,0 +1,164 @@
+""" Optional instrumentation of the solver: how long each phase of a solve took
+and the size of the system it solved, sent to a pluggable sink.
+
+    instrument.enable(JsonTraceSink("trace.jsonl"), condition=True, rank=True)
+    circuit.solve()
+    instrument.disable()
+
+Each solve or sweep sends the sink one event, a dict like
+
+    {"event": "solve", "phases": {"indexing": 0.01, "assembly": 0.02, ...},
+     "counters": {"unknowns": 1000, "nonzeros": 4800, ...}}
+
+Phases are indexing (nodes to matrix columns), assembly (stamping the
+matrix), ordering (a fill reducing order, when worked out apart from the
+factorization), factorization (LU elimination) and substitution (the
+triangular solves), or for circuits solved iteratively, preconditioner
+(setting up multigrid) and iteration (conjugate gradients). A matrix that
+can't be factored counts as singular, and its rankDeficiency is the number
+of its rows that depend on the others. While disabled, which is the
+default, every hook returns at once and nothing is timed or counted. """
+
+import json
+import logging
+import time
+
+####################################################
+## Turning it on and off
+####################################################
+
+# Where events go, None while disabled
+_sink = None
+_options = {}
+# Trace of the solve in progress
+_trace = None
+
+def enable(sink, condition=False, rank=False):
+    """ Sends an event per solve to sink, any callable taking the event dict.
+    With condition, the factorization also estimates the 1-norm condition
+    number of the matrix, which costs a few extra solves. With rank, a
+    singular matrix's rank deficiency is counted, which takes a dense copy """
+    global _sink, _options
+    _sink = sink
+    _options = {"condition": condition, "rank": rank}
+
+def disable():
+    global _sink, _trace
+    _sink = None
+    _trace = None
+
+def enabled():
+    return _sink is not None
+
+def wants(option):
+    """ Whether an optional, costly measurement was asked for """
+    return _sink is not None and _options.get(option, False)
+
+####################################################
+## Hooks called by the solver
+####################################################
+
+class Trace(object):
+    """ Phase times and counters of one solve """
+
+    def __init__(self, event):
+        self.event = event
+        self.phases = {}
+        self.counters = {}
+
+    def toDict(self):
+        return {"event": self.event, "phases": self.phases, "counters": self.counters}
+
+class Phase(object):
+    """ Adds the time spent inside a with block to a phase of the trace """
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        phases = self.trace.phases
+        phases[self.name] = phases.get(self.name, 0.0) + time.time() - self.start
+
+class _Nothing(object):
+    """ Stands in for a Phase while disabled """
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc):
+        pass
+
+_NOTHING = _Nothing()
+
+def begin(event):
+    """ Starts the trace of a solve, unless one is already going (a sweep that
+    solves, say) or instrumentation is off. Returns what to pass to end() """
+    global _trace
+    if _sink is None or _trace is not None:
+        return None
+    _trace = Trace(event)
+    return _trace
+
+def end(trace):
+    """ Finishes a trace from begin() and sends it to the sink """
+    global _trace
+    if trace is None or trace is not _trace:
+        return
+    _trace = None
+    if _sink is not None:
+        _sink(trace.toDict())
+
+def phase(name):
+    """ with phase("assembly"): ... times the block as part of the current trace """
+    if _trace is None:
+        return _NOTHING
+    return Phase(_trace, name)
+
+def count(name, value):
+    """ Records a counter of the current trace, replacing any earlier value """
+    if _trace is not None:
+        _trace.counters[name] = value
+
+def add(name, value=1):
+    """ Adds to a counter of the current trace """
+    if _trace is not None:
+        _trace.counters[name] = _trace.counters.get(name, 0) + value
+
+####################################################
+## Sinks
+####################################################
+
+class LogSink(object):
+    """ Writes each event to a logger, as JSON """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger("circuit")
+        self.level = level
+
+    def __call__(self, event):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s", json.dumps(event, sort_keys=True))
+
+class JsonTraceSink(object):
+    """ Appends each event to a file as a line of JSON """
+
+    def __init__(self, filename):
+        self.file = open(filename, "a")
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event, sort_keys=True) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ListSink(object):
+    """ Keeps every event in a list, for looking at them from code """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
@@ -1,70 +1,440 @@
 """ Matrix math """
 
-from numpy import linalg
-from pprint import pprint as pp
+import numpy as np
+import instrument
+from graph import bandOrder
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+
 #################################################################
-## Matrix functions to solve a system of linear equations: Ax = b
+## Sparse matrix functions to solve a system of linear equations: Ax = b
 #################################################################
 
-#Slightly modified from RosettaCode
-#Url: http://rosettacode.org/wiki/Reduced_row_echelon_form#Python
-
-#Destructive function that row-reduces a matrix into echelon form
-def RREF(M):
-    if not M: return
-    lead = 0
-    rowCount = len(M)
-    columnCount = len(M[0])
-    for r in range(rowCount):
-        if lead >= columnCount:
-            return
-        i = r
-        while M[i][lead] == 0:
-            i += 1
-            if i == rowCount:
-                i = r
-                lead += 1
-                if columnCount == lead:
-                    return
-        M[i],M[r] = M[r],M[i]
-        lv = M[r][lead]
-        M[r] = [ mrx / lv for mrx in M[r]]
-        for i in range(rowCount):
-            if i != r:
-                lv = M[i][lead]
-                M[i] = [ iv - lv*rv for rv,iv in zip(M[r],M[i])]
-        lead += 1
-    return M
-
-def isNonZero(x):
-    return abs(x) > 0.0001
-
-def clearZeroRows(M):
-    return [row for row in M if any(map(isNonZero, row))]
-
-def clearZeroCols(M):
-    transpose = zip(*M)[0]
-    noZeros = clearZeroRows(map(list, transpose))
-    return map(list, zip(*noZeros))
-
-#Goes through all steps to remove redundant equations and solve Ax = b
-def solveMatrix(A):
-    RREF(A)
-
-    pp(A)
-    # Clear out empty equations
-    noZeroRows = clearZeroRows(A)
-
-    # Solution is the last column in the matrix
-    solutionVector = [[row[-1]] for row in noZeroRows]
-    coefficientMatrix = clearZeroCols([[row[:-1]] for row in noZeroRows])
-    pp(coefficientMatrix)
-    pp(solutionVector)
-    # Solve and return as python list
+# Builds a sparse matrix from (row, col, value) triplets, square unless
+# the number of columns is given. Duplicate entries are summed, which is
+# what stamping element after element into the same node row expects.
+def buildMatrix(rows, cols, vals, dim, width=None):
+    shape = (dim, dim if width is None else width)
+    coo = sparse.coo_matrix((vals, (rows, cols)), shape=shape)
+    # SuperLU wants compressed columns
+    return coo.tocsc()
+
+# Factors A once so it can be reused for any number of right hand sides.
+# ordering is SuperLU's fill reducing column ordering, "NATURAL" for a
+# matrix whose rows and columns are already in a good order. Given position,
+# row and column i of A are moved to position[i] and factored in that order.
+# Returns None if the matrix is singular.
+def factorMatrix(A, ordering="COLAMD", position=None):
     try:
-        matrixAnswer = linalg.solve(coefficientMatrix,solutionVector)
-    except linalg.LinAlgError as e:
-        print e
+        with instrument.phase("factorization"):
+            factor = Factorization(A, ordering, position)
+    except RuntimeError:
+        instrument.add("singular")
+        # SuperLU stops at the first zero pivot, so how many rows are
+        # dependent takes a dense rank, only worked out when asked for
+        if instrument.wants("rank"):
+            instrument.count("rankDeficiency", A.shape[0] - np.linalg.matrix_rank(A.toarray()))
+        return None
+    instrument.add("factorizations")
+    # SuperLU copies its factors out each time L or U is read
+    if instrument.enabled():
+        instrument.count("factorNonzeros", factor.lu.L.nnz + factor.lu.U.nnz)
+    if instrument.wants("condition"):
+        instrument.count("condition", factor.condition())
+    return factor
+
+# Solves Ax = b with a sparse direct factorization.
+# Returns the solution as a numpy array, or None if A is singular.
+def solveMatrix(A, b):
+    factor = factorMatrix(A)
+    if factor is None:
+        return None
+    return factor.solve(b)
+
+class Factorization(object):
+    """ Sparse LU factors of a base matrix A, kept around for later solves """
+
+    def __init__(self, A, ordering="COLAMD", position=None):
+        self.A = A
+        if position is None:
+            self.lu = _splu(A, ordering)
+        else:
+            self.lu = PermutedLU(_splu(permute(A, position), "NATURAL"), position)
+
+    def solve(self, b, U=None, d=None, transpose=False):
+        """ Solves (A + U diag(d) U^T) x = b, or Ax = b if there is no update.
+        With transpose, solves the transposed system instead.
+
+        The update is applied with the Woodbury identity, so changing k entries
+        of d costs k extra triangular solves instead of a new factorization.
+        Returns None if the system is singular. """
+        trans = "T" if transpose else "N"
+        with instrument.phase("substitution"):
+            x = self.lu.solve(b, trans)
+            if U is not None and len(d):
+                Z = self.lu.solve(U.toarray(), trans)
+                S = np.eye(len(d)) + d[:, None] * U.T.dot(Z)
+                try:
+                    x = x - Z.dot(np.linalg.solve(S, d * U.T.dot(x)))
+                except np.linalg.LinAlgError:
+                    instrument.add("singular")
+                    # With A nonsingular, the update loses as much rank as S
+                    if instrument.enabled():
+                        instrument.count("rankDeficiency", len(d) - np.linalg.matrix_rank(S))
+                    return None
+        # Nearly singular systems factor fine but blow up on the solve
+        if not np.all(np.isfinite(x)):
+            return None
+        return x
+
+    def solveBatch(self, b, E, V, U, D):
+        """ Solves a batch of systems (A + U diag(D[i]) U^T) x_i = b + E V[i] at once.
+
+        Row i of V and D describes point i of the batch, and the solutions are
+        returned as the columns of a matrix. Since the right hand side is linear
+        in V, each column of E costs a single solve however many points there
+        are. The small Woodbury systems of all points are stacked and solved
+        together. Points whose system is singular come back as NaN. """
+        with instrument.phase("substitution"):
+            return self._solveBatch(b, E, V, U, D)
+
+    def _solveBatch(self, b, E, V, U, D):
+        X = np.repeat(self.lu.solve(b)[:, None], len(V), axis=1)
+        if E.shape[1]:
+            X += self.lu.solve(E.toarray()).dot(V.T)
+        if not U.shape[1]:
+            return X
+
+        Z = self.lu.solve(U.toarray())
+        S = np.eye(U.shape[1]) + D[:, :, None] * U.T.dot(Z)[None, :, :]
+        r = D * U.T.dot(X).T
+        try:
+            corrections = np.linalg.solve(S, r[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            corrections = np.empty_like(r)
+            for i in range(len(r)):
+                try:
+                    corrections[i] = np.linalg.solve(S[i], r[i])
+                except np.linalg.LinAlgError:
+                    corrections[i] = np.nan
+        return X - Z.dot(corrections.T)
+
+    def condition(self):
+        """ Estimate of the 1-norm condition number of A, from a few solves
+        with the factors rather than the inverse """
+        n = self.A.shape[0]
+        inverse = splinalg.LinearOperator((n, n), matvec=self.lu.solve, dtype=float,
+                                          rmatvec=lambda x: self.lu.solve(x, trans="T"))
+        return float(splinalg.norm(self.A, 1) * splinalg.onenormest(inverse))
+
+class PermutedLU(object):
+    """ LU factors of a matrix laid out with row and column i moved to
+    position[i], solving systems of the matrix as it was """
+
+    def __init__(self, lu, position):
+        self._lu = lu
+        self.position = position
+        self.perm_c = lu.perm_c
+
+    # Copies of the factors, made when asked for as SuperLU makes them
+    @property
+    def L(self):
+        return self._lu.L
+
+    @property
+    def U(self):
+        return self._lu.U
+
+    def solve(self, b, trans="N"):
+        y = np.empty_like(b)
+        y[self.position] = b
+        return self._lu.solve(y, trans)[self.position]
+
+def permute(A, position):
+    """ A with row and column i moved to position[i], in compressed columns """
+    order = np.empty_like(position)
+    order[position] = np.arange(len(position))
+    return A.tocsr()[order][:, order].tocsc()
+
+def _splu(A, ordering):
+    # Every ordering but COLAMD orders rows and columns alike, which only
+    # holds if the pivots stay on the diagonal
+    if ordering == "COLAMD":
+        return splinalg.splu(A, permc_spec=ordering)
+    return splinalg.splu(A, permc_spec=ordering, diag_pivot_thresh=DIAGONAL_PIVOT,
+                         options=dict(SymmetricMode=True))
+
+#################################################################
+## Fill reducing orderings
+#################################################################
+
+# How a circuit's matrix is ordered before it is factored. "mmd" is minimum
+# degree on the pattern of A + A^T, which suits nodal matrices: they are
+# symmetric but for the voltage source rows. "rcm" is reverse Cuthill-McKee,
+# which keeps the factors within a narrow band, and only does as well on
+# chains like ladders. "colamd" is SuperLU's ordering for unsymmetric
+# matrices, worked out again for every factorization.
+ORDERINGS = ("mmd", "rcm", "colamd")
+DEFAULT_ORDERING = "mmd"
+# A diagonal entry stays the pivot unless the column has an entry this many
+# times bigger than it
+DIAGONAL_PIVOT = 0.1
+
+class Ordering(object):
+    """ Fill reducing order of the rows and columns of matrices sharing one
+    pattern, like a circuit's matrix between edits. The first factorization
+    works it out and the rest reuse it, skipping that step """
+
+    def __init__(self, method=DEFAULT_ORDERING):
+        if method not in ORDERINGS:
+            raise ValueError("Unknown ordering %r" % method)
+        self.method = method
+        # Where each row and column goes, None until worked out
+        self.position = None
+
+    def factor(self, A):
+        """ Factors A in the order, as factorMatrix does """
+        if self.method == "colamd":
+            return factorMatrix(A)
+        if self.position is None and self.method == "rcm":
+            with instrument.phase("ordering"):
+                self.position = bandOrder(A)
+        if self.position is not None:
+            return factorMatrix(A, position=self.position)
+
+        # SuperLU finds the minimum degree order while it factors. It factors
+        # Pc^T A Pc, and splu reports Pc by where each column went
+        factor = factorMatrix(A, "MMD_AT_PLUS_A")
+        if factor is not None:
+            self.position = factor.lu.perm_c
+        return factor
+
+class StampPattern(object):
+    """ A matrix stamped from the same (row, col) triplets over and over with
+    new values, like the Jacobian of each Newton iteration.
+
+    The compressed column layout is worked out once, so each new matrix is a
+    single scatter of the values. So is the fill reducing ordering: the first
+    factorization works one out, and from then on the rows and columns are
+    laid out already permuted into it, so later factorizations skip that
+    step. ordering is one of ORDERINGS. """
+
+    def __init__(self, rows, cols, size, ordering=DEFAULT_ORDERING):
+        self.size = size
+        self._rows, self._cols = rows, cols
+        self.ordering = Ordering(ordering)
+        self._ordered = False
+        self._layout(np.arange(size))
+
+    def _layout(self, position):
+        """ Lays the triplets out in compressed columns, with row and column i
+        of the matrix moved to position[i] """
+        size = self.size
+        keys = position[self._cols].astype(np.int64) * size + position[self._rows]
+        unique, self._slot = np.unique(keys, return_inverse=True)
+        self._indices = (unique % size).astype(np.int32)
+        self._indptr = np.searchsorted(unique // size, np.arange(size + 1)).astype(np.int32)
+        self._position = position
+
+    def matrix(self, vals):
+        """ The matrix with the given triplet values, in the pattern's layout.
+        Duplicate entries are summed, as in buildMatrix """
+        data = np.bincount(self._slot, vals, len(self._indices))
+        return sparse.csc_matrix((data, self._indices, self._indptr), shape=(self.size, self.size))
+
+    def solve(self, vals, b):
+        """ Factors the matrix with the given triplet values and solves it for b.
+        Returns None if it is singular """
+        if not self._ordered:
+            factor = self.ordering.factor(self.matrix(vals))
+            if factor is None:
+                return None
+            # An ordering worked out anew each time can't be laid out in advance
+            if self.ordering.position is not None:
+                self._layout(self.ordering.position)
+                self._ordered = True
+            return factor.solve(b)
+
+        factor = factorMatrix(self.matrix(vals), "NATURAL")
+        if factor is None:
+            return None
+        y = np.empty_like(b)
+        y[self._position] = b
+        x = factor.solve(y)
+        return x[self._position] if x is not None else None
+
+#################################################################
+## Iterative solution of symmetric positive definite systems
+#################################################################
+
+# Conjugate gradient iterations allowed before giving up
+MAX_CG_ITERATIONS = 1000
+# Multigrid levels are added until one has at most this many unknowns, which
+# is solved directly
+COARSE_SIZE = 1000
+MAX_LEVELS = 20
+# Each level must have at most this fraction of the unknowns of the one above
+MAX_COARSE_RATIO = 0.5
+# Levels stop before all of them together have this many times the nonzeros
+# of the first, and a hierarchy whose coarsest level is still bigger than
+# MAX_COARSE_SIZE is given up on: factoring it would cost more than
+# factoring the whole system
+MAX_COMPLEXITY = 4.0
+MAX_COARSE_SIZE = 10 * COARSE_SIZE
+# Off-diagonal entries weaker than this, relative to their diagonals, don't
+# join two unknowns into the same aggregate
+STRENGTH = 0.08
+
+def conjugateGradient(A, b, x0=None, tolerance=1e-10, preconditioner=None,
+                      maxIterations=MAX_CG_ITERATIONS):
+    """ Solves the symmetric positive definite system Ax = b by preconditioned
+    conjugate gradients, starting from x0 (zero by default), until the
+    residual is within tolerance of b in 2-norm. preconditioner is a function
+    applying an approximate inverse of A to a vector. Returns None if that
+    takes more than maxIterations """
+    if not np.any(b):
+        return np.zeros(len(b))
+    with instrument.phase("iteration"):
+        x = np.zeros(len(b)) if x0 is None else np.array(x0, dtype=float)
+        r = b - A.dot(x)
+        target = tolerance * np.linalg.norm(b)
+        z = preconditioner(r) if preconditioner is not None else r
+        p = z.copy()
+        rz = r.dot(z)
+        for iteration in xrange(maxIterations + 1):
+            if np.linalg.norm(r) <= target:
+                instrument.count("cgIterations", iteration)
+                return x
+            Ap = A.dot(p)
+            alpha = rz / p.dot(Ap)
+            x += alpha * p
+            r -= alpha * Ap
+            z = preconditioner(r) if preconditioner is not None else r
+            rzNext = r.dot(z)
+            p *= rzNext / rz
+            p += z
+            rz = rzNext
+    instrument.add("diverged")
+    return None
+
+# Builds the multigrid preconditioner of a symmetric positive definite matrix.
+# Returns None if the matrix doesn't coarsen into levels that stay sparse
+# (see MAX_COMPLEXITY) down to MAX_COARSE_SIZE, or the coarsest is singular.
+def multigrid(A):
+    with instrument.phase("preconditioner"):
+        grid = Multigrid(A)
+    return grid if grid.coarse is not None else None
+
+class Multigrid(object):
+    """ Smoothed aggregation multigrid V-cycle, used as the preconditioner of
+    conjugate gradients.
+
+    Each level lumps strongly connected unknowns together into aggregates,
+    which are the unknowns of the next, coarser level. Errors that are smooth
+    across an aggregate are corrected there, and a Jacobi sweep before and
+    after takes care of the rest. The coarse matrices of a mesh take about
+    as much memory as the first one, and never more than MAX_COMPLEXITY
+    times it. Matrices whose coarse levels fill in instead, like meshes with
+    many long links, get no coarse factorization: coarse is None. """
+
+    def __init__(self, A):
+        # (matrix, damped inverse diagonal, prolongation, restriction) per level
+        self.levels = []
+        A = sparse.csr_matrix(A)
+        budget = MAX_COMPLEXITY * A.nnz - A.nnz
+        while A.shape[0] > COARSE_SIZE and len(self.levels) < MAX_LEVELS:
+            weight = _jacobiWeight(A)
+            P = _prolongation(A, weight)
+            if P is None:
+                break
+            R = P.T.tocsr()
+            coarse = R.dot(A).dot(P).tocsr()
+            if coarse.nnz > budget:
+                break
+            budget -= coarse.nnz
+            self.levels.append((A, weight, P, R))
+            A = coarse
+        instrument.count("levels", len(self.levels) + 1)
+        self.coarse = factorMatrix(A.tocsc()) if A.shape[0] <= MAX_COARSE_SIZE else None
+
+    def solve(self, b):
+        return self._cycle(0, b)
+
+    def _cycle(self, level, b):
+        if level == len(self.levels):
+            return self.coarse.lu.solve(b)
+        A, weight, P, R = self.levels[level]
+        x = weight * b
+        x += P.dot(self._cycle(level + 1, R.dot(b - A.dot(x))))
+        x += weight * (b - A.dot(x))
+        return x
+
+def _jacobiWeight(A):
+    """ Damped Jacobi step of each unknown: 4/3 over the spectral radius of
+    D^-1 A, which is bounded by its largest absolute row sum """
+    diagonal = A.diagonal()
+    radius = np.max(abs(A).dot(np.ones(A.shape[0])) / diagonal)
+    return (4.0 / 3 / radius) / diagonal
+
+def _prolongation(A, weight):
+    """ Smoothed aggregation prolongation from the next coarser level, or
+    None if the unknowns don't coarsen enough """
+    n = A.shape[0]
+    aggregate = _aggregates(A)
+    count = aggregate.max() + 1
+    if count > MAX_COARSE_RATIO * n:
         return None
-    else:
-        return [[round(linalg.det([i]),3)] for i in matrixAnswer]
+    sizes = np.bincount(aggregate, minlength=count)
+    T = sparse.csr_matrix((1.0 / np.sqrt(sizes[aggregate]), (np.arange(n), aggregate)), shape=(n, count))
+    return (T - sparse.diags(weight).dot(A.dot(T))).tocsr()
+
+def _aggregates(A):
+    """ Aggregate of each unknown. The roots of the aggregates are a maximal
+    set of unknowns at least three strong connections apart, picked in rounds
+    by random priority. Each root's strong neighbors join it, and then the
+    unknowns left join their strongest aggregated neighbor """
+    n = A.shape[0]
+    coo = A.tocoo()
+    diagonal = np.abs(A.diagonal())
+    strong = (coo.row != coo.col) & \
+        (np.abs(coo.data) >= STRENGTH * np.sqrt(diagonal[coo.row] * diagonal[coo.col]))
+    rows, cols, weights = coo.row[strong], coo.col[strong], np.abs(coo.data[strong])
+    S = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+    def near(mask):
+        return S.dot(mask.astype(float)) > 0
+
+    def highestNeighbor(values):
+        neighbors = sparse.csr_matrix((values[S.indices], S.indices, S.indptr), shape=(n, n))
+        return neighbors.max(axis=1).toarray().ravel()
+
+    # 1 for a root, -1 within two connections of one, 0 undecided. An undecided
+    # unknown with the highest priority of the undecided ones within two
+    # connections, itself included, is a root
+    state = np.zeros(n, dtype=np.int8)
+    priority = np.random.RandomState(0).permutation(n) + 1.0
+    while not np.all(state):
+        undecided = state == 0
+        p = np.where(undecided, priority, 0.0)
+        highest = highestNeighbor(np.maximum(p, highestNeighbor(p)))
+        roots = undecided & (p >= highest)
+        state[roots] = 1
+        first = near(roots)
+        state[undecided & ~roots & (first | near(first))] = -1
+
+    aggregate = np.full(n, -1, dtype=np.int64)
+    roots = state == 1
+    aggregate[roots] = np.arange(roots.sum())
+    for joining in (roots, None):
+        done = aggregate >= 0
+        joins = done[cols] & ~done[rows]
+        if joining is not None:
+            joins &= joining[cols]
+        r, c, w = rows[joins], cols[joins], weights[joins]
+        order = np.lexsort((-w, r))
+        first = np.unique(r[order], return_index=True)[1]
+        aggregate[r[order][first]] = aggregate[c[order][first]]
+    # Only weak connections lead anywhere else, so these go on their own
+    alone = aggregate < 0
+    aggregate[alone] = aggregate.max() + 1 + np.arange(alone.sum())
+    return aggregate
@@ -0,0 +1,197 @@
+""" Monte Carlo tolerance analysis. Element values are drawn from their
+tolerance distributions and the circuit is solved in batches of trials,
+spread across a pool of worker processes. Only running statistics of the
+node voltages are kept, never every trial. """
+
+import multiprocessing
+import numpy as np
+from circuit import Resistor
+
+# Largest batch of trials, and the most node voltages a batch may hold
+MAX_BATCH = 1000
+BATCH_VOLTAGES = 1 << 22
+# Trials kept per node to estimate percentiles, and the most voltages they may hold
+SAMPLE_SIZE = 10000
+SAMPLE_VOLTAGES = 1 << 24
+
+####################################################
+## Tolerance specs
+####################################################
+
+class Tolerance(object):
+    """ Relative tolerance of an element value, e.g. Tolerance(0.05) for 5%.
+
+    A uniform tolerance draws values evenly within nominal * (1 +- tolerance).
+    A normal one draws from a normal distribution with the tolerance at 3 sigma. """
+
+    def __init__(self, tolerance, distribution="uniform"):
+        if distribution not in ("uniform", "normal"):
+            raise ValueError("Unknown distribution %r" % distribution)
+        self.tolerance = tolerance
+        self.distribution = distribution
+
+    def draw(self, nominal, count, random):
+        if self.distribution == "uniform":
+            spread = random.uniform(-1, 1, count)
+        else:
+            spread = random.normal(0, 1.0/3, count)
+        return nominal * (1 + self.tolerance * spread)
+
+####################################################
+## Running statistics
+####################################################
+
+class Statistics(object):
+    """ Per-node statistics of the trials seen so far, in sorted(circuit.nodes) order.
+
+    Mean and standard deviation are exact, and NaN for floating nodes. Percentiles are estimated from a
+    uniform random sample of the trials, so memory stays bounded. """
+
+    def __init__(self, locations, limits=None, seed=None, floating=()):
+        self.locations = locations
+        self.count = 0
+        # Trials whose circuit was singular, left out of everything else
+        self.failed = 0
+        # Trials where every node in limits was within its (low, high) range
+        self.passed = 0
+        self.limits = limits or {}
+        self._limitCols = [locations.index(loc) for loc in self.limits]
+        self._low = np.array([low for low, _ in self.limits.values()])
+        self._high = np.array([high for _, high in self.limits.values()])
+        # Nodes with no path to ground are NaN in every trial, which isn't a failure
+        floating = set(floating)
+        self._grounded = np.array([loc not in floating for loc in locations], dtype=bool)
+
+        n = len(locations)
+        self.mean, self._m2 = np.zeros(n), np.zeros(n)
+        self.min, self.max = np.full(n, np.inf), np.full(n, -np.inf)
+        self._sample = np.empty((max(1, min(SAMPLE_SIZE, SAMPLE_VOLTAGES // max(n, 1))), n))
+        self._random = np.random.RandomState(seed)
+
+    def update(self, batch):
+        """ Adds a batch of trials, one row of node voltages each """
+        solved = np.all(np.isfinite(batch[:, self._grounded]), axis=1)
+        self.failed += len(batch) - solved.sum()
+        batch = batch[solved]
+        if not len(batch):
+            return
+
+        limited = batch[:, self._limitCols]
+        self.passed += np.all((limited >= self._low) & (limited <= self._high), axis=1).sum()
+
+        # Combine the batch's mean and squared deviations with the running ones
+        # (Chan et al.), which stays accurate over millions of trials
+        count, batchCount = self.count, len(batch)
+        batchMean = batch.mean(axis=0)
+        delta = batchMean - self.mean
+        total = count + batchCount
+        self.mean += delta * batchCount / total
+        self._m2 += ((batch - batchMean)**2).sum(axis=0) + delta**2 * count * batchCount / total
+        self.min = np.minimum(self.min, batch.min(axis=0))
+        self.max = np.maximum(self.max, batch.max(axis=0))
+        self.count = total
+
+        # Reservoir sampling: trial t replaces a random slot with probability size/t
+        size = len(self._sample)
+        trial = np.arange(count, total)
+        slots = (self._random.random_sample(len(trial)) * (trial + 1)).astype(int)
+        slots[trial < size] = trial[trial < size]
+        keep = slots < size
+        self._sample[slots[keep]] = batch[keep]
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / max(self.count - 1, 1))
+
+    def yieldFraction(self):
+        """ Fraction of all trials that solved and stayed within the limits """
+        return float(self.passed) / max(self.count + self.failed, 1)
+
+    def percentile(self, q):
+        """ Estimated q-th percentile of each node voltage (q in 0..100, or a
+        list). NaN while no trial has been kept """
+        sample = self._sample[:min(self.count, len(self._sample))]
+        if not len(sample):
+            return np.full(np.shape(q) + sample.shape[1:], np.nan)
+        return np.percentile(sample, q, axis=0)
+
+####################################################
+## Running the trials
+####################################################
+
+def monteCarlo(circuit, tolerances, trials, limits=None, processes=None,
+               batchSize=None, seed=None):
+    """ Runs a Monte Carlo tolerance analysis of the circuit's node voltages.
+
+    tolerances maps each varied Resistor or VoltageSource of the circuit to a
+    Tolerance (a plain number means a uniform one). Its current value is the
+    nominal. limits optionally maps node locations to (low, high) voltages used
+    to count yield. Returns a Statistics, or None if the nominal circuit can't
+    be solved. """
+    if circuit._batchFactor() is None:
+        return None
+    locations = sorted(circuit.nodes)
+    stats = Statistics(locations, limits, seed, [loc for part in circuit.floating for loc in part])
+
+    # Workers get their own copy of the circuit, so elements are sent as their
+    # position in the equation builder's lists, which is the same in the copy
+    specs = []
+    for element, tolerance in tolerances.iteritems():
+        if not isinstance(tolerance, Tolerance):
+            tolerance = Tolerance(tolerance)
+        kind, index = circuit._parameter(element)
+        nominal = element.resistance if kind is Resistor else element.voltage
+        specs.append((kind is Resistor, index, nominal, tolerance))
+
+    if batchSize is None:
+        batchSize = max(1, min(MAX_BATCH, BATCH_VOLTAGES // max(len(locations), 1)))
+    sizes = [batchSize] * (trials // batchSize)
+    if trials % batchSize:
+        sizes.append(trials % batchSize)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, len(sizes))
+    batches = zip(sizes, seeds)
+
+    if processes == 1:
+        _initWorker(circuit, specs)
+        for batch in batches:
+            stats.update(_runBatch(batch))
+        return stats
+
+    # Batches are merged in order, so the reservoir sample, and with it the
+    # percentiles, only depend on the seed
+    pool = multiprocessing.Pool(processes, _initWorker, (circuit, specs))
+    try:
+        for result in pool.imap(_runBatch, batches):
+            stats.update(result)
+    finally:
+        pool.terminate()
+        pool.join()
+    return stats
+
+# State of a worker process, set once by _initWorker
+_worker = {}
+
+def _initWorker(circuit, specs):
+    _worker["circuit"] = circuit
+    _worker["factor"] = circuit._batchFactor()
+    _worker["specs"] = specs
+
+def _runBatch(batch):
+    """ Draws and solves one batch of trials, returning their node voltages """
+    size, seed = batch
+    circuit, specs = _worker["circuit"], _worker["specs"]
+    random = np.random.RandomState(seed)
+
+    resistors, resistances, sources, voltages = [], [], [], []
+    for isResistor, index, nominal, tolerance in specs:
+        values = tolerance.draw(nominal, size, random)
+        if isResistor:
+            resistors.append(index)
+            resistances.append(values)
+        else:
+            sources.append(index)
+            voltages.append(values)
+    resistances = np.array(resistances).reshape(len(resistors), size).T
+    voltages = np.array(voltages).reshape(len(sources), size).T
+
+    return circuit._solvePoints(_worker["factor"], resistors, resistances, sources, voltages)
@@ -0,0 +1,131 @@
+""" Multi-port models: a linear circuit at DC as seen from a few of its nodes,
+the ports, with everything else eliminated.
+
+    model = block.reduce(["in", "out"])
+    model.impedance, model.openVoltages
+    parent.addMultiPort(model, [("amp", 1), ("amp", 2)], reference="0", name="block1")
+
+With v the voltages of the ports, measured from the circuit's ground (the
+reference), and i the currents flowing into the circuit at the ports, a model
+is
+
+    Norton      i = Y v - J     admittance Y, short circuit currents J
+    Thevenin    v = Z i + E     impedance Z, open circuit voltages E
+
+Each form is worked out from the other where it exists. Ports held at their
+voltage by voltage sources have no Norton form, and a circuit that lets
+current flow between the ports without ever reaching ground has no Thevenin
+form. Either form makes a network of resistors and sources that can stand
+in for the circuit in a parent. Both sides of a model only take a few
+ports' worth of memory, however big the circuit it came from, so a block
+that appears many times is best reduced once and added to each parent as
+its model. """
+
+import numpy as np
+
+# Conductances between ports smaller than this, relative to the largest
+# admittance of the model, are left out of its network
+NETWORK_TOLERANCE = 1e-12
+# Models whose matrix is this badly conditioned have no inverse form
+MAX_CONDITION = 1e14
+
+class MultiPort(object):
+    """ Norton and Thevenin forms of a circuit seen from its ports. The forms
+    that don't exist are None """
+
+    def __init__(self, ports, reference, admittance=None, shortCurrents=None,
+                 impedance=None, openVoltages=None):
+        self.ports = list(ports)
+        self.reference = reference
+        if impedance is None and admittance is not None:
+            impedance, openVoltages = _inverse(admittance, shortCurrents)
+        elif admittance is None and impedance is not None:
+            admittance, shortCurrents = _inverse(impedance, openVoltages)
+        self.admittance, self.shortCurrents = admittance, shortCurrents
+        self.impedance, self.openVoltages = impedance, openVoltages
+
+    def __len__(self):
+        return len(self.ports)
+
+    def __str__(self):
+        return "MultiPort: ports %s, reference %s" % (self.ports, self.reference)
+
+    def network(self):
+        """ Resistors and voltage sources behaving like the model at its ports.
+
+        Returns (resistors, sources), lists of (a, b, resistance) and (a, b,
+        voltage) between the nodes of the network: k for port k, -1 for the
+        reference and len(self) + k for a node of its own behind port k. A
+        source's voltage is that of b over a. Raises ValueError if the model
+        has no such network """
+        if self.admittance is not None:
+            return self._nortonNetwork(range(len(self)), self.admittance,
+                                       self.shortCurrents, self.openVoltages)
+        Z, E = self.impedance, self.openVoltages
+        if Z is None:
+            raise ValueError("%s has neither a Norton nor a Thevenin form" % self)
+        self._checkReciprocal(Z)
+
+        # A port held by a source has a zero row of Z, and one held at a fixed
+        # voltage from another port by a source between them has the other's
+        # row. Those get the source, and the rest a network of their own.
+        smallest = NETWORK_TOLERANCE * np.abs(Z).max()
+        free, sources = [], []
+        for k in xrange(len(self)):
+            if np.all(np.abs(Z[k]) <= smallest):
+                sources.append((-1, k, E[k]))
+                continue
+            tied = [f for f in free if np.allclose(Z[k], Z[f], rtol=1e-9, atol=smallest)]
+            if tied:
+                sources.append((tied[0], k, E[k] - E[tied[0]]))
+            else:
+                free.append(k)
+        if not free:
+            return [], sources
+        Y, J = _inverse(Z[np.ix_(free, free)], E[free])
+        if Y is None:
+            raise ValueError("Sources hold the ports of %s in a way resistors and "
+                             "sources between the ports can't model" % self)
+        resistors, inner = self._nortonNetwork(free, Y, J, E[free])
+        return resistors, inner + sources
+
+    def _nortonNetwork(self, ports, Y, J, E):
+        """ network() of the ports, whose admittance is Y, short circuit
+        currents J and open circuit voltages E """
+        self._checkReciprocal(Y)
+        Y = 0.5 * (Y + Y.T)
+        # A singular admittance leaves the open circuit voltages unknown, which
+        # only matters if the circuit has sources of its own
+        if E is None:
+            if np.any(J):
+                raise ValueError("%s has no open circuit voltages to put in series "
+                                 "with its ports" % self)
+            E = np.zeros(len(ports))
+
+        # A resistor joins each pair of ports with admittance between them,
+        # and each port to the reference by what its row of Y leaves over.
+        # Ports with a voltage of their own get it from a source in series,
+        # with the resistors behind it.
+        count = len(ports)
+        smallest = NETWORK_TOLERANCE * np.abs(Y).max()
+        conductance = np.hstack((-Y, Y.sum(axis=1)[:, None]))
+        a, b = np.nonzero(np.abs(conductance) > smallest)
+        keep = (b == count) | (a < b)
+        a, b = a[keep], b[keep]
+        resistance = 1.0 / conductance[a, b]
+        ends = [port + len(self) if voltage else port for port, voltage in zip(ports, E)]
+        ends.append(-1)
+        resistors = [(ends[i], ends[j], r) for i, j, r in zip(a, b, resistance.tolist())]
+        sources = [(port + len(self), port, voltage) for port, voltage in zip(ports, E) if voltage]
+        return resistors, sources
+
+    def _checkReciprocal(self, M):
+        if len(M) and not np.allclose(M, M.T, rtol=1e-9, atol=NETWORK_TOLERANCE * np.abs(M).max()):
+            raise ValueError("%s isn't reciprocal, which resistors can't model" % self)
+
+def _inverse(matrix, vector):
+    """ (M^-1, M^-1 v), or (None, None) if M is singular """
+    if len(matrix) and np.linalg.cond(matrix) > MAX_CONDITION:
+        return None, None
+    inverse = np.linalg.inv(matrix)
+    return inverse, inverse.dot(vector)
@@ -0,0 +1,280 @@
+""" Reading and writing circuits as SPICE-like text netlists.
+
+One element per line, the first letter of its name giving the kind:
+
+    * comment
+    R1 a b 4.7k          resistor between nodes a and b
+    V1 plus minus 5      voltage source, plus is 5 volts above minus
+    W1 a b 0             wire, the 0 is optional
+    C1 a b 10u           capacitor
+    L1 a b 1m            inductor
+    D1 a b 1e-14         diode from anode a to cathode b, with its saturation current
+    .ground minus
+    .end
+
+Nodes are names, or grid coordinates written as "x,y". Without a .ground
+line, node 0 is ground as in SPICE. Unlike SPICE, the first line is not a
+title. Both directions stream: lines are parsed in batches and added to the
+circuit as they go, so memory doesn't grow with the size of the file. """
+
+import re
+from itertools import islice
+import numpy as np
+from circuit import Resistor, VoltageSource, Wire, Capacitor, Inductor, Diode, kindCode, \
+                    valueOf, RESISTOR, VOLTAGE_SOURCE, WIRE, CAPACITOR, INDUCTOR, NONLINEAR, \
+                    REMOVED
+from compact import CompactCircuit
+
+# Lines parsed before they are added to the circuit
+BATCH_SIZE = 65536
+# Marks the end of each line when a whole batch is split at once
+LINE_END = "\0"
+
+KINDS = {"R": RESISTOR, "V": VOLTAGE_SOURCE, "W": WIRE, "C": CAPACITOR, "L": INDUCTOR,
+         "D": NONLINEAR}
+LETTERS = dict((kind, letter) for letter, kind in KINDS.items())
+# SPICE value scales, plus "meg" for 1e6
+SCALES = {"t": 1e12, "g": 1e9, "k": 1e3, "m": 1e-3, "u": 1e-6, "n": 1e-9,
+          "p": 1e-12, "f": 1e-15}
+VALUE = re.compile(r"^([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)([a-z]*)$")
+
+####################################################
+## Reading
+####################################################
+
+def load(filename, circuit=None):
+    """ Reads a netlist file into circuit, a new CompactCircuit by default """
+    with open(filename, "r") as f:
+        return read(f, circuit)
+
+def read(lines, circuit=None):
+    """ Reads netlist lines (a file or any iterable of strings) into circuit,
+    a new CompactCircuit by default, and returns it """
+    if circuit is None:
+        circuit = CompactCircuit()
+    reader = Reader(circuit)
+    lines = iter(lines)
+    while reader.addLines(list(islice(lines, BATCH_SIZE))):
+        pass
+    return reader.finish()
+
+class Reader(object):
+    """ Reads a netlist into a circuit a batch of lines at a time.
+
+    Each batch is split into columns and handled with whole-column operations:
+    node names are looked up in one pass, values converted by numpy, and
+    compact circuits get the batch as arrays. """
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.ground = None
+        self.lineCount = 0
+        # Node name as written -> node index (compact circuits) or location
+        self._nodes = dict()
+        self._compact = isinstance(circuit, CompactCircuit)
+
+    def addLines(self, lines):
+        """ Adds a batch of lines. Returns False at the end of the netlist """
+        first = self.lineCount + 1
+        self.lineCount += len(lines)
+        if self._addColumns(lines, first):
+            return True
+
+        rows = [line.split() for line in lines]
+        rows = [r for r in rows if r]
+        ended = not lines
+
+        # Comments and directives are rare, so only then go line by line
+        if [r for r in rows if r[0][0] in "*."]:
+            elements = []
+            for r in rows:
+                word = r[0].lower()
+                if word == ".end":
+                    ended = True
+                    break
+                elif word == ".ground" and len(r) == 2:
+                    self.ground = parseNode(r[1])
+                elif word == ".ground":
+                    self._fail(lines, first)
+                elif word[0] not in "*.":
+                    elements.append(r)
+            rows = elements
+
+        # Wires may leave out their value
+        rows = [r + ["0"] if len(r) == 3 and r[0][0] in "wW" else r for r in rows]
+        if [r for r in rows if len(r) != 4]:
+            self._fail(lines, first)
+        if rows:
+            self._addRows(zip(*rows), lines, first)
+        return not ended
+
+    def _addColumns(self, lines, first):
+        """ Fast path for a batch of plain four field element lines. The whole
+        batch is split at once, with a marker after each line to check that every
+        line really had four fields. Returns False if the batch doesn't qualify """
+        fields = (" %s " % LINE_END).join(lines).split()
+        fields.append(LINE_END)
+        if len(fields) != 5 * len(lines) or fields[4::5].count(LINE_END) != len(lines):
+            return False
+        letters = np.char.upper(np.array(fields[0::5], dtype="S1"))
+        if not np.all(np.in1d(letters, KINDS.keys())):
+            return False
+        self._addRows((fields[0::5], fields[1::5], fields[2::5], fields[3::5]), lines, first)
+        return True
+
+    def _addRows(self, columns, lines, first):
+        """ Adds elements given as columns of names, nodes, nodes and values """
+        names, a, b, values = columns
+        letters = np.char.upper(np.array(names, dtype="S1"))
+        kinds = np.select([letters == letter for letter in KINDS], KINDS.values(), -1)
+        if np.any(kinds < 0):
+            self._fail(lines, first)
+        values = self._values(values, lines, first)
+        values[kinds == WIRE] = 0.0
+        self._addElements(kinds, kinds == VOLTAGE_SOURCE, a, b, values)
+
+    def finish(self):
+        """ Sets the ground and returns the circuit """
+        if self.ground is None and "0" in self.circuit.nodes:
+            self.ground = "0"
+        if self.ground is not None:
+            self.circuit.addGround(self.ground)
+        return self.circuit
+
+    def _addElements(self, kinds, isSource, a, b, values):
+        # Voltage sources are written plus node first, but run src (minus) to dest (plus)
+        a, b = self._lookup(a), self._lookup(b)
+        if self._compact:
+            a, b = np.array(a), np.array(b)
+            self.circuit.addElements(kinds, np.where(isSource, b, a), np.where(isSource, a, b), values)
+            return
+        for kind, x, y, value in zip(kinds, a, b, values.tolist()):
+            if kind == RESISTOR:
+                self.circuit.addElement(Resistor(x, y, value))
+            elif kind == VOLTAGE_SOURCE:
+                self.circuit.addElement(VoltageSource(y, x, value))
+            elif kind == CAPACITOR:
+                self.circuit.addElement(Capacitor(x, y, value))
+            elif kind == INDUCTOR:
+                self.circuit.addElement(Inductor(x, y, value))
+            elif kind == NONLINEAR:
+                self.circuit.addElement(Diode(x, y, value))
+            else:
+                self.circuit.addElement(Wire(x, y))
+
+    def _lookup(self, names):
+        """ Node of each name, adding the ones not seen before """
+        new = list(set(names).difference(self._nodes))
+        for name, location in zip(new, parseNodes(new)):
+            self._nodes[name] = self.circuit.addNode(location) if self._compact else location
+        return map(self._nodes.__getitem__, names)
+
+    def _values(self, fields, lines, first):
+        try:
+            return np.array(fields).astype(float)
+        except ValueError:
+            pass
+        # Some have a scale suffix or unit
+        try:
+            return np.array([parseValue(field) for field in fields])
+        except ValueError:
+            self._fail(lines, first)
+
+    def _fail(self, lines, first):
+        """ Raises a ValueError naming the first bad line of a batch """
+        for number, line in enumerate(lines, first):
+            fields = line.split()
+            if not fields or fields[0][0] == "*" or fields[0].lower() == ".end":
+                continue
+            if fields[0].lower() == ".ground":
+                if len(fields) != 2:
+                    raise ValueError("line %d: expected .ground <node>" % number)
+                continue
+            if fields[0][0] == ".":
+                continue
+            kind = KINDS.get(fields[0][0].upper())
+            if kind is None or len(fields) not in ((3, 4) if kind == WIRE else (4,)):
+                raise ValueError("line %d: can't read %r" % (number, line.strip()))
+            if len(fields) == 4:
+                parseValue(fields[3], number)
+        raise ValueError("lines %d-%d: can't read netlist" % (first, first + len(lines) - 1))
+
+def parseNode(field):
+    """ "x,y" is a grid location, anything else a node name """
+    if "," in field:
+        return tuple(map(int, field.split(",")))
+    return field
+
+def parseNodes(fields):
+    """ parseNode of each field, converting them all at once when they are all x,y """
+    coordinates = ",".join(fields).split(",")
+    if len(coordinates) == 2 * len(fields) and all("," in field for field in fields):
+        numbers = np.fromstring(" ".join(coordinates), dtype=int, sep=" ")
+        # fromstring stops quietly at the first bad number, so count them
+        if len(numbers) == len(coordinates):
+            return zip(numbers[0::2].tolist(), numbers[1::2].tolist())
+    return map(parseNode, fields)
+
+def parseValue(field, number=0):
+    """ Reads a number with an optional SPICE scale suffix and unit, e.g. 4.7k or 10megohm """
+    try:
+        return float(field)
+    except ValueError:
+        pass
+    match = VALUE.match(field.lower())
+    if match is None:
+        raise ValueError("line %d: can't read value %r" % (number, field))
+    value, letters = match.groups()
+    if letters.startswith("meg"):
+        return float(value) * 1e6
+    # Letters that aren't a scale are just a unit, as in 5v
+    return float(value) * SCALES.get(letters[:1], 1.0)
+
+####################################################
+## Writing
+####################################################
+
+def save(circuit, filename):
+    with open(filename, "w") as f:
+        write(circuit, f)
+
+def write(circuit, f):
+    """ Writes circuit as a netlist to the file object f. Elements are named
+    by their kind letter and position, e.g. R12 """
+    f.write("* Circuit Solver netlist\n")
+    for kinds, src, dest, values, first in _batches(circuit):
+        lines = []
+        for i, (kind, a, b, value) in enumerate(zip(kinds, src, dest, values), first):
+            if kind == WIRE:
+                lines.append("W%d %s %s 0\n" % (i, a, b))
+            elif kind == VOLTAGE_SOURCE:
+                lines.append("V%d %s %s %r\n" % (i, b, a, value))
+            else:
+                lines.append("%s%d %s %s %r\n" % (LETTERS[kind], i, a, b, value))
+        f.writelines(lines)
+    if circuit.ground is not None:
+        f.write(".ground %s\n" % formatNode(circuit.ground))
+    f.write(".end\n")
+
+def _batches(circuit):
+    """ Yields (kinds, src names, dest names, values, number of the first) per batch of elements """
+    if not isinstance(circuit, CompactCircuit):
+        elements = list(circuit.elements)
+        for start in xrange(0, len(elements), BATCH_SIZE):
+            batch = elements[start:start + BATCH_SIZE]
+            yield [kindCode(e) for e in batch], [formatNode(e.src) for e in batch], \
+                  [formatNode(e.dest) for e in batch], [float(valueOf(e)) for e in batch], start + 1
+        return
+    # Compact circuits are written straight from their arrays, naming each node once
+    locations, kinds, src, dest = circuit._arrays()
+    names = np.array([formatNode(loc) for loc in locations], dtype=object)
+    live = np.flatnonzero(kinds != REMOVED)
+    for start in xrange(0, len(live), BATCH_SIZE):
+        batch = live[start:start + BATCH_SIZE]
+        yield kinds[batch].tolist(), names[src[batch]], names[dest[batch]], \
+              circuit._value[batch].tolist(), start + 1
+
+def formatNode(location):
+    if isinstance(location, tuple):
+        return ",".join(map(str, location))
+    return str(location)
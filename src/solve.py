@@ -0,0 +1,145 @@
+""" Solves netlist files without the GUI, spreading them over a pool of worker
+processes. Each worker reads, solves and formats whole files on its own, so
+throughput grows with the number of cores.
+
+    python -m src.solve circuits/ more/*.net --format json -o voltages.jsonl
+
+Directories stand for the netlist files in them. Files in the binary format
+of binary.py are read as such, whatever their name. Voltages are written one
+line per node as CSV (file,node,voltage), or one JSON object per file. """
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+import netlist
+import binary
+from cache import SolutionCache
+
+# Files sent to a worker at a time
+CHUNK_SIZE = 4
+
+####################################################
+## Solving a file
+####################################################
+
+# Cache of solutions shared by the files a process solves, set by main()
+_cache = None
+
+def solveFile(filename):
+    """ Returns (locations, voltages) of a netlist's nodes in sorted order, or
+    raises ValueError if it can't be read or solved """
+    if binary.isBinary(filename):
+        circuit = binary.load(filename)
+    else:
+        circuit = netlist.load(filename)
+    circuit.cache = _cache
+    circuit.solve()
+    if not circuit.solved:
+        raise ValueError("circuit can't be solved")
+    locations = circuit._locations
+    order = circuit._locationOrder()
+    return [locations[i] for i in order], circuit._nodeVoltages[order].tolist()
+
+def formatCsv(filename, locations, voltages):
+    names = [_csvField(netlist.formatNode(loc)) for loc in locations]
+    rows = zip([_csvField(filename)] * len(names), names, map(repr, voltages))
+    return "".join("%s,%s,%s\n" % row for row in rows)
+
+def formatJson(filename, locations, voltages):
+    names = [netlist.formatNode(loc) for loc in locations]
+    # Floating nodes have no voltage, which JSON spells null
+    voltages = [None if v != v else v for v in voltages]
+    return json.dumps(OrderedDict([("file", filename), ("voltages", OrderedDict(zip(names, voltages)))])) + "\n"
+
+def _csvField(text):
+    if any(c in text for c in ',"\n'):
+        return '"%s"' % text.replace('"', '""')
+    return text
+
+FORMATS = {"csv": formatCsv, "json": formatJson}
+
+def _solveAndFormat(job):
+    """ Worker task: the output text of a file, or None and an error message """
+    filename, format = job
+    try:
+        locations, voltages = solveFile(filename)
+    except (ValueError, IOError) as e:
+        return filename, None, str(e)
+    return filename, FORMATS[format](filename, locations, voltages), None
+
+####################################################
+## Command line
+####################################################
+
+def findFiles(paths, pattern):
+    """ Expands directories to their files matching pattern, and globs """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        elif glob.has_magic(path):
+            files.extend(sorted(glob.glob(path)))
+        else:
+            files.append(path)
+    return files
+
+def solveFiles(files, out, format="csv", processes=None):
+    """ Solves files and writes their voltages to out in the order given.
+    Errors go to stderr. Returns the number of files that failed """
+    jobs = [(filename, format) for filename in files]
+    if format == "csv":
+        out.write("file,node,voltage\n")
+    if processes == 1:
+        results = (_solveAndFormat(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_solveAndFormat, jobs, CHUNK_SIZE)
+
+    failed = 0
+    try:
+        for filename, text, error in results:
+            if error is not None:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (filename, error))
+                if format == "json":
+                    out.write(json.dumps({"file": filename, "error": error}) + "\n")
+            else:
+                out.write(text)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Solve netlist files and write their node voltages.")
+    parser.add_argument("paths", nargs="+", help="netlist files, directories or globs")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("-o", "--output", help="file to write to, standard output by default")
+    parser.add_argument("-j", "--processes", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--pattern", default="*.net", help="netlist files to take from directories")
+    parser.add_argument("--cache", metavar="DIRECTORY",
+                        help="keep solutions in DIRECTORY and reuse them for circuits solved before")
+    args = parser.parse_args(argv)
+
+    # Set before the pool starts, so the workers inherit it
+    global _cache
+    if args.cache:
+        _cache = SolutionCache(directory=args.cache)
+
+    files = findFiles(args.paths, args.pattern)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        failed = solveFiles(files, out, args.format, args.processes)
+    finally:
+        if args.output:
+            out.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+""" Spatial index of a circuit drawn on a grid: which nodes and elements are
+near a point or inside a rectangle, without scanning the whole circuit.
+
+    attach(circuit)
+    circuit.addElement(Resistor((40, 60), (120, 60), 100.0))
+    circuit.spatial.nodeAt(42, 58, tolerance=20)    # (40, 60)
+
+The plane is cut into square buckets. Each node is kept in the bucket it
+falls in and each element in every bucket its bounding box touches, so a
+lookup only looks at the few buckets around the point. A circuit with an
+index (its spatial attribute) keeps it up to date as elements are added and
+removed. Elements whose
+ends aren't (x, y) locations aren't drawn anywhere, and aren't indexed. """
+
+import math
+from numbers import Real
+
+# Side of a bucket, the length of a resistor or voltage source in the GUI
+BUCKET_SIZE = 80
+# Elements spanning more buckets than this are kept in a list of their own
+# rather than in every bucket
+MAX_BUCKETS = 256
+
+class SpatialIndex(object):
+    """ Buckets of nodes and elements by position """
+
+    def __init__(self, bucketSize=BUCKET_SIZE):
+        self.bucketSize = bucketSize
+        # Bucket -> {key: element}, and key -> (element, buckets it is in)
+        self._buckets = dict()
+        self._elements = dict()
+        # Elements too big for the buckets
+        self._large = dict()
+        # Bucket -> {location: number of indexed elements ending there}
+        self._nodes = dict()
+
+    def __len__(self):
+        return len(self._elements)
+
+    def add(self, key, element):
+        """ Indexes an element under key, any hashable that identifies it """
+        src, dest = point(element.src), point(element.dest)
+        if src is None or dest is None:
+            return
+        self.remove(key)
+        buckets = self._bucketsOf(min(src[0], dest[0]), min(src[1], dest[1]),
+                                  max(src[0], dest[0]), max(src[1], dest[1]))
+        if len(buckets) > MAX_BUCKETS:
+            self._large[key] = element
+            buckets = []
+        for bucket in buckets:
+            self._buckets.setdefault(bucket, dict())[key] = element
+        self._elements[key] = (element, buckets)
+        for location in (src, dest):
+            counts = self._nodes.setdefault(self._bucket(*location), dict())
+            counts[location] = counts.get(location, 0) + 1
+
+    def remove(self, key):
+        """ Forgets the element indexed under key, if there is one """
+        entry = self._elements.pop(key, None)
+        if entry is None:
+            return
+        element, buckets = entry
+        self._large.pop(key, None)
+        for bucket in buckets:
+            elements = self._buckets[bucket]
+            del elements[key]
+            if not elements:
+                del self._buckets[bucket]
+        for location in (point(element.src), point(element.dest)):
+            bucket = self._bucket(*location)
+            counts = self._nodes[bucket]
+            counts[location] -= 1
+            if not counts[location]:
+                del counts[location]
+                if not counts:
+                    del self._nodes[bucket]
+
+    def clear(self):
+        self.__init__(self.bucketSize)
+
+    ####################################################
+    ## Lookups
+    ####################################################
+
+    def nodeAt(self, x, y, tolerance):
+        """ The node location closest to (x, y) no more than tolerance away
+        along either axis, or None """
+        best, bestDistance = None, None
+        for bucket in self._bucketsOf(x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            for location in self._nodes.get(bucket, ()):
+                dx, dy = location[0] - x, location[1] - y
+                if abs(dx) > tolerance or abs(dy) > tolerance:
+                    continue
+                distance = dx * dx + dy * dy
+                if best is None or distance < bestDistance:
+                    best, bestDistance = location, distance
+        return best
+
+    def elementAt(self, x, y, tolerance):
+        """ The element closest to (x, y), if its segment passes within
+        tolerance of it, or None """
+        best, bestDistance = None, None
+        candidates = self._near(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        for element in candidates:
+            distance = _segmentDistance(x, y, point(element.src), point(element.dest))
+            if distance <= tolerance and (best is None or distance < bestDistance):
+                best, bestDistance = element, distance
+        return best
+
+    def query(self, x0, y0, x1, y1):
+        """ Every element whose bounding box overlaps the rectangle """
+        found = []
+        for element in self._near(x0, y0, x1, y1):
+            src, dest = point(element.src), point(element.dest)
+            if max(src[0], dest[0]) >= x0 and min(src[0], dest[0]) <= x1 and \
+               max(src[1], dest[1]) >= y0 and min(src[1], dest[1]) <= y1:
+                found.append(element)
+        return found
+
+    def _near(self, x0, y0, x1, y1):
+        """ The elements in the buckets the rectangle touches, each once """
+        size = self.bucketSize
+        count = (math.floor(x1 / size) - math.floor(x0 / size) + 1) * \
+                (math.floor(y1 / size) - math.floor(y0 / size) + 1)
+        # A rectangle bigger than the circuit is quicker to answer by looking
+        # at every element
+        if count > len(self._elements):
+            return [element for element, _ in self._elements.itervalues()]
+        near = dict(self._large)
+        for bucket in self._bucketsOf(x0, y0, x1, y1):
+            near.update(self._buckets.get(bucket, ()))
+        return near.values()
+
+    def _bucket(self, x, y):
+        return (int(math.floor(x / self.bucketSize)), int(math.floor(y / self.bucketSize)))
+
+    def _bucketsOf(self, x0, y0, x1, y1):
+        """ Every bucket the rectangle touches """
+        (i0, j0), (i1, j1) = self._bucket(x0, y0), self._bucket(x1, y1)
+        return [(i, j) for i in xrange(i0, i1 + 1) for j in xrange(j0, j1 + 1)]
+
+def point(location):
+    """ The location as an (x, y) tuple, or None if it isn't a point. Named
+    nodes like ("blk", 0) are tuples too, so both coordinates must be numbers """
+    if isinstance(location, tuple) and len(location) == 2 and \
+       all(isinstance(c, Real) and not isinstance(c, bool) for c in location):
+        return location
+    return None
+
+def _segmentDistance(x, y, a, b):
+    """ Distance from (x, y) to the segment from a to b """
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length:
+        t = max(0.0, min(1.0, ((x - a[0]) * dx + (y - a[1]) * dy) / float(length)))
+    return math.hypot(x - a[0] - t * dx, y - a[1] - t * dy)
+
+def attach(circuit, bucketSize=BUCKET_SIZE):
+    """ Indexes every element of the circuit in a new SpatialIndex, which the
+    circuit then keeps up to date. Returns the index """
+    index = SpatialIndex(bucketSize)
+    for element in circuit.elements:
+        index.add(circuit._spatialKey(element), element)
+    circuit.spatial = index
+    return index
@@ -0,0 +1,176 @@
+""" Transient analysis: node voltages over time in circuits with capacitors
+and inductors.
+
+Each step replaces capacitors and inductors by their companion model, a
+conductance in parallel with a current source that carries the element's
+history. With a fixed timestep the conductances never change, so the system
+is factored once (twice for the trapezoidal rule, whose first step is taken
+by backward Euler) and every step is a right hand side update and a pair of
+triangular solves. Waveforms are produced a step at a time, so a long
+simulation only keeps what the caller keeps. """
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from circuit import stampSystem, GROUND, REMOVED, WIRE, \
+                    VOLTAGE_SOURCE, RESISTOR, CAPACITOR, INDUCTOR, NONLINEAR
+from matrix import Ordering
+
+METHODS = ("trapezoidal", "euler")
+
+####################################################
+## Running a simulation
+####################################################
+
+def transient(circuit, dt, steps, method="trapezoidal", sources=None):
+    """ Simulates the circuit for steps timesteps of dt seconds, starting with
+    every capacitor discharged and no current in any inductor.
+
+    method is "trapezoidal" or "euler" (backward Euler, which damps ringing
+    but is less accurate). The trapezoidal rule takes its first step by
+    backward Euler, as the currents it starts from are only known to be
+    zero before t = 0, not right after sources that step on. sources optionally maps voltage sources of the
+    circuit to their voltage over time: a function of t, or a sequence with a
+    value per step. The others keep their voltage.
+
+    Yields (t, voltages) for t = dt, 2 dt, ..., with the node voltages in
+    sorted(circuit.nodes) order. Raises ValueError if the circuit can't be
+    solved. """
+    return TransientSystem(circuit, dt, method).run(steps, sources)
+
+def record(circuit, dt, steps, filename=None, method="trapezoidal", sources=None):
+    """ Runs transient() and returns the voltages as an array with a row per
+    step and a column per node. With a filename the array is a memory-mapped
+    .npy file, so it can be bigger than memory and read back with np.load """
+    count = len(circuit.nodes)
+    if filename is None:
+        voltages = np.empty((steps, count))
+    else:
+        voltages = open_memmap(filename, mode="w+", dtype=float, shape=(steps, count))
+    for step, (_, v) in enumerate(transient(circuit, dt, steps, method, sources)):
+        voltages[step] = v
+    if filename is not None:
+        voltages.flush()
+    return voltages
+
+####################################################
+## The system solved each step
+####################################################
+
+class TransientSystem(object):
+    """ The circuit's equations with capacitors and inductors as companion
+    models for a timestep dt, factored once per method it steps with """
+
+    def __init__(self, circuit, dt, method="trapezoidal"):
+        if method not in METHODS:
+            raise ValueError("Unknown method %r" % method)
+        if circuit.ground not in circuit.nodes:
+            raise ValueError("The circuit has no ground")
+        self.circuit = circuit
+        self.dt = dt
+        self.method = method
+
+        # Only wires merge nodes: inductors and capacitors are both branches now
+        locations, kinds, src, dest = circuit._topologyArrays()
+        if np.any(kinds == NONLINEAR):
+            raise ValueError("Transient analysis doesn't support nonlinear elements")
+        cols, grounded, self.floating = circuit._columns(kinds == WIRE, kinds != REMOVED)
+        self.dim = cols.max() + 1
+        self._sortedCols = cols[circuit._locationOrder()]
+
+        values = circuit._values()
+        inSystem = grounded[src]
+        which = dict((kind, np.flatnonzero((kinds == kind) & inSystem))
+                     for kind in (RESISTOR, VOLTAGE_SOURCE, CAPACITOR, INDUCTOR))
+        self._sourceIdx = which[VOLTAGE_SOURCE]
+        self._voltages = values[self._sourceIdx]
+        self.size = self.dim + len(self._sourceIdx)
+
+        self._cSrc, self._cDest = cols[src[which[CAPACITOR]]], cols[dest[which[CAPACITOR]]]
+        self._lSrc, self._lDest = cols[src[which[INDUCTOR]]], cols[dest[which[INDUCTOR]]]
+        self._resistors = (cols[src[which[RESISTOR]]], cols[dest[which[RESISTOR]]],
+                           1.0 / values[which[RESISTOR]])
+        self._capacitance = values[which[CAPACITOR]]
+        self._inductance = values[which[INDUCTOR]]
+        self._vSrc, self._vDest = cols[src[self._sourceIdx]], cols[dest[self._sourceIdx]]
+
+        # The trapezoidal rule averages the two ends of the step, which
+        # doubles a capacitor's companion conductance and halves an inductor's
+        self._cG, self._lG, self.factor = self._companion(2.0 if method == "trapezoidal" else 1.0)
+        # Backward Euler for the first step, which only needs the state at t = 0
+        self._start = self._companion(1.0) if method == "trapezoidal" else None
+
+    def _companion(self, scale):
+        """ (capacitor conductances, inductor conductances, factored system) """
+        cG = scale * self._capacitance / self.dt
+        lG = self.dt / (scale * self._inductance)
+        rSrc, rDest, rG = self._resistors
+        conductance = np.concatenate((rG, cG, lG))
+        gSrc = np.concatenate((rSrc, self._cSrc, self._lSrc))
+        gDest = np.concatenate((rDest, self._cDest, self._lDest))
+        A = stampSystem(self.size, self.dim, gSrc, gDest, conductance, self._vSrc, self._vDest)
+        factor = Ordering(self.circuit.ordering).factor(A)
+        if factor is None:
+            raise ValueError("The circuit can't be solved")
+        return cG, lG, factor
+
+    def run(self, steps, sources=None):
+        """ Generator of (t, voltages) for each of steps timesteps """
+        waveforms = self._waveforms(sources or {})
+        trapezoidal = self.method == "trapezoidal"
+        # History current of each capacitor and inductor, from src to dest
+        cHistory = np.zeros(len(self._cG))
+        lHistory = np.zeros(len(self._lG))
+        b = np.zeros(self.size)
+        voltages = self._voltages.copy()
+
+        for step in xrange(steps):
+            t = (step + 1) * self.dt
+            cG, lG, factor = self._start if step == 0 and trapezoidal else \
+                             (self._cG, self._lG, self.factor)
+            for position, waveform in waveforms:
+                voltages[position] = waveform(step, t)
+
+            # A capacitor's history current is pushed into its src node, an
+            # inductor's pulled out of it
+            b[:] = 0.0
+            self._inject(b, self._cSrc, self._cDest, cHistory)
+            self._inject(b, self._lSrc, self._lDest, -lHistory)
+            b[self.dim:] = voltages
+            x = factor.solve(b)
+            if x is None:
+                raise ValueError("The circuit can't be solved at t = %g" % t)
+
+            # Ground's column is -1 and floating nodes' -2, as in Circuit.solve
+            v = np.append(x[:self.dim], (np.nan, 0.0))
+            vC = v[self._cSrc] - v[self._cDest]
+            vL = v[self._lSrc] - v[self._lDest]
+            # Currents at t by the step's own companion models, and the
+            # history the next step's models need
+            current = cG * vC - cHistory
+            cHistory = self._cG * vC + (current if trapezoidal else 0.0)
+            current = lG * vL + lHistory
+            lHistory = current + (self._lG * vL if trapezoidal else 0.0)
+
+            yield t, v[self._sortedCols]
+
+    def _inject(self, b, src, dest, current):
+        """ Adds a current flowing into src and out of dest to the KCL rows """
+        for nodes, sign in ((src, 1.0), (dest, -1.0)):
+            keep = nodes != GROUND
+            b[:self.dim] += sign * np.bincount(nodes[keep], current[keep], self.dim)
+
+    def _waveforms(self, sources):
+        """ (position, function of step and t) for each source with a waveform """
+        circuit = self.circuit
+        waveforms = []
+        for element, waveform in sources.iteritems():
+            i = circuit._elementIndex(element)
+            position = np.searchsorted(self._sourceIdx, i) if i is not None else len(self._sourceIdx)
+            if position >= len(self._sourceIdx) or self._sourceIdx[position] != i:
+                raise ValueError("%s is not a grounded voltage source of the circuit" % element)
+            if callable(waveform):
+                waveforms.append((position, lambda step, t, f=waveform: f(t)))
+            else:
+                values = np.asarray(waveform, dtype=float)
+                waveforms.append((position, lambda step, t, values=values: values[step]))
+        return waveforms
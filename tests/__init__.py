@@ -0,0 +1,5 @@
+""" Regression tests of the solver, each checking a result against a dense or
+analytic reference.
+
+    python -m unittest discover tests
+"""
@@ -0,0 +1,59 @@
+""" Circuits the tests share, and a dense reference solver for them that has
+nothing in common with the sparse one but the equations. """
+
+import numpy as np
+from src.circuit import Circuit, Resistor, VoltageSource, Wire
+
+def randomCircuit(nodes, extra=None, seed=0, cls=Circuit):
+    """ Connected circuit of resistors between grid locations (i, 0), a few of
+    them replaced by voltage sources and wires, grounded at (0, 0) """
+    random = np.random.RandomState(seed)
+    if extra is None:
+        extra = nodes
+    # A random spanning tree, so every node has a path to ground, plus extra links
+    pairs = [(random.randint(i), i) for i in xrange(1, nodes)]
+    pairs += [tuple(random.choice(nodes, 2, replace=False)) for _ in xrange(extra)]
+    circuit = cls()
+    for k, (a, b) in enumerate(pairs):
+        src, dest = (int(a), 0), (int(b), 0)
+        if k % 17 == 5:
+            circuit.addElement(VoltageSource(src, dest, random.uniform(-10, 10)))
+        elif k % 23 == 7:
+            circuit.addElement(Wire(src, dest))
+        else:
+            circuit.addElement(Resistor(src, dest, random.uniform(1, 1000)))
+    circuit.addGround((0, 0))
+    return circuit
+
+def denseVoltages(circuit):
+    """ Node voltages of a circuit of resistors, voltage sources and wires,
+    by modified nodal analysis on a dense matrix, in sorted(circuit.nodes)
+    order """
+    locations = sorted(circuit.nodes)
+    column = dict((location, i) for i, location in enumerate(locations))
+    elements = list(circuit.elementsInOrder())
+    sources = [e for e in elements if e.__class__.__name__.startswith(("VoltageSource", "Wire"))]
+    n = len(locations)
+    A = np.zeros((n + len(sources) + 1, n + len(sources)))
+    b = np.zeros(len(A))
+    for e in elements:
+        if e.__class__.__name__.startswith("Resistor"):
+            i, j, g = column[e.src], column[e.dest], 1.0 / e.resistance
+            A[i, i] += g
+            A[j, j] += g
+            A[i, j] -= g
+            A[j, i] -= g
+    # V(dest) - V(src) = voltage, with the source's current leaving dest
+    for k, e in enumerate(sources):
+        i, j = column[e.src], column[e.dest]
+        A[n + k, j], A[n + k, i] = 1.0, -1.0
+        A[j, n + k], A[i, n + k] = -1.0, 1.0
+        b[n + k] = e.voltage
+    # Ground is held at 0 volts by one more row
+    A[-1, column[circuit.ground]] = 1.0
+    x = np.linalg.lstsq(A, b, rcond=None)[0]
+    return x[:n]
+
+def voltages(circuit):
+    """ Solved node voltages in sorted(circuit.nodes) order """
+    return np.array([circuit.nodes[location].voltage for location in sorted(circuit.nodes)])
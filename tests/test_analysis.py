@@ -0,0 +1,120 @@
+""" Transient, AC, Newton and sensitivity analyses against analytic solutions
+and finite differences. """
+
+import unittest
+import numpy as np
+from src.circuit import Circuit, Resistor, VoltageSource, Capacitor, Inductor, Diode, \
+                        THERMAL_VOLTAGE
+from src.compact import CompactCircuit
+from src.transient import record
+from src.ac import acSweep
+from tests.reference import randomCircuit, voltages
+
+SOURCE, MIDDLE, GROUND = (0, 1), (1, 1), (0, 0)
+
+def divider(cls, element, volts=1.0, resistance=1000.0):
+    """ A source driving a resistor in series with element to ground, the
+    middle node between them """
+    circuit = cls()
+    circuit.addElement(VoltageSource(GROUND, SOURCE, volts))
+    circuit.addElement(Resistor(SOURCE, MIDDLE, resistance))
+    circuit.addElement(element)
+    circuit.addGround(GROUND)
+    return circuit
+
+class TransientTest(unittest.TestCase):
+
+    def testRCCharge(self):
+        R, C = 1000.0, 1e-6
+        dt, steps = R * C / 200, 1000
+        t = dt * np.arange(1, steps + 1)
+        exact = 1 - np.exp(-t / (R * C))
+        for cls in (Circuit, CompactCircuit):
+            circuit = divider(cls, Capacitor(MIDDLE, GROUND, C), resistance=R)
+            column = sorted(circuit.nodes).index(MIDDLE)
+            for method, tolerance in (("trapezoidal", 1e-4), ("euler", 3e-3)):
+                v = record(circuit, dt, steps, method=method)[:, column]
+                np.testing.assert_allclose(v, exact, atol=tolerance, err_msg=method)
+
+    def testRLCurrent(self):
+        R, L = 100.0, 1e-3
+        dt, steps = L / R / 200, 1000
+        t = dt * np.arange(1, steps + 1)
+        circuit = divider(Circuit, Inductor(MIDDLE, GROUND, L), resistance=R)
+        column = sorted(circuit.nodes).index(MIDDLE)
+        v = record(circuit, dt, steps)[:, column]
+        np.testing.assert_allclose(v, np.exp(-t * R / L), atol=1e-4)
+
+class ACTest(unittest.TestCase):
+
+    def testLowAndHighPass(self):
+        R, C, L = 1000.0, 1e-6, 1e-3
+        frequencies = np.logspace(0, 6, 25)
+        w = 2 * np.pi * frequencies
+        for cls in (Circuit, CompactCircuit):
+            result = acSweep(divider(cls, Capacitor(MIDDLE, GROUND, C), resistance=R), frequencies)
+            np.testing.assert_allclose(result.node(MIDDLE), 1 / (1 + 1j * w * R * C), rtol=1e-9)
+            result = acSweep(divider(cls, Inductor(MIDDLE, GROUND, L), resistance=R), frequencies)
+            np.testing.assert_allclose(result.node(MIDDLE), 1j * w * L / (R + 1j * w * L),
+                                       rtol=1e-9)
+
+    def testSourcePhasors(self):
+        circuit = divider(Circuit, Resistor(MIDDLE, GROUND, 3000.0))
+        source = circuit.voltageSources()[0]
+        result = acSweep(circuit, [50.0], {source: 2j})
+        np.testing.assert_allclose(result.node(MIDDLE), [1.5j], rtol=1e-12)
+
+class NewtonTest(unittest.TestCase):
+
+    def testDiodeDivider(self):
+        volts, R, Is = 5.0, 1000.0, 1e-14
+        for cls in (Circuit, CompactCircuit):
+            circuit = divider(cls, Diode(MIDDLE, GROUND, Is), volts, R)
+            circuit.solve()
+            self.assertTrue(circuit.solved)
+            v = circuit.nodes[MIDDLE].voltage
+            # The current through the resistor is the diode's
+            current = (volts - v) / R
+            self.assertAlmostEqual(current, Is * (np.exp(v / THERMAL_VOLTAGE) - 1),
+                                   delta=1e-9 * current)
+            self.assertTrue(0.6 < v < 0.7)
+
+    def testReverseBias(self):
+        circuit = divider(Circuit, Diode(GROUND, MIDDLE), 5.0)
+        circuit.solve()
+        self.assertAlmostEqual(circuit.nodes[MIDDLE].voltage, 5.0, places=6)
+
+class SensitivityTest(unittest.TestCase):
+
+    def assertMatchesDifferences(self, circuit, outputs, tolerance):
+        gradient = circuit.sensitivity(outputs)
+        columns = [sorted(circuit.nodes).index(output) for output in outputs]
+        for k, element in enumerate(circuit.elementsInOrder()):
+            # Wires are sources of 0 volts
+            name = [name for name in ("resistance", "voltage", "value") if hasattr(element, name)][0]
+            value = getattr(element, name)
+            step = 1e-6 * abs(value) if value else 1e-6
+            solved = []
+            for sign in (1, -1):
+                setattr(element, name, value + sign * step)
+                circuit.solve()
+                solved.append(voltages(circuit)[columns])
+            setattr(element, name, value)
+            difference = (solved[0] - solved[1]) / (2 * step)
+            np.testing.assert_allclose(gradient[:, k], difference, rtol=tolerance,
+                                       atol=tolerance * np.abs(gradient).max(),
+                                       err_msg=str(element))
+
+    def testLinear(self):
+        for cls in (Circuit, CompactCircuit):
+            circuit = randomCircuit(40, seed=7, cls=cls)
+            self.assertMatchesDifferences(circuit, [(5, 0), (17, 0), (39, 0)], 1e-5)
+
+    def testDiode(self):
+        circuit = divider(Circuit, Diode(MIDDLE, GROUND), 5.0)
+        circuit.addElement(Resistor(MIDDLE, (2, 1), 500.0))
+        circuit.addElement(Diode((2, 1), GROUND, 1e-12))
+        self.assertMatchesDifferences(circuit, [MIDDLE, (2, 1)], 1e-5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+""" DC solves: the sparse direct and iterative solvers, and the low-rank
+(Woodbury) updates of a cached factorization, against a dense solve and the
+benchmark circuits' known voltages. """
+
+import unittest
+import numpy as np
+from src import instrument
+from src.circuit import Circuit, Resistor, MAX_UPDATE_RANK
+from src.compact import CompactCircuit
+from bench.generators import GENERATORS, build
+from tests.reference import randomCircuit, denseVoltages, voltages
+
+class SolveTest(unittest.TestCase):
+
+    def testMatchesDense(self):
+        for cls in (Circuit, CompactCircuit):
+            for seed in xrange(5):
+                circuit = randomCircuit(200, seed=seed, cls=cls)
+                circuit.solve()
+                self.assertTrue(circuit.solved)
+                np.testing.assert_allclose(voltages(circuit), denseVoltages(circuit),
+                                           rtol=1e-9, atol=1e-9)
+
+    def testKnownVoltages(self):
+        for name, generator in sorted(GENERATORS.items()):
+            for backend in ("objects", "compact"):
+                case = generator(2000)
+                circuit = build(case, backend)
+                circuit.solve()
+                solved = [circuit.nodes[location].voltage for location in case.locations]
+                np.testing.assert_allclose(solved, case.expected, atol=1e-8, err_msg=name)
+
+    def testIterative(self):
+        for name in ("grid2d", "grid3d"):
+            case = GENERATORS[name](5000)
+            circuit = build(case, "compact")
+            circuit.iterative = True
+            circuit.solve()
+            solved = [circuit.nodes[location].voltage for location in case.locations]
+            np.testing.assert_allclose(solved, case.expected, atol=1e-6, err_msg=name)
+
+    def testUnsolvable(self):
+        circuit = Circuit()
+        circuit.addElement(Resistor((0, 0), (1, 0), 1.0))
+        circuit.addGround((0, 0))
+        circuit.solve()
+        self.assertTrue(circuit.unsolvable)
+
+class UpdateTest(unittest.TestCase):
+    """ Changed resistances applied to the factors of an earlier solve """
+
+    def setUp(self):
+        self.sink = instrument.ListSink()
+        instrument.enable(self.sink)
+
+    def tearDown(self):
+        instrument.disable()
+
+    def testLowRankUpdate(self):
+        circuit = randomCircuit(300, seed=3)
+        circuit.solve()
+        random = np.random.RandomState(0)
+        resistors = circuit.resistors()
+        order = random.permutation(len(resistors))
+        # Each update is from the factors of the first solve, so the ranks add up
+        for rank in (1, 4, MAX_UPDATE_RANK):
+            for i in order[:rank]:
+                resistors[i].resistance = random.uniform(1, 1000)
+            circuit.solve()
+            counters = self.sink.events[-1]["counters"]
+            self.assertEqual(counters.get("updateRank"), rank)
+            self.assertNotIn("factorizations", counters)
+            np.testing.assert_allclose(voltages(circuit), denseVoltages(circuit),
+                                       rtol=1e-8, atol=1e-8)
+
+    def testRefactorsPastMaxRank(self):
+        circuit = randomCircuit(300, seed=4)
+        circuit.solve()
+        for resistor in circuit.resistors()[:MAX_UPDATE_RANK + 1]:
+            resistor.resistance *= 2
+        circuit.solve()
+        self.assertEqual(self.sink.events[-1]["counters"].get("factorizations"), 1)
+        np.testing.assert_allclose(voltages(circuit), denseVoltages(circuit),
+                                   rtol=1e-9, atol=1e-9)
+
+    def testSweep(self):
+        circuit = randomCircuit(100, seed=5)
+        resistor = circuit.resistors()[10]
+        values = [1.0, 50.0, 2000.0]
+        swept = circuit.sweep(resistor, values)
+        for row, value in zip(swept, values):
+            resistor.resistance = value
+            np.testing.assert_allclose(row, denseVoltages(circuit), rtol=1e-8, atol=1e-8)
+
+if __name__ == "__main__":
+    unittest.main()
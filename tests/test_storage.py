@@ -0,0 +1,127 @@
+""" The canonical hash and solution cache, and circuits saved and loaded as
+netlists, binary files and pickles, which must solve as the original did. """
+
+import os
+import shutil
+import tempfile
+import unittest
+import cPickle as pickle
+from StringIO import StringIO
+import numpy as np
+from src import netlist, binary
+from src.circuit import Circuit, Resistor, Diode, Capacitor
+from src.compact import CompactCircuit
+from src.cache import SolutionCache
+from tests.reference import randomCircuit, denseVoltages, voltages
+
+def shuffled(circuit, seed):
+    """ The same circuit, its elements added in another order and every
+    resistor turned around """
+    copy = Circuit()
+    elements = list(circuit.elementsInOrder())
+    for i in np.random.RandomState(seed).permutation(len(elements)):
+        element = elements[i]
+        if isinstance(element, Resistor):
+            element = Resistor(element.dest, element.src, element.resistance)
+        copy.addElement(element)
+    copy.addGround(circuit.ground)
+    return copy
+
+class HashTest(unittest.TestCase):
+
+    def testEqualCircuits(self):
+        circuit = randomCircuit(100, seed=1)
+        key = circuit.canonicalHash()
+        self.assertEqual(shuffled(circuit, 0).canonicalHash(), key)
+        self.assertEqual(randomCircuit(100, seed=1, cls=CompactCircuit).canonicalHash(), key)
+
+    def testDifferentCircuits(self):
+        circuit = randomCircuit(100, seed=1)
+        key = circuit.canonicalHash()
+        circuit.resistors()[0].resistance *= 2
+        self.assertNotEqual(circuit.canonicalHash(), key)
+        circuit.resistors()[0].resistance /= 2
+        self.assertEqual(circuit.canonicalHash(), key)
+        circuit.addGround((1, 0))
+        self.assertNotEqual(circuit.canonicalHash(), key)
+
+    def testCache(self):
+        circuit = randomCircuit(100, seed=2)
+        circuit.cache = SolutionCache()
+        circuit.solve()
+        other = shuffled(circuit, 1)
+        other.cache = circuit.cache
+        other.solve()
+        self.assertEqual(circuit.cache.hits, 1)
+        np.testing.assert_allclose(voltages(other), denseVoltages(other), rtol=1e-9, atol=1e-9)
+        # Currents are stored turned around with the resistors
+        for element in other.resistors():
+            original = circuit.elementsBetween(element.src, element.dest)[0]
+            self.assertAlmostEqual(element.current, -original.current, places=9)
+
+    def testDiskCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            circuit = randomCircuit(50, seed=3)
+            circuit.cache = SolutionCache(directory=directory)
+            circuit.solve()
+            other = randomCircuit(50, seed=3, cls=CompactCircuit)
+            other.cache = SolutionCache(directory=directory)
+            other.solve()
+            self.assertEqual(other.cache.hits, 1)
+            np.testing.assert_allclose(voltages(other), voltages(circuit), rtol=1e-12)
+        finally:
+            shutil.rmtree(directory)
+
+class RoundTripTest(unittest.TestCase):
+
+    def assertSameSolution(self, circuit, loaded):
+        self.assertEqual(loaded.canonicalHash(), circuit.canonicalHash())
+        circuit.solve()
+        loaded.solve()
+        np.testing.assert_allclose(voltages(loaded), voltages(circuit), rtol=1e-12, atol=1e-12)
+
+    def testNetlist(self):
+        for cls in (Circuit, CompactCircuit):
+            circuit = randomCircuit(200, seed=4, cls=cls)
+            circuit.addElement(Capacitor((3, 0), (4, 0), 1e-6))
+            circuit.addElement(Diode((5, 0), (0, 0), 2e-14))
+            f = StringIO()
+            netlist.write(circuit, f)
+            f.seek(0)
+            self.assertSameSolution(circuit, netlist.read(f))
+
+    def testNamedNodes(self):
+        text = "V1 in 0 5\nR1 in out 1k\nR2 out 0 3k\n"
+        circuit = netlist.read(StringIO(text))
+        circuit.solve()
+        self.assertAlmostEqual(circuit.nodes["out"].voltage, 3.75)
+        f = StringIO()
+        netlist.write(circuit, f)
+        f.seek(0)
+        self.assertSameSolution(circuit, netlist.read(f))
+
+    def testBinary(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "circuit.cbin")
+            for cls in (Circuit, CompactCircuit):
+                circuit = randomCircuit(200, seed=5, cls=cls)
+                binary.save(circuit, filename)
+                self.assertTrue(binary.isBinary(filename))
+                loaded = binary.load(filename)
+                self.assertSameSolution(circuit, loaded)
+                # A loaded circuit is pickled as its file name, and maps it again
+                self.assertSameSolution(circuit, pickle.loads(pickle.dumps(loaded, 2)))
+                del loaded
+        finally:
+            shutil.rmtree(directory)
+
+    def testPickle(self):
+        for cls in (Circuit, CompactCircuit):
+            circuit = randomCircuit(100, seed=6, cls=cls)
+            circuit.solve()
+            self.assertSameSolution(circuit, pickle.loads(pickle.dumps(circuit, 2)))
+
+if __name__ == "__main__":
+    unittest.main()